@@ -0,0 +1,824 @@
+"""
+Локальные бенчмарки бота. Telegram не нужен: вместо Bot API поднимается заглушка.
+
+    python bench.py replay --mode both --count 5000
+    python bench.py replay --updates recorded.jsonl
+    python bench.py replay --latency 50 --flood 0.01
+    python bench.py spam --count 100000
+    python bench.py shard --shards 1 2 4 --count 20000
+    python bench.py startup --chats 20000
+    python bench.py welcome --batch 1 10 100 500
+    python bench.py warnings --count 1000000
+
+Обновления для replay можно записать с живого бота: RECORD_UPDATES_FILE=updates.jsonl python bot.py
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import parse_qs
+
+# Данные бенчмарка не должны попасть в рабочий bot_data/
+os.environ.setdefault("BOT_DATA_DIR", tempfile.mkdtemp(prefix="bench_bot_data_"))
+
+import httpx
+from telegram import Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+import bot
+
+logging.getLogger().setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+TOKEN = "123456:BENCH"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+OWNER_ID = 1000
+WEBHOOK_SECRET = "bench-secret"
+BOT_ADMIN_RIGHTS = {
+    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+    "can_manage_video_chats": False, "can_restrict_members": True, "can_promote_members": True,
+    "can_change_info": False, "can_invite_users": True, "can_post_stories": False,
+    "can_edit_stories": False, "can_delete_stories": False, "can_pin_messages": True,
+}
+# Методы, на которые FakeBotApi отвечает 429 с вероятностью --flood: на практике
+# Telegram ограничивает отправку, а её бот повторяет через очередь исходящих
+FLOOD_METHODS = {"sendMessage"}
+
+
+# ==================== ЗАГЛУШКА BOT API ====================
+class FakeBotApi:
+    """
+    Локальный HTTP-сервер вместо api.telegram.org: отвечает на методы Bot API,
+    отдаёт обновления через getUpdates и считает вызовы по методам.
+    latency — средняя задержка ответа (±50%), flood — доля отправок,
+    на которые приходит 429 с retry_after секунд.
+    """
+
+    def __init__(self, latency: float = 0.0, flood: float = 0.0, retry_after: int = 1, seed: int = 1):
+        self.latency = latency
+        self.flood = flood
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.calls = Counter()
+        self.flooded = Counter()
+        self.promoted = set()
+        self.pending = []
+        # Сколько обновлений обработал каждый воркер шарда (метод benchProgress)
+        self.progress = {}
+        self.progressed = asyncio.Event()
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+        self._server = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def feed(self, updates):
+        self.pending.extend(updates)
+        self._new_updates.set()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rsplit("/", 1)[-1]
+                self.calls[method] += 1
+                if method != "getUpdates" and self.latency:
+                    await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+                if method in FLOOD_METHODS and self._random.random() < self.flood:
+                    self.flooded[method] += 1
+                    status = b"429 Too Many Requests"
+                    payload = json.dumps({
+                        "ok": False, "error_code": 429,
+                        "description": f"Too Many Requests: retry after {self.retry_after}",
+                        "parameters": {"retry_after": self.retry_after},
+                    }).encode()
+                else:
+                    status = b"200 OK"
+                    result = await self.dispatch(method, self._parse(headers, body))
+                    payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 %s\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n" % (status, len(payload)) + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(headers: dict, body: bytes) -> dict:
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        return {}
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup", "title": "Bench"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def dispatch(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if method == "sendMessage":
+            return self._message(params)
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False, "user": user_json(OWNER_ID)}]
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            if user_id == BOT_USER["id"]:
+                # Бот — админ чата с обычным для модерации набором прав
+                return dict(BOT_ADMIN_RIGHTS, status="administrator", user=BOT_USER)
+            if user_id in self.promoted:
+                return dict(BOT_ADMIN_RIGHTS, status="administrator", user=user_json(user_id))
+            return {"status": "member", "user": user_json(user_id)}
+        if method == "promoteChatMember":
+            self.promoted.add(int(params["user_id"]))
+        if method == "getChatMemberCount":
+            return 1000
+        if method == "benchProgress":
+            self.progress[params["shard"]] = int(params["processed"])
+            self.progressed.set()
+        return True
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), 0.5)
+            except asyncio.TimeoutError:
+                return []
+        return self.pending[:limit]
+
+
+# ==================== ОБНОВЛЕНИЯ ====================
+def user_json(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+
+def synthetic_updates(count: int, chats: int = 50, users: int = 2000, seed: int = 1, moderation: float = 0.0):
+    """
+    Смесь обычных сообщений, ключевых слов, @admins, команд и вступлений в чат.
+    moderation — доля команд владельца (модерация, настройки) и chat_member-обновлений,
+    чтобы через бенчмарк проходили и остальные обработчики.
+    """
+    rnd = random.Random(seed)
+    texts = ["salom hammaga", "bugun o'yin bormi?", "donat qancha?", "garant bormi", "@admins yordam"]
+    commands = ["/help", "/rules", "/warns", "/chatid", "/info"]
+    owner_commands = [
+        "/warn {user} spam", "/warns {user}", "/resetwarns {user}", "/mute {user} 5m", "/unmute {user}",
+        "/ban {user} 1h reklama", "/unban {user}", "/kick {user}", "/history {user}", "/info {user}",
+        "/admins", "/keywords", "/addkeyword garant Garant: @admins", "/delkeyword garant",
+        "/setrules 1. Spam yo'q", "/setwelcome Salom {user}!", "/statsbot", "/start",
+    ]
+    updates = []
+    for i in range(count):
+        chat_id = -1001000000000 - rnd.randrange(chats)
+        message = {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": user_json(OWNER_ID + rnd.randrange(users)),
+        }
+        roll = rnd.random()
+        if roll < 0.05:
+            message["new_chat_members"] = [user_json(OWNER_ID + users + i)]
+        elif roll < 0.2:
+            command = rnd.choice(commands)
+            message["text"] = command
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        elif roll < 0.2 + moderation / 2:
+            # Вступление через chat_member: его видит track_chat_members
+            member = user_json(OWNER_ID + rnd.randrange(users))
+            updates.append({"update_id": i + 1, "chat_member": {
+                "chat": message["chat"], "from": member, "date": message["date"],
+                "old_chat_member": {"status": "left", "user": member},
+                "new_chat_member": {"status": "member", "user": member},
+            }})
+            continue
+        elif roll < 0.2 + moderation:
+            command = rnd.choice(owner_commands).format(user=OWNER_ID + 1 + rnd.randrange(users - 1))
+            message["from"] = user_json(OWNER_ID)
+            message["text"] = command
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}]
+        else:
+            message["text"] = rnd.choice(texts)
+        updates.append({"update_id": i + 1, "message": message})
+    return updates
+
+
+def load_updates(path: str):
+    """Записанные обновления (JSON Lines); update_id перенумеровываются по порядку"""
+    updates = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                update = json.loads(line)
+                update["update_id"] = len(updates) + 1
+                updates.append(update)
+    return updates
+
+
+# ==================== REPLAY ====================
+class CountingProcessor(SimpleUpdateProcessor):
+    """
+    Считает обновления после всех обработчиков — в том числе те, обработку
+    которых остановил ApplicationHandlerStop (анти-флуд, анти-спам).
+    """
+
+    def __init__(self, on_done, max_concurrent_updates: int = 256):
+        super().__init__(max_concurrent_updates)
+        self.on_done = on_done
+        self.seconds = []
+
+    async def do_process_update(self, update, coroutine):
+        started = time.perf_counter()
+        await coroutine
+        self.seconds.append(time.perf_counter() - started)
+        self.on_done()
+
+
+class HandlerTimes:
+    """Время каждого вызова каждого обработчика Application (поверх bot.timed)"""
+
+    def __init__(self, application):
+        self.seconds = defaultdict(list)
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = self._timed(handler.callback)
+
+    def _timed(self, callback):
+        samples = self.seconds[callback.__name__]
+
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        return wrapper
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def data_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def replay(updates, mode: str, concurrency: int = 32, timeout: float = 300, api: FakeBotApi = None):
+    """
+    Прогон обновлений через настоящий Application в режиме polling или webhook.
+    Returns: словарь с временем, вызовами Bot API, временами обработчиков и записью на диск
+    """
+    api = api or FakeBotApi()
+    await api.start()
+    processed = 0
+    finished = asyncio.Event()
+
+    def count():
+        nonlocal processed
+        processed += 1
+        if processed >= len(updates):
+            finished.set()
+
+    processor = CountingProcessor(count)
+    application = bot.build_application(TOKEN, api.base_url, concurrent_updates=processor)
+    handler_times = HandlerTimes(application)
+    written_before = Counter(bot.metrics.bytes_written)
+    size = data_size(bot.DATA_DIR)
+
+    async with application:
+        # Как run_polling/run_webhook: post_init запускает планировщик
+        await application.post_init(application)
+        await application.start()
+        started = time.perf_counter()
+        if mode == "polling":
+            api.feed(updates)
+            await application.updater.start_polling(poll_interval=0, timeout=1, allowed_updates=Update.ALL_TYPES)
+        else:
+            port = _free_port()
+            url = f"http://127.0.0.1:{port}/telegram"
+            await application.updater.start_webhook(
+                listen="127.0.0.1", port=port, url_path="telegram",
+                webhook_url=url, secret_token=WEBHOOK_SECRET
+            )
+            semaphore = asyncio.Semaphore(concurrency)
+            async with httpx.AsyncClient() as client:
+                async def post(update):
+                    async with semaphore:
+                        await client.post(
+                            url, content=json.dumps(update),
+                            headers={
+                                "Content-Type": "application/json",
+                                "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET,
+                            }
+                        )
+                await asyncio.gather(*(post(u) for u in updates))
+        await asyncio.wait_for(finished.wait(), timeout)
+        elapsed = time.perf_counter() - started
+        await bot.outbox.drain(timeout)
+        drained = time.perf_counter() - started - elapsed
+        await application.updater.stop()
+        await application.stop()
+        # Отложенные записи — тоже часть работы этого прогона
+        await bot.storage.flush()
+    await api.stop()
+    written = Counter(bot.metrics.bytes_written)
+    written.subtract(written_before)
+    return {
+        "elapsed": elapsed,
+        "drained": drained,
+        "calls": api.calls,
+        "flooded": api.flooded,
+        "updates": processor.seconds,
+        "handlers": handler_times.seconds,
+        "written": +written,
+        "growth": data_size(bot.DATA_DIR) - size,
+    }
+
+
+def print_replay_report(mode: str, total: int, elapsed: float, calls: Counter):
+    api_calls = sum(calls.values()) - calls["getUpdates"]
+    print(f"\n[{mode}] {total} ta update: {elapsed:.2f} s, {total / elapsed:.0f} update/s")
+    print(f"  Bot API: {api_calls} ta chaqiruv ({api_calls / total:.2f} / update)")
+    for method, n in calls.most_common():
+        print(f"    {method:<24} {n:>7} {n / total:>7.3f}")
+
+
+def print_latency_report(result: dict):
+    print(f"  Chiquvchi navbat bo'shashi: {result['drained']:.2f} s"
+          + (f", 429: {sum(result['flooded'].values())} ta" if result["flooded"] else ""))
+    print(f"  {'ishlovchi':<28} {'chaqiruv':>8} {'p50, ms':>8} {'p99, ms':>8}")
+    rows = [("(update)", result["updates"])] + sorted(
+        ((name, samples) for name, samples in result["handlers"].items() if samples),
+        key=lambda row: -len(row[1])
+    )
+    for name, samples in rows:
+        print(f"  {name:<28} {len(samples):>8} {percentile(samples, 0.5) * 1000:>8.2f} "
+              f"{percentile(samples, 0.99) * 1000:>8.2f}")
+    print(f"  {bot.DATA_DIR} ga yozildi: {sum(result['written'].values())} bayt, "
+          f"hajm o'zgarishi: {result['growth']:+d} bayt")
+    for name, size in result["written"].most_common():
+        print(f"    {name:<24} {size:>10}")
+
+
+def cmd_replay(args):
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(
+        args.count, moderation=args.moderation
+    )
+    bot.load_data()
+    disable_send_limits()
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        api = FakeBotApi(args.latency / 1000, args.flood, args.retry_after)
+        result = asyncio.run(replay(updates, mode, args.concurrency, api=api))
+        print_replay_report(mode, len(updates), result["elapsed"], result["calls"])
+        print_latency_report(result)
+
+
+# ==================== SHARD ====================
+def disable_send_limits():
+    # Меряем приём обновлений, а не лимиты Telegram на отправку
+    bot.GLOBAL_SEND_RATE = bot.GROUP_SEND_RATE = bot.PRIVATE_SEND_RATE = 1e6
+    bot.GROUP_SEND_BURST = 1e6
+
+
+async def shard_run(updates, shards: int, timeout: float = 300):
+    """Прогон обновлений через приёмник и shards воркеров (отдельных процессов)"""
+    api = FakeBotApi()
+    await api.start()
+    # Каждый прогон — с чистыми данными: число шардов у каталога менять нельзя
+    for name in os.listdir(bot.DATA_DIR):
+        path = os.path.join(bot.DATA_DIR, name)
+        if name.startswith("shard-") and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif name in ("shards.json", "owner"):
+            os.remove(path)
+    ingress = bot.ShardIngress(TOKEN, shards, api.base_url,
+                               worker_command=[sys.executable, os.path.abspath(__file__), "shard-worker"])
+    try:
+        await ingress.start()
+        started = time.perf_counter()
+        api.feed(updates)
+        run = asyncio.create_task(ingress.run())
+        deadline = started + timeout
+        while sum(api.progress.values()) < len(updates):
+            if run.done() or time.perf_counter() > deadline:
+                raise RuntimeError(f"{sum(api.progress.values())} / {len(updates)} update qayta ishlandi")
+            api.progressed.clear()
+            try:
+                await asyncio.wait_for(api.progressed.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        elapsed = time.perf_counter() - started
+        ingress.stop()
+        await run
+    finally:
+        await ingress.close()
+        await api.stop()
+    return elapsed, api.calls, dict(api.progress)
+
+
+def cmd_shard(args):
+    updates = synthetic_updates(args.count, chats=args.chats)
+    for shards in args.shards:
+        elapsed, calls, progress = asyncio.run(shard_run(updates, shards))
+        calls.pop("benchProgress", None)
+        print_replay_report(f"{shards} shard", len(updates), elapsed, calls)
+        print("  Workerlar bo'yicha: " + ", ".join(f"#{k}: {n}" for k, n in sorted(progress.items())))
+
+
+def cmd_shard_worker(args):
+    """Воркер для cmd_shard: bot.py-воркер плюс отчёт о числе обработанных обновлений"""
+    bot.load_data()
+    disable_send_limits()
+    shard = os.path.basename(bot.DATA_DIR)
+    processed = 0
+
+    def count():
+        nonlocal processed
+        processed += 1
+
+    application = bot.build_application(TOKEN, bot.BOT_API_URL, polling=False,
+                                        concurrent_updates=CountingProcessor(count))
+
+    async def report():
+        while True:
+            await asyncio.sleep(0.05)
+            await application.bot.do_api_request("benchProgress", api_kwargs={"shard": shard, "processed": processed})
+
+    on_start = application.post_init
+
+    async def post_init(app):
+        await on_start(app)
+        # Не app.create_task: такие задачи Application ждёт при остановке
+        asyncio.create_task(report())
+
+    application.post_init = post_init
+    asyncio.run(bot.run_shard_worker(application, bot.SHARD_SOCKET))
+    bot.storage.close()
+
+
+# ==================== STARTUP ====================
+def make_chat_data(data_dir: str, chats: int, seed: int = 1):
+    """
+    Данные chats чатов в формате бота (файл на чат) и те же данные в прежних
+    общих файлах warnings.json, welcome.json, ... в data_dir/legacy.
+    """
+    rnd = random.Random(seed)
+    legacy = {"warnings": {}, "welcome": {}, "rules": {}, "admins": {}, "keywords": {}}
+    os.makedirs(os.path.join(data_dir, "chats"))
+    for i in range(chats):
+        chat_id = str(-1001000000000 - i)
+        chat = {
+            "warnings": {
+                str(OWNER_ID + rnd.randrange(10 ** 6)): [
+                    {"reason": "Qoidabuzarlik", "date": "2026-01-01T00:00:00", "by": OWNER_ID}
+                    for _ in range(rnd.randrange(1, 3))
+                ]
+                for _ in range(rnd.randrange(10))
+            },
+            "welcome": "Xush kelibsiz, {name}! Qoidalar: /rules",
+            "rules": "1. Spam yo'q\n2. Reklama yo'q\n3. Hurmat",
+            "admins": [OWNER_ID + rnd.randrange(1000) for _ in range(rnd.randrange(3))],
+            "keywords": {f"so'z{k}": f"javob {k}" for k in range(rnd.randrange(5))},
+        }
+        with open(os.path.join(data_dir, "chats", f"{chat_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(chat, f, ensure_ascii=False)
+        for section, value in chat.items():
+            legacy[section][chat_id] = value
+    with open(os.path.join(data_dir, "schedule.json"), 'w', encoding='utf-8') as f:
+        json.dump({"next_id": 1, "backfilled": True, "entries": {}}, f)
+    os.makedirs(os.path.join(data_dir, "legacy"))
+    for section, value in legacy.items():
+        with open(os.path.join(data_dir, "legacy", f"{section}.json"), 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False, indent=2)
+
+
+def cmd_startup(args):
+    data_dir = tempfile.mkdtemp(prefix="bench_startup_")
+    make_chat_data(data_dir, args.chats)
+    # Так load_data() читал все общие файлы до запуска
+    started = time.perf_counter()
+    for name in os.listdir(os.path.join(data_dir, "legacy")):
+        with open(os.path.join(data_dir, "legacy", name), 'r', encoding='utf-8') as f:
+            json.load(f)
+    eager = time.perf_counter() - started
+
+    runs = []
+    for _ in range(args.runs):
+        started = time.time()
+        env = dict(os.environ, BOT_DATA_DIR=data_dir, BENCH_STARTED=repr(started))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "startup-child"],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    shutil.rmtree(data_dir)
+
+    print(f"\n[startup] {args.chats} ta chat, {args.runs} ta ishga tushirish (median)")
+    for phase in ("import", "load_data", "build", "initialize", "first_update", "total"):
+        values = sorted(run[phase] for run in runs)
+        print(f"  {phase:<14} {values[len(values) // 2] * 1000:8.1f} ms")
+    print(f"  Oldingi umumiy fayllarni o'qish (eager load_data): {eager * 1000:.1f} ms")
+
+
+def cmd_startup_child(args):
+    """Один холодный запуск: от старта процесса до первого обработанного обновления"""
+    started = float(os.environ["BENCH_STARTED"])
+    phases = {"import": time.time() - started}
+    mark = time.time()
+    bot.load_data()
+    phases["load_data"] = time.time() - mark
+
+    async def run():
+        mark = time.time()
+        api = FakeBotApi()
+        await api.start()
+        first = asyncio.Event()
+        application = bot.build_application(TOKEN, api.base_url, concurrent_updates=CountingProcessor(first.set))
+        phases["build"] = time.time() - mark
+        mark = time.time()
+        async with application:
+            await application.post_init(application)
+            await application.start()
+            phases["initialize"] = time.time() - mark
+            mark = time.time()
+            # Первое обновление — в чат с данными: читается файл этого чата
+            api.feed(synthetic_updates(1, chats=1))
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+            await first.wait()
+            phases["first_update"] = time.time() - mark
+            phases["total"] = time.time() - started
+            await application.updater.stop()
+            await application.stop()
+        await api.stop()
+
+    asyncio.run(run())
+    print(json.dumps(phases))
+
+
+# ==================== SPAM ====================
+def spam_messages(count: int, chats: int = 200, waves: int = 20, seed: int = 1):
+    """
+    Поток сообщений: обычная переписка и волны спама — один текст с мелкими
+    правками (числа, ссылки, эмодзи, регистр, лишнее слово) по многим чатам.
+    Возвращает [(chat_id, текст, это_спам)].
+    """
+    rnd = random.Random(seed)
+    letters = "abdefghijklmnopqrstuvxyz"
+    vocab = ["".join(rnd.choices(letters, k=rnd.randrange(2, 10))) for _ in range(20000)]
+    # Частоты слов по закону Ципфа, как в живой переписке
+    cum_weights = list(itertools.accumulate(1 / (i + 1) for i in range(len(vocab))))
+    templates = [" ".join(rnd.choices(vocab, cum_weights=cum_weights, k=rnd.randrange(8, 30))) for _ in range(waves)]
+    messages = []
+    for _ in range(count):
+        chat_id = -1001000000000 - rnd.randrange(chats)
+        if rnd.random() < 0.3:
+            words = rnd.choice(templates).split()
+            variant = rnd.randrange(5)
+            if variant == 0:
+                words.append(f"https://t.me/promo{rnd.randrange(10 ** 6)}")
+            elif variant == 1:
+                words.insert(rnd.randrange(len(words)), f"{rnd.randrange(1000)}$")
+            elif variant == 2:
+                words = [w.upper() if rnd.random() < 0.3 else w for w in words] + ["🔥🔥"]
+            elif variant == 3:
+                words[rnd.randrange(len(words))] = rnd.choice(vocab)
+            messages.append((chat_id, " ".join(words), True))
+        else:
+            text = " ".join(rnd.choices(vocab, cum_weights=cum_weights, k=rnd.randrange(2, 25)))
+            messages.append((chat_id, text, False))
+    return messages
+
+
+def cmd_spam(args):
+    messages = spam_messages(args.count)
+    index = bot.SpamIndex()
+    flagged = Counter()
+    started = time.perf_counter()
+    for i, (chat_id, text, _) in enumerate(messages):
+        # Виртуальное время: поток идёт со скоростью --rate сообщений в секунду
+        flagged[i] = bot.is_spam(index.check(chat_id, text, i / args.rate))
+    elapsed = time.perf_counter() - started
+
+    spam_total = sum(1 for *_, is_spam in messages if is_spam)
+    caught = sum(1 for i, (*_, is_spam) in enumerate(messages) if is_spam and flagged[i])
+    false_positives = sum(1 for i, (*_, is_spam) in enumerate(messages) if not is_spam and flagged[i])
+    print(f"\n[spam] {len(messages)} ta xabar: {elapsed:.2f} s, {len(messages) / elapsed:.0f} xabar/s, "
+          f"{elapsed / len(messages) * 1e6:.1f} mks/xabar")
+    print(f"  Spam: {spam_total} ta, aniqlandi {caught} ({caught / max(spam_total, 1):.1%})")
+    print(f"  Noto'g'ri aniqlangan oddiy xabarlar: {false_positives}")
+    print(f"  Indeksdagi yozuvlar: {len(index)}")
+
+
+# ==================== WELCOME ====================
+def replace_render(template: str, members, chat_title: str) -> str:
+    """Прежний render_welcome для сравнения: .replace по сырому тексту на каждое приветствие"""
+    text = template.replace("{chat}", chat_title or "")
+    slots = text.count("{user}")
+    if not slots:
+        return text[:bot.MAX_MESSAGE_LENGTH]
+    budget = (bot.MAX_MESSAGE_LENGTH - len(text) + slots * len("{user}")) // slots
+    mentions = []
+    used = 0
+    for i, member in enumerate(members):
+        mention = member.mention_html()
+        rest = len(members) - i - 1
+        suffix = len(f" va yana {rest} kishi") if rest else 0
+        if used + len(mention) + 2 + suffix > budget:
+            break
+        mentions.append(mention)
+        used += len(mention) + 2
+    users = ", ".join(mentions)
+    if len(mentions) < len(members):
+        users += f" va yana {len(members) - len(mentions)} kishi"
+    return text.replace("{user}", users)
+
+
+def cmd_welcome(args):
+    text = "👋 <b>Xush kelibsiz {user}!</b>\n{chat} guruhiga qo'shilganingiz bilan. Qoidalar: /rules"
+    title = "Bench guruhi"
+    print(f"\n[welcome] {args.runs} ta render, mks/render")
+    print(f"  {'batch':>6} {'replace':>10} {'shablon':>10}")
+    for size in args.batch:
+        members = [User(i, f"User{i}", False, username=f"user{i}") for i in range(size)]
+        started = time.perf_counter()
+        for _ in range(args.runs):
+            replace_render(text, members, title)
+        replaced = (time.perf_counter() - started) / args.runs
+        started = time.perf_counter()
+        for _ in range(args.runs):
+            bot.render_template(bot.compile_template(text), members, title)
+        compiled = (time.perf_counter() - started) / args.runs
+        print(f"  {size:>6} {replaced * 1e6:>10.1f} {compiled * 1e6:>10.1f}")
+
+
+# ==================== WARNINGS ====================
+def warnings_json(count: int, chats: int, seed: int = 1) -> list:
+    """JSON-тексты warnings-секций chats чатов, всего count ogohlantirish в прежнем формате"""
+    rnd = random.Random(seed)
+    reasons = ["Sabab ko'rsatilmagan", "Spam", "Reklama", "Haqorat", "Qoidabuzarlik"]
+    sections = [{} for _ in range(chats)]
+    issued = 0
+    while issued < count:
+        # У большинства пользователей 1-2 ogohlantirish, причины в основном повторяются
+        items = sections[rnd.randrange(chats)].setdefault(str(OWNER_ID + rnd.randrange(10 ** 9)), [])
+        for _ in range(min(rnd.choice((1, 1, 2)), count - issued)):
+            reason = rnd.choice(reasons) if rnd.random() < 0.9 else f"Sabab #{rnd.randrange(10 ** 6)}"
+            date = datetime.fromtimestamp(1767225600 + rnd.randrange(10 ** 7)).isoformat()
+            items.append({"reason": reason, "date": date, "by": OWNER_ID})
+            issued += 1
+    return [json.dumps(section, ensure_ascii=False) for section in sections]
+
+
+def measure(build):
+    """(результат, занятая им память в байтах)"""
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def cmd_warnings(args):
+    texts = warnings_json(args.count, args.chats)
+    # Прежний вид — как его оставлял json.load: словари со строковыми ключами и ISO-датами
+    legacy, legacy_size = measure(lambda: [json.loads(text) for text in texts])
+    tables, table_size = measure(lambda: [bot.WarningTable.from_json(section) for section in legacy])
+    total = sum(len(table) for table in tables)
+    users = [[int(user_id) for user_id in section] for section in legacy]
+
+    started = time.perf_counter()
+    for section, ids in zip(legacy, users):
+        for user_id in ids:
+            section.get(str(user_id), [])
+    legacy_get = time.perf_counter() - started
+    started = time.perf_counter()
+    for table, ids in zip(tables, users):
+        for user_id in ids:
+            table.get(user_id)
+    table_get = time.perf_counter() - started
+    lookups = sum(len(ids) for ids in users)
+
+    print(f"\n[warnings] {total} ta ogohlantirish, {lookups} ta foydalanuvchi, {args.chats} ta chat")
+    print(f"  {'':<10} {'MB':>8} {'bayt/yozuv':>11} {'get, mks':>9}")
+    print(f"  {'dict':<10} {legacy_size / 2 ** 20:>8.1f} {legacy_size / total:>11.0f} "
+          f"{legacy_get / lookups * 1e6:>9.2f}")
+    print(f"  {'jadval':<10} {table_size / 2 ** 20:>8.1f} {table_size / total:>11.0f} "
+          f"{table_get / lookups * 1e6:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bot benchmarklari")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("replay", help="update oqimini polling/webhook orqali o'tkazish")
+    p.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    p.add_argument("--updates", help="yozib olingan update'lar (JSON Lines)")
+    p.add_argument("--count", type=int, default=5000, help="sintetik update'lar soni")
+    p.add_argument("--concurrency", type=int, default=32, help="webhook uchun parallel so'rovlar")
+    p.add_argument("--moderation", type=float, default=0.02,
+                   help="sintetik oqimdagi egasi buyruqlari va chat_member update'lari ulushi")
+    p.add_argument("--latency", type=float, default=0, help="Bot API javobining o'rtacha kechikishi, ms")
+    p.add_argument("--flood", type=float, default=0, help="429 qaytariladigan sendMessage ulushi")
+    p.add_argument("--retry-after", type=int, default=1, help="429 javobidagi retry_after, s")
+    p.set_defaults(func=cmd_replay)
+
+    p = sub.add_parser("spam", help="spam-indeks o'tkazuvchanligi va aniqligi")
+    p.add_argument("--count", type=int, default=100000, help="xabarlar soni")
+    p.add_argument("--rate", type=float, default=10000, help="oqim tezligi, xabar/s (virtual vaqt)")
+    p.set_defaults(func=cmd_spam)
+
+    p = sub.add_parser("shard", help="BOT_SHARDS rejimi: qabul qiluvchi va N ta worker jarayon")
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="workerlar soni")
+    p.add_argument("--count", type=int, default=20000, help="sintetik update'lar soni")
+    p.add_argument("--chats", type=int, default=50, help="chatlar soni")
+    p.set_defaults(func=cmd_shard)
+
+    # Запускается самим cmd_shard через ShardIngress
+    p = sub.add_parser("shard-worker")
+    p.set_defaults(func=cmd_shard_worker)
+
+    p = sub.add_parser("startup", help="ishga tushishdan birinchi update'gacha vaqt")
+    p.add_argument("--chats", type=int, default=20000, help="ma'lumotlari bor chatlar soni")
+    p.add_argument("--runs", type=int, default=5, help="ishga tushirishlar soni")
+    p.set_defaults(func=cmd_startup)
+
+    p = sub.add_parser("startup-child")
+    p.set_defaults(func=cmd_startup_child)
+
+    p = sub.add_parser("welcome", help="guruhlangan qo'shilishlar uchun salomlashuv render'i")
+    p.add_argument("--batch", type=int, nargs="+", default=[1, 10, 100, 500], help="bir xabardagi a'zolar soni")
+    p.add_argument("--runs", type=int, default=2000, help="har bir o'lcham uchun render'lar soni")
+    p.set_defaults(func=cmd_welcome)
+
+    p = sub.add_parser("warnings", help="ogohlantirishlarning xotiradagi hajmi: dict va jadval")
+    p.add_argument("--count", type=int, default=1000000, help="ogohlantirishlar soni")
+    p.add_argument("--chats", type=int, default=5000, help="chatlar soni")
+    p.set_defaults(func=cmd_warnings)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
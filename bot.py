@@ -1,12 +1,36 @@
+import html
 import logging
-from telegram import Update, ChatPermissions
+import httpx
+from telegram import Update, ChatPermissions, MessageEntity, User
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
-from datetime import datetime, timedelta, timezone
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import (
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, ChatMemberHandler, TypeHandler,
+    ContextTypes, filters
+)
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+import bisect
+import cProfile
+import functools
+import glob
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import os
 import asyncio
+import pstats
 import re
+import shutil
+import signal
+import sys
+import threading
+import time
 
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
 logging.basicConfig(
@@ -16,65 +40,2602 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== ПУТИ К ФАЙЛАМ ДАННЫХ ====================
-DATA_DIR = "bot_data"
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "bot_data")
 os.makedirs(DATA_DIR, exist_ok=True)
-bot_owner_id = 7294324265
+# Общая папка всех воркеров при шардировании (её передаёт приёмник, см. ШАРДИРОВАНИЕ)
+SHARED_DATA_DIR = os.environ.get("BOT_SHARED_DATA_DIR")
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "8312081729:AAH9IZR1dF_QLA4WamD6Wwd36v-ZE7XN_o0")
+# Адрес своего Bot API сервера (по умолчанию — api.telegram.org)
+BOT_API_URL = os.environ.get("BOT_API_URL")
+# Данные чатов — по файлу на чат (CHATS_DIR/<chat_id>.json), читаются при первом обращении
+CHATS_DIR = f"{DATA_DIR}/chats"
+SUMMARY_FILE = f"{DATA_DIR}/summary.json"
+# Прежние общие файлы данных чатов: переводятся в CHATS_DIR при первом запуске
 WARNINGS_FILE = f"{DATA_DIR}/warnings.json"
 WELCOME_FILE = f"{DATA_DIR}/welcome.json"
 RULES_FILE = f"{DATA_DIR}/rules.json"
-SUPERADMINS_FILE = f"{DATA_DIR}/superadmins.json"
 ADMINS_FILE = f"{DATA_DIR}/admins.json"
+KEYWORDS_FILE = f"{DATA_DIR}/keywords.json"
+SUPERADMINS_FILE = f"{DATA_DIR}/superadmins.json"
+SCHEDULE_FILE = f"{DATA_DIR}/schedule.json"
 STATS_FILE = f"{DATA_DIR}/stats.json"
+STATS_LOG_FILE = f"{DATA_DIR}/stats.log"
+SQLITE_FILE = f"{DATA_DIR}/bot.db"
+# Индекс username общий для всех воркеров: пользователь мог писать в чат другого шарда
+USERNAMES_FILE = f"{SHARED_DATA_DIR or DATA_DIR}/usernames.log"
+AUDIT_DIR = f"{DATA_DIR}/audit"
+
+# Хранилище данных: "json" (файлы выше) или "sqlite" (SQLITE_FILE)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+
+# Сколько записей может накопиться в stats.log до сжатия в stats.json
+STATS_COMPACT_EVERY = 5000
+# Окно (сек), в котором повторные сохранения одного файла склеиваются в одну запись
+SAVE_DELAY = float(os.environ.get("SAVE_DELAY", "2"))
+# Сколько username -> user_id держать в памяти
+USERNAME_INDEX_SIZE = 200000
+# Кэш администраторов чатов: время жизни записи (сек) и максимум чатов в памяти
+ADMIN_CACHE_TTL = 300
+ADMIN_CACHE_SIZE = 5000
+# Индекс ролей: чатов в памяти и как часто (сек) сверять админов с Telegram в фоне;
+# в чатах, где за последние ROLE_RESYNC сек была модерация, — раз в ROLE_RESYNC_ACTIVE
+ROLE_INDEX_CHATS = 100000
+ROLE_RESYNC = 3600
+ROLE_RESYNC_ACTIVE = 300
+# Лимиты на ключевые слова одного чата
+MAX_KEYWORDS_PER_CHAT = 500
+MAX_KEYWORD_LENGTH = 64
+# @admins: как часто можно звать админов в одном чате и одному пользователю (сек)
+SUMMON_CHAT_COOLDOWN = 60
+SUMMON_USER_COOLDOWN = 300
+# /admin, /unadmin: сколько ждать подтверждения нового статуса (сек)
+# и через сколько впервые проверить его запросом, если событие не пришло
+CONFIRM_TIMEOUT = 6.0
+CONFIRM_FIRST_CHECK = 0.5
+# Исходящие сообщения (лимиты Telegram): всего в секунду,
+# в группу — 20 в минуту с небольшим запасом на всплеск, в личку — 1 в секунду
+GLOBAL_SEND_RATE = 30
+GROUP_SEND_RATE = 20 / 60
+GROUP_SEND_BURST = 3
+PRIVATE_SEND_RATE = 1
+SEND_MAX_RETRIES = 3
+# Очередь чата: не больше OUTBOX_CHAT_LIMIT сообщений (сверх — выбрасываются самые старые
+# PRIORITY_LOW), и PRIORITY_LOW старше OUTBOX_LOW_MAX_AGE сек уже не отправляется
+OUTBOX_CHAT_LIMIT = 50
+OUTBOX_LOW_MAX_AGE = 120
+# Приветствия: вступления за это окно (сек) склеиваются в одно сообщение;
+# предыдущее приветствие удаляется, чтобы не засорять чат
+WELCOME_BATCH_WINDOW = 3.0
+WELCOME_DELETE_PREVIOUS = True
+MAX_MESSAGE_LENGTH = 4096
+TEMPLATE_CACHE_SIZE = 10000
+TEMPLATE_CHUNK = 32
+# Шаблон принимается, только если и в худшем случае влезает в сообщение: подстановки —
+# название чата (до 128 символов, после html.escape — до 6 на символ), число, время;
+# на список участников — место под «va yana N kishi». Запас — под заголовок ответа
+TEMPLATE_VALUE_MAX = {"chat": 128 * 6, "count": 10, "time": 5}
+TEMPLATE_LIST_RESERVE = len(" va yana 1000000 kishi")
+TEMPLATE_HEADER_RESERVE = 100
+# Анти-флуд: не больше FLOOD_USER_LIMIT сообщений пользователя за FLOOD_USER_WINDOW сек;
+# больше FLOOD_CHAT_LIMIT сообщений в чате за FLOOD_CHAT_WINDOW сек — рейд, и на
+# RAID_DURATION сек лимит пользователя уменьшается вдвое. Нарушитель получает mute.
+FLOOD_USER_LIMIT = 6
+FLOOD_USER_WINDOW = 5.0
+FLOOD_CHAT_LIMIT = 60
+FLOOD_CHAT_WINDOW = 5.0
+RAID_DURATION = 300
+FLOOD_MUTE_SECONDS = 600
+FLOOD_MAX_TRACKED = 100000
+# Анти-спам: одинаковый или похожий (MinHash, сходство не ниже SPAM_SIMILARITY) текст
+# за SPAM_WINDOW сек — повтор. Спам — SPAM_CHAT_REPEATS повторов в одном чате или текст
+# в SPAM_GLOBAL_CHATS разных чатах. SPAM_ACTION: delete (удалить) или flag (только в лог)
+SPAM_WINDOW = 600
+SPAM_CHAT_REPEATS = 3
+SPAM_GLOBAL_CHATS = 3
+SPAM_MIN_LENGTH = 24
+SPAM_MIN_WORDS = 5
+SPAM_MINHASH_BINS = 12
+SPAM_MINHASH_BAND = 3
+SPAM_SIMILARITY = 0.6
+SPAM_BAND_SCAN = 16
+SPAM_MAX_TRACKED = 50000
+SPAM_ACTION = os.environ.get("SPAM_ACTION", "delete")
+# Массовая модерация: целей за команду, параллельных запросов к API;
+# вступления запоминаются на RECENT_JOINS_WINDOW сек в RECENT_JOINS_CHATS чатах
+BULK_MAX_TARGETS = 500
+BULK_CONCURRENCY = 10
+RECENT_JOINS_WINDOW = 24 * 3600
+RECENT_JOINS_CHATS = 5000
+# Через сколько дней ogohlantirish истекает сам (0 — никогда)
+WARN_EXPIRE_DAYS = int(os.environ.get("WARN_EXPIRE_DAYS", "30"))
+# Журнал модерации: размер сегмента, сколько последних сегментов держать
+# несжатыми (доступными для /history) и ограничения записи
+AUDIT_SEGMENT_SIZE = int(os.environ.get("AUDIT_SEGMENT_SIZE", str(8 * 1024 * 1024)))
+AUDIT_OPEN_SEGMENTS = 2
+AUDIT_DETAIL_LIMIT = 200
+AUDIT_RECORD_LIMIT = 1024
+AUDIT_HISTORY_DEFAULT = 10
+AUDIT_HISTORY_MAX = 50
+
+# ==================== WEBHOOK ====================
+# Если задан WEBHOOK_URL (публичный адрес reverse proxy), бот принимает обновления
+# через webhook на WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH вместо long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# Путь к файлу, куда записываются все входящие обновления (для bench.py replay)
+RECORD_UPDATES_FILE = os.environ.get("RECORD_UPDATES_FILE")
+# Метрики в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (без порта — выключено)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Профилирование первых PROFILE_SECONDS сек после запуска (0 — выключено; в работе — /profile)
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", "0"))
+PROFILE_MAX_SECONDS = 3600
+# Шардирование: при BOT_SHARDS > 1 процесс-приёмник забирает обновления и раздаёт их
+# воркерам по chat_id % BOT_SHARDS через unix-сокеты; данные воркера K — в DATA_DIR/shard-K.
+# BOT_SHARD_SOCKET и BOT_SHARED_DATA_DIR воркеру передаёт приёмник
+SHARDS = int(os.environ.get("BOT_SHARDS", "1"))
+SHARD_SOCKET = os.environ.get("BOT_SHARD_SOCKET")
+OWNER_FILE = f"{SHARED_DATA_DIR or DATA_DIR}/owner"
+SHARD_POLL_TIMEOUT = 10
+SHARD_START_TIMEOUT = 60
+SHARD_LINE_LIMIT = 4 * 1024 * 1024
+# Последний подтверждённый приёмником offset getUpdates — с него продолжаем после перезапуска
+SHARD_OFFSET_FILE = f"{DATA_DIR}/ingress_offset"
+# Сбросить накопившиеся обновления при запуске приёмника (по умолчанию — дообработать)
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"
+
+# ==================== МЕТРИКИ ====================
+class Histogram:
+    """Гистограмма в стиле Prometheus: счётчики по корзинам METRIC_BUCKETS, сумма и число"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Метрики бота в памяти: запись — пара операций со списком и числом,
+    текст для /metrics собирается только по запросу.
+    """
+
+    def __init__(self):
+        self.handler_seconds = defaultdict(Histogram)  # обработчик -> время
+        self.api_seconds = defaultdict(Histogram)  # метод Bot API -> время ответа
+        self.api_calls = Counter()
+        self.api_errors = Counter()
+        self.save_seconds = defaultdict(Histogram)  # файл -> время записи
+        self.bytes_written = Counter()  # файл или каталог в DATA_DIR -> записано байт
+        self.update_lag = Histogram()  # от отправки сообщения до начала обработки
+        self.outbox_dropped = Counter()  # причина -> выброшено исходящих сообщений
+
+    def wrote(self, file_path: str, size: int):
+        # Файлы чатов и сегменты журнала — одной меткой по каталогу
+        self.bytes_written[os.path.relpath(file_path, DATA_DIR).split(os.sep)[0]] += size
+
+    @staticmethod
+    def _histogram_lines(name: str, label: str, histograms: dict) -> list:
+        lines = [f"# TYPE {name} histogram"]
+        for key, histogram in sorted(histograms.items()):
+            labels = f'{label}="{key}",' if label else ""
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {histogram.count}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{name}_sum{suffix} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{suffix} {histogram.count}")
+        return lines
+
+    def render(self, gauges: dict) -> str:
+        """Текстовый формат Prometheus"""
+        lines = self._histogram_lines("bot_handler_seconds", "handler", self.handler_seconds)
+        lines += self._histogram_lines("bot_api_request_seconds", "method", self.api_seconds)
+        lines += self._histogram_lines("bot_save_seconds", "file", self.save_seconds)
+        lines += self._histogram_lines("bot_update_lag_seconds", "", {"": self.update_lag})
+        for name, label, counter in (("bot_api_calls_total", "method", self.api_calls),
+                                     ("bot_api_errors_total", "method", self.api_errors),
+                                     ("bot_bytes_written_total", "file", self.bytes_written),
+                                     ("bot_outbox_dropped_total", "reason", self.outbox_dropped)):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f'{name}{{{label}="{key}"}} {count}' for key, count in sorted(counter.items()))
+        for name, value in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MetricsRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы, ошибки и время ответа по методам Bot API"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            metrics.api_errors[api_method] += 1
+            raise
+        finally:
+            metrics.api_calls[api_method] += 1
+            metrics.api_seconds[api_method].observe(time.perf_counter() - started)
+        if code >= 400:
+            metrics.api_errors[api_method] += 1
+        if api_method in MODERATION_METHODS and request_data is not None:
+            track_moderation(request_data.parameters, code, payload)
+        return code, payload
+
+
+def timed(callback):
+    """Обёртка обработчика, записывающая время его выполнения"""
+    histogram = metrics.handler_seconds[callback.__name__]
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    return wrapper
+
+
+class MetricsServer:
+    """Минимальный HTTP-сервер: GET /metrics отдаёт метрики в текстовом виде"""
+
+    def __init__(self):
+        self._server = None
+        self._application = None
+
+    async def start(self, application: Application, host: str, port: int):
+        self._application = application
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Метрики: http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def gauges(self) -> dict:
+        return {
+            "bot_update_queue_size": self._application.update_queue.qsize(),
+            "bot_outbox_depth": outbox.depth(),
+            "bot_scheduled_actions": len(scheduler),
+        }
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render(self.gauges()).encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Ошибка в /metrics: {e}")
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer()
+
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+class Profiler:
+    """
+    Профилирование работающего бота на заданное окно: cProfile включается в потоке
+    event loop (обработчики, статистика, проверки прав), а записи файлов в executor
+    профилируются отдельно и добавляются в тот же .prof при остановке.
+    """
+
+    def __init__(self):
+        self._profile = None
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._notify = None
+        self.started = None
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None
+
+    def start(self, seconds: float, notify=None):
+        """notify(path, summary) вызывается после записи результата"""
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._notify = notify
+        self.started = time.monotonic()
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        self._profile.enable()
+        logger.info(f"Профилирование включено на {seconds:.0f} сек")
+
+    def run_in_thread(self, func, *args):
+        """Для executor: до Python 3.12 cProfile видит только тот поток, где включён"""
+        if not self.active or sys.version_info >= (3, 12):
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            with self._lock:
+                self._thread_profiles.append(profile)
+
+    def stop(self):
+        if not self.active:
+            return None
+        self._profile.disable()
+        self._timer.cancel()
+        stats = pstats.Stats(self._profile)
+        with self._lock:
+            for profile in self._thread_profiles:
+                stats.add(profile)
+            self._thread_profiles = []
+        self._profile = None
+        path = f"{DATA_DIR}/profile-{datetime.now():%Y%m%d-%H%M%S}.prof"
+        try:
+            stats.dump_stats(path)
+        except Exception as e:
+            logger.error(f"Ошибка записи {path}: {e}")
+            return None
+        logger.info(f"Профиль записан в {path}")
+        if self._notify:
+            self._notify(path, self.summary(stats))
+            self._notify = None
+        return path
+
+    @staticmethod
+    def summary(stats: pstats.Stats, limit: int = 10) -> str:
+        """Самые дорогие функции по собственному времени"""
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        return "\n".join(
+            f"{tottime:8.3f}s {calls:>8} {os.path.basename(file)}:{line}({name})"
+            for (file, line, name), (_, calls, tottime, _, _) in rows
+        )
+
+
+profiler = Profiler()
+
+
+# ==================== СТАТИСТИКА ====================
+class StatsStore:
+    """
+    Статистика чатов и пользователей.
+    В памяти — множества (проверка за O(1)), на диске — снимок stats.json
+    плюс append-only лог stats.log, который периодически сжимается в снимок.
+    """
+
+    def __init__(self, snapshot_path: str, log_path: str, compact_every: int = STATS_COMPACT_EVERY):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.chats = set()
+        self.users = set()
+        self._log = None
+        self._log_entries = 0
+        self._compacting = False
+
+    def load(self):
+        """Загрузка снимка и проигрывание лога поверх него"""
+        replayed = self.read()
+        if replayed or not os.path.exists(self.snapshot_path):
+            self.compact()
+        else:
+            self._open_log('a')
+
+    def read(self) -> int:
+        """Только чтение снимка и лога, без сжатия; возвращает число записей лога"""
+        self.chats.clear()
+        self.users.clear()
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                self.chats.update(int(x) for x in loaded.get("chats", []))
+                self.users.update(int(x) for x in loaded.get("users", []))
+                logger.info(f"Успешно загружено из {self.snapshot_path}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {self.snapshot_path}: {e}")
+
+        replayed = 0
+        # .old — лог, снимок которого не успел записаться до остановки
+        for path in (self.log_path + ".old", self.log_path):
+            try:
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            kind, _, value = line.strip().partition(" ")
+                            # Последняя строка могла быть записана не полностью
+                            if not value.lstrip('-').isdigit():
+                                continue
+                            if kind == "c":
+                                self.chats.add(int(value))
+                            elif kind == "u":
+                                self.users.add(int(value))
+                            replayed += 1
+            except Exception as e:
+                logger.error(f"Ошибка чтения {path}: {e}")
+        return replayed
+
+    def _open_log(self, mode: str):
+        if self._log:
+            self._log.close()
+        self._log = open(self.log_path, mode, encoding='utf-8')
+        self._log_entries = 0
+
+    def _append(self, kind: str, value: int):
+        try:
+            if self._log is None:
+                self._open_log('a')
+            line = f"{kind} {value}\n"
+            self._log.write(line)
+            self._log.flush()
+            metrics.wrote(self.log_path, len(line))
+            self._log_entries += 1
+        except Exception as e:
+            logger.error(f"Ошибка записи в {self.log_path}: {e}")
+            return
+        if self._log_entries >= self.compact_every:
+            self.compact()
+
+    def add_chat(self, chat_id: int) -> bool:
+        if chat_id in self.chats:
+            return False
+        self.chats.add(chat_id)
+        self._append("c", chat_id)
+        return True
+
+    def add_user(self, user_id: int) -> bool:
+        if user_id in self.users:
+            return False
+        self.users.add(user_id)
+        self._append("u", user_id)
+        return True
+
+    def compact(self):
+        """
+        Сжатие лога: текущий stats.log откладывается в stats.log.old,
+        снимок пишется в stats.json (внутри event loop — через executor),
+        и только после успешной записи stats.log.old удаляется.
+        """
+        if self._compacting:
+            return
+        snapshot = {"chats": list(self.chats), "users": list(self.users)}
+        old_path = self.log_path + ".old"
+        if self._log:
+            self._log.close()
+            self._log = None
+        try:
+            if os.path.exists(self.log_path):
+                if os.path.exists(old_path):
+                    # Прошлый снимок не записался — дописываем, а не затираем
+                    with open(self.log_path, 'r', encoding='utf-8') as src, \
+                            open(old_path, 'a', encoding='utf-8') as dst:
+                        dst.write(src.read())
+                    os.remove(self.log_path)
+                else:
+                    os.replace(self.log_path, old_path)
+        except Exception as e:
+            logger.error(f"Ошибка ротации {self.log_path}: {e}")
+        self._open_log('a')
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_snapshot(snapshot)
+            return
+        self._compacting = True
+        future = loop.run_in_executor(None, profiler.run_in_thread, self._write_snapshot, snapshot)
+        future.add_done_callback(lambda _: setattr(self, '_compacting', False))
+
+    def _write_snapshot(self, snapshot: dict):
+        if save_data(self.snapshot_path, snapshot, indent=None):
+            try:
+                os.remove(self.log_path + ".old")
+            except FileNotFoundError:
+                pass
 
-# ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ДАННЫХ ====================
-warnings_data = {}
-welcome_data = {}
-rules_data = {}
-superadmins_data = {"owner": None}
-admins_data = {}
-stats_data = {"chats": [], "users": []}
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
 
 
 # ==================== ЗАГРУЗКА ДАННЫХ ====================
 def load_data():
-    """Загрузка всех данных из JSON-файлов"""
-    global warnings_data, welcome_data, rules_data, superadmins_data, admins_data, stats_data
-    files_to_load = [
-        (WARNINGS_FILE, warnings_data, {}),
-        (WELCOME_FILE, welcome_data, {}),
-        (RULES_FILE, rules_data, {}),
-        (SUPERADMINS_FILE, superadmins_data, {"owner": None}),
-        (ADMINS_FILE, admins_data, {}),
-        (STATS_FILE, stats_data, {"chats": [], "users": []})
-    ]
-    for file_path, var_ref, default in files_to_load:
+    """Загрузка всех данных из выбранного хранилища"""
+    storage.load()
+    username_index.load()
+    audit_log.load()
+    scheduler.load()
+
+
+def json_default(value):
+    """Компактные структуры в памяти (WarningTable) сериализуются своим to_json"""
+    if hasattr(value, "to_json"):
+        return value.to_json()
+    raise TypeError(f"{type(value).__name__} JSON'ga o'tkazilmaydi")
+
+
+def save_data(file_path: str, data, indent=2) -> bool:
+    """Сохранение данных в JSON-файл (блокирующее — только вне event loop)"""
+    try:
+        write_file(file_path, json.dumps(data, ensure_ascii=False, indent=indent, default=json_default))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения в {file_path}: {e}")
+        return False
+
+
+def write_file(file_path: str, text: str):
+    """Атомарная запись уже сериализованного текста через временный файл"""
+    started = time.perf_counter()
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        size = f.tell()
+    os.replace(temp_path, file_path)
+    metrics.wrote(file_path, size)
+    metrics.save_seconds[os.path.basename(file_path)].observe(time.perf_counter() - started)
+    logger.info(f"Данные успешно сохранены в {file_path}")
+
+
+# ==================== ОТЛОЖЕННОЕ СОХРАНЕНИЕ ====================
+class WriteBehind:
+    """
+    Write-behind сохранение JSON-файлов.
+    Обработчики только помечают файл «грязным»; все пометки в течение
+    SAVE_DELAY секунд склеиваются в одну запись, которая выполняется в executor.
+    """
+
+    def __init__(self, delay: float = SAVE_DELAY):
+        self.delay = delay
+        self._sources = {}
+        self._dirty = set()
+        self._task = None
+        self._lock = None
+
+    def register(self, file_path: str, data):
+        self._sources[file_path] = data
+
+    def mark_dirty(self, file_path: str):
+        self._dirty.add(file_path)
         try:
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    loaded = json.load(f)
-                    if isinstance(var_ref, dict):
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (запуск/остановка) — пишем сразу
+            self.flush_sync()
+            return
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.delay)
+        await self.flush()
+
+    def _take_snapshots(self):
+        # Сериализация в event loop: словари не меняются во время json.dumps
+        paths, self._dirty = self._dirty, set()
+        snapshots = []
+        for path in paths:
+            try:
+                snapshots.append((path, json.dumps(self._sources[path], ensure_ascii=False, indent=2,
+                                                   default=json_default)))
+            except Exception as e:
+                logger.error(f"Ошибка сериализации {path}: {e}")
+        return snapshots
+
+    @staticmethod
+    def _write_snapshots(snapshots):
+        failed = []
+        for path, text in snapshots:
+            try:
+                write_file(path, text)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения в {path}: {e}")
+                failed.append(path)
+        return failed
+
+    async def flush(self):
+        """Запись всех грязных файлов в executor"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while self._dirty:
+                snapshots = self._take_snapshots()
+                failed = await asyncio.get_running_loop().run_in_executor(
+                    None, profiler.run_in_thread, self._write_snapshots, snapshots
+                )
+                if failed:
+                    # Повторим при следующей пометке или при остановке
+                    self._dirty.update(failed)
+                    break
+
+    def flush_sync(self):
+        """Синхронная запись (используется вне event loop)"""
+        if self._dirty:
+            failed = self._write_snapshots(self._take_snapshots())
+            self._dirty.update(failed)
+
+
+# ==================== ХРАНИЛИЩЕ ====================
+def warning_time(value) -> float:
+    """Время выдачи ogohlantirish в epoch; до перехода на epoch оно хранилось ISO-строкой"""
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return 0.0
+    return float(value or 0)
+
+
+def warning_date(issued: float) -> str:
+    """ISO-строка для колонки date в SQLite (warning_time — обратное преобразование)"""
+    return datetime.fromtimestamp(issued).isoformat()
+
+
+class WarningRecord:
+    """Одно ogohlantirish — только для чтения, собирается из WarningTable по запросу"""
+
+    __slots__ = ("reason", "issued", "by")
+
+    def __init__(self, reason: str, issued: float, by: int):
+        self.reason = reason
+        self.issued = issued
+        self.by = by
+
+
+class WarningTable:
+    """
+    Ogohlantirishlar чата — параллельные массивы, отсортированные по user_id:
+    user_id, время (epoch) и автор — в array, причина — ссылка на интернированную
+    строку. ~32 байта на запись вместо словаря со строковыми датой и ключами;
+    записи пользователя — срез, который находится бинарным поиском.
+    """
+
+    __slots__ = ("users", "issued", "by", "reasons")
+
+    def __init__(self):
+        self.users = array('q')
+        self.issued = array('d')
+        self.by = array('q')
+        self.reasons = []
+
+    def __len__(self):
+        return len(self.users)
+
+    def _range(self, user_id: int):
+        lo = bisect.bisect_left(self.users, user_id)
+        hi = lo
+        while hi < len(self.users) and self.users[hi] == user_id:
+            hi += 1
+        return lo, hi
+
+    def get(self, user_id: int) -> list:
+        lo, hi = self._range(user_id)
+        return [WarningRecord(self.reasons[i], self.issued[i], self.by[i]) for i in range(lo, hi)]
+
+    def add(self, user_id: int, reason: str, issued: float, by: int) -> int:
+        """Returns: сколько теперь ogohlantirish у пользователя"""
+        lo, hi = self._range(user_id)
+        self.users.insert(hi, user_id)
+        self.issued.insert(hi, issued)
+        self.by.insert(hi, by or 0)
+        self.reasons.insert(hi, sys.intern(reason))
+        return hi - lo + 1
+
+    def clear(self, user_id: int) -> int:
+        lo, hi = self._range(user_id)
+        for column in (self.users, self.issued, self.by, self.reasons):
+            del column[lo:hi]
+        return hi - lo
+
+    def remove(self, user_id: int, issued: float):
+        """Удалить одно по времени выдачи. Returns: (удалено ли, сколько осталось у пользователя)"""
+        lo, hi = self._range(user_id)
+        for i in range(lo, hi):
+            if self.issued[i] == issued:
+                for column in (self.users, self.issued, self.by, self.reasons):
+                    del column[i]
+                return True, hi - lo - 1
+        return False, hi - lo
+
+    def __iter__(self):
+        """(user_id, время выдачи) всех записей"""
+        return zip(self.users, self.issued)
+
+    def warned_users(self) -> int:
+        return sum(1 for i in range(len(self.users)) if i == 0 or self.users[i] != self.users[i - 1])
+
+    def to_json(self) -> dict:
+        data = {}
+        for i, user_id in enumerate(self.users):
+            data.setdefault(str(user_id), []).append([self.reasons[i], self.issued[i], self.by[i]])
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "WarningTable":
+        """{user_id: [[причина, время, автор], ...]} или прежний формат [{reason, date, by}, ...]"""
+        table = cls()
+        for user_id in sorted(data, key=int):
+            for item in data[user_id]:
+                if isinstance(item, dict):
+                    item = (item.get("reason", ""), warning_time(item.get("date", "")), item.get("by"))
+                reason, issued, by = item
+                table.users.append(int(user_id))
+                table.issued.append(issued)
+                table.by.append(by or 0)
+                table.reasons.append(sys.intern(reason))
+        return table
+
+
+class ChatStore:
+    """
+    Данные чатов (ogohlantirishlar, приветствие, правила, bot-админы, kalit so'zlar):
+    файл на чат в CHATS_DIR, который читается при первом обращении к чату.
+    Запуск не зависит от числа чатов; прочитанные чаты остаются в памяти.
+    """
+
+    def __init__(self, directory: str, write_behind: WriteBehind):
+        self.directory = directory
+        self.write_behind = write_behind
+        self._chats = {}
+
+    def path(self, chat_id) -> str:
+        return f"{self.directory}/{chat_id}.json"
+
+    def get(self, chat_id) -> dict:
+        key = str(chat_id)
+        chat = self._chats.get(key)
+        if chat is None:
+            # Чата без файла тоже запоминаем — второй раз на диск не пойдём
+            chat = self._chats[key] = self._read(key)
+        return chat
+
+    def _read(self, chat_id: str) -> dict:
+        path = self.path(chat_id)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                loaded = json.load(f)
+            if not isinstance(loaded, dict):
+                return {}
+            if "warnings" in loaded:
+                loaded["warnings"] = WarningTable.from_json(loaded["warnings"])
+            return loaded
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Ошибка загрузки {path}: {e}")
+            return {}
+
+    def mark_dirty(self, chat_id):
+        path = self.path(chat_id)
+        self.write_behind.register(path, self._chats[str(chat_id)])
+        self.write_behind.mark_dirty(path)
+
+    def chat_ids(self) -> list:
+        """Все чаты на диске и в памяти (полный обход — только для миграций и редких задач)"""
+        ids = set(self._chats)
+        if os.path.isdir(self.directory):
+            ids.update(name[:-len(".json")] for name in os.listdir(self.directory) if name.endswith(".json"))
+        return [int(chat_id) for chat_id in ids]
+
+    def __len__(self):
+        return len(self._chats)
+
+
+class JsonStorage:
+    """
+    Хранилище в JSON-файлах: данные чатов — в ChatStore (файл на чат, загрузка
+    по требованию), общие данные — целиком в памяти. Изменённые файлы
+    записываются целиком через WriteBehind, статистика — через StatsStore.
+    """
+
+    name = "json"
+
+    def __init__(self):
+        self.write_behind = WriteBehind()
+        self.chats = ChatStore(CHATS_DIR, self.write_behind)
+        self.superadmins = {"owner": None}
+        # Отложенные действия: id -> [срок, вид, chat_id, user_id, данные]
+        self.schedule = {"next_id": 1, "backfilled": False, "entries": {}}
+        # Число пользователей с ogohlantirish — чтобы не читать ради него все чаты
+        self.summary = {"warned_users": 0}
+        self.stats = StatsStore(STATS_FILE, STATS_LOG_FILE)
+
+    def load(self):
+        """Загрузка общих данных; данные чатов читаются при первом обращении"""
+        files_to_load = [
+            (SUPERADMINS_FILE, self.superadmins, {"owner": None}),
+            (SCHEDULE_FILE, self.schedule, {"next_id": 1, "backfilled": False, "entries": {}}),
+            (SUMMARY_FILE, self.summary, {"warned_users": 0})
+        ]
+        for file_path, var_ref, default in files_to_load:
+            self.write_behind.register(file_path, var_ref)
+            try:
+                if os.path.exists(file_path):
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        loaded = json.load(f)
                         var_ref.clear()
                         var_ref.update(loaded if isinstance(loaded, dict) else default)
-                    logger.info(f"Успешно загружено из {file_path}")
+                        logger.info(f"Успешно загружено из {file_path}")
+                else:
+                    save_data(file_path, default)
+                    logger.info(f"Создан новый файл {file_path}")
+            except Exception as e:
+                logger.error(f"Ошибка загрузки {file_path}: {e}")
+                var_ref.clear()
+                var_ref.update(default)
+        os.makedirs(CHATS_DIR, exist_ok=True)
+        self.migrate_chat_files()
+        self.stats.load()
+
+    def migrate_chat_files(self):
+        """
+        Однократный перевод общих warnings.json, welcome.json, rules.json,
+        admins.json и keywords.json в файлы чатов; прежний файл
+        переименовывается в *.migrated.
+        """
+        sections = ((WARNINGS_FILE, "warnings"), (WELCOME_FILE, "welcome"), (RULES_FILE, "rules"),
+                    (ADMINS_FILE, "admins"), (KEYWORDS_FILE, "keywords"))
+        migrated = []
+        for file_path, section in sections:
+            if not os.path.exists(file_path):
+                continue
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+            except Exception as e:
+                logger.error(f"Ошибка загрузки {file_path}: {e}")
+                continue
+            for chat_id, value in (loaded if isinstance(loaded, dict) else {}).items():
+                if section == "warnings":
+                    value = WarningTable.from_json(value)
+                self.chats.get(chat_id)[section] = value
+            migrated.append(file_path)
+        if not migrated:
+            return
+        for chat_id in self.chats.chat_ids():
+            self.chats.mark_dirty(chat_id)
+        self.summary["warned_users"] = sum(
+            self.chats.get(chat_id)["warnings"].warned_users()
+            for chat_id in self.chats.chat_ids() if "warnings" in self.chats.get(chat_id)
+        )
+        self.write_behind.mark_dirty(SUMMARY_FILE)
+        for file_path in migrated:
+            os.replace(file_path, file_path + ".migrated")
+        logger.info(f"Данные {len(self.chats)} чатов перенесены в {CHATS_DIR}")
+
+    async def flush(self):
+        await self.write_behind.flush()
+
+    def close(self):
+        self.write_behind.flush_sync()
+        self.stats.compact()
+        self.stats.close()
+
+    def _count_warned(self, delta: int):
+        self.summary["warned_users"] += delta
+        self.write_behind.mark_dirty(SUMMARY_FILE)
+
+    # --- ogohlantirishlar ---
+    def get_warnings(self, chat_id: int, user_id: int) -> list:
+        table = self.chats.get(chat_id).get("warnings")
+        return table.get(user_id) if table else []
+
+    def add_warning(self, chat_id: int, user_id: int, reason: str, issued: float, by: int) -> int:
+        chat = self.chats.get(chat_id)
+        table = chat.get("warnings")
+        if table is None:
+            table = chat["warnings"] = WarningTable()
+        count = table.add(user_id, reason, issued, by)
+        if count == 1:
+            self._count_warned(1)
+        self.chats.mark_dirty(chat_id)
+        return count
+
+    def _drop_empty_warnings(self, chat_id: int):
+        chat = self.chats.get(chat_id)
+        if not chat["warnings"]:
+            del chat["warnings"]
+        self.chats.mark_dirty(chat_id)
+
+    def clear_warnings(self, chat_id: int, user_id: int) -> int:
+        table = self.chats.get(chat_id).get("warnings")
+        removed = table.clear(user_id) if table else 0
+        if removed:
+            self._count_warned(-1)
+            self._drop_empty_warnings(chat_id)
+        return removed
+
+    def remove_warning(self, chat_id: int, user_id: int, issued: float) -> bool:
+        """Удалить одно ogohlantirish по времени выдачи (истечение срока)"""
+        table = self.chats.get(chat_id).get("warnings")
+        if not table:
+            return False
+        removed, left = table.remove(user_id, issued)
+        if removed:
+            if not left:
+                self._count_warned(-1)
+            self._drop_empty_warnings(chat_id)
+        return removed
+
+    def iter_warnings(self):
+        for chat_id in self.chats.chat_ids():
+            for user_id, issued in self.chats.get(chat_id).get("warnings", ()):
+                yield chat_id, user_id, issued
+
+    def count_warnings(self) -> int:
+        # Число пользователей с ogohlantirish; счётчик ведётся при изменениях
+        return self.summary["warned_users"]
+
+    # --- matnlar ---
+    def get_welcome(self, chat_id: int):
+        return self.chats.get(chat_id).get("welcome")
+
+    def set_welcome(self, chat_id: int, text: str):
+        self.chats.get(chat_id)["welcome"] = text
+        self.chats.mark_dirty(chat_id)
+
+    def get_rules(self, chat_id: int):
+        return self.chats.get(chat_id).get("rules")
+
+    def set_rules(self, chat_id: int, text: str):
+        self.chats.get(chat_id)["rules"] = text
+        self.chats.mark_dirty(chat_id)
+
+    # --- egasi va adminlar ---
+    def get_owner(self):
+        return self.superadmins.get("owner")
+
+    def set_owner(self, user_id: int):
+        self.superadmins["owner"] = user_id
+        self.write_behind.mark_dirty(SUPERADMINS_FILE)
+
+    def get_bot_admins(self, chat_id: int) -> list:
+        return self.chats.get(chat_id).get("admins", [])
+
+    # --- kalit so'zlar ---
+    def get_keywords(self, chat_id: int) -> dict:
+        return self.chats.get(chat_id).get("keywords", {})
+
+    def set_keyword(self, chat_id: int, keyword: str, reply: str):
+        self.chats.get(chat_id).setdefault("keywords", {})[keyword] = reply
+        self.chats.mark_dirty(chat_id)
+
+    def delete_keyword(self, chat_id: int, keyword: str) -> bool:
+        chat = self.chats.get(chat_id)
+        chat_keywords = chat.get("keywords", {})
+        if keyword not in chat_keywords:
+            return False
+        del chat_keywords[keyword]
+        if not chat_keywords:
+            del chat["keywords"]
+        self.chats.mark_dirty(chat_id)
+        return True
+
+    # --- rejalashtirilgan amallar ---
+    def get_schedule(self) -> list:
+        return [(due, int(entry_id), kind, chat_id, user_id, data)
+                for entry_id, (due, kind, chat_id, user_id, data) in self.schedule["entries"].items()]
+
+    def add_schedule(self, due: float, kind: str, chat_id: int, user_id: int, data=None) -> int:
+        entry_id = self.schedule["next_id"]
+        self.schedule["next_id"] += 1
+        self.schedule["entries"][str(entry_id)] = [due, kind, chat_id, user_id, data]
+        self.write_behind.mark_dirty(SCHEDULE_FILE)
+        return entry_id
+
+    def remove_schedule(self, entry_id: int):
+        if self.schedule["entries"].pop(str(entry_id), None) is not None:
+            self.write_behind.mark_dirty(SCHEDULE_FILE)
+
+    def is_schedule_backfilled(self) -> bool:
+        return self.schedule.get("backfilled", False)
+
+    def mark_schedule_backfilled(self):
+        self.schedule["backfilled"] = True
+        self.write_behind.mark_dirty(SCHEDULE_FILE)
+
+    # --- statistika ---
+    def add_chat(self, chat_id: int):
+        self.stats.add_chat(chat_id)
+
+    def add_user(self, user_id: int):
+        self.stats.add_user(user_id)
+
+    def count_chats(self) -> int:
+        return len(self.stats.chats)
+
+    def count_users(self) -> int:
+        return len(self.stats.users)
+
+    @staticmethod
+    def read_stats(data_dir: str) -> tuple:
+        """(число чатов, множество user_id, число ogohlantirilgan) из файлов data_dir другого процесса"""
+        stats = StatsStore(f"{data_dir}/{os.path.basename(STATS_FILE)}", f"{data_dir}/{os.path.basename(STATS_LOG_FILE)}")
+        stats.read()
+        warned = 0
+        try:
+            with open(f"{data_dir}/{os.path.basename(SUMMARY_FILE)}", 'r', encoding='utf-8') as f:
+                warned = json.load(f).get("warned_users", 0)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка чтения {data_dir}: {e}")
+        return len(stats.chats), stats.users, warned
+
+
+class SqliteStorage:
+    """
+    Хранилище в SQLite (WAL): каждое изменение — upsert одной строки по индексу,
+    а не перезапись файла. Запросы короткие, поэтому выполняются прямо в event loop.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS warnings (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            date TEXT NOT NULL,
+            by_user INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS warnings_chat_user ON warnings (chat_id, user_id);
+        CREATE TABLE IF NOT EXISTS welcome (chat_id INTEGER PRIMARY KEY, text TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS rules (chat_id INTEGER PRIMARY KEY, text TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS bot_admins (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS keywords (
+            chat_id INTEGER NOT NULL,
+            keyword TEXT NOT NULL,
+            reply TEXT NOT NULL,
+            PRIMARY KEY (chat_id, keyword)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS stats_chats (chat_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS stats_users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS schedule (
+            id INTEGER PRIMARY KEY,
+            due REAL NOT NULL,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            data TEXT
+        );
+    """
+
+    # Сколько уже записанных id статистики помнить, чтобы не ходить в базу
+    SEEN_CACHE_SIZE = 100000
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self._seen_chats = set()
+        self._seen_users = set()
+        self._warned_users = 0
+
+    def load(self):
+        import sqlite3
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        if self._get_setting("json_migrated") is None:
+            self.migrate_from_json()
+        self._warned_users = self.db.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT chat_id, user_id FROM warnings)"
+        ).fetchone()[0]
+        logger.info(f"Успешно загружено из {self.path}")
+
+    def migrate_from_json(self):
+        """Однократный перенос данных из JSON-файлов в пустую базу"""
+        source = JsonStorage()
+        if not any(os.path.exists(path) for path in (CHATS_DIR, WARNINGS_FILE, WELCOME_FILE, RULES_FILE,
+                                                      SUPERADMINS_FILE, ADMINS_FILE, KEYWORDS_FILE,
+                                                      STATS_FILE, SCHEDULE_FILE)):
+            self._set_setting("json_migrated", datetime.now().isoformat())
+            return
+        source.load()
+        source.stats.close()
+        with self.db:
+            self.db.execute("BEGIN")
+            for chat_id in source.chats.chat_ids():
+                chat = source.chats.get(chat_id)
+                if "warnings" in chat:
+                    table = chat["warnings"]
+                    self.db.executemany(
+                        "INSERT INTO warnings (chat_id, user_id, reason, date, by_user) VALUES (?, ?, ?, ?, ?)",
+                        [(chat_id, table.users[i], table.reasons[i], warning_date(table.issued[i]), table.by[i])
+                         for i in range(len(table))]
+                    )
+                if chat.get("welcome") is not None:
+                    self.db.execute("INSERT OR REPLACE INTO welcome VALUES (?, ?)", (chat_id, chat["welcome"]))
+                if chat.get("rules") is not None:
+                    self.db.execute("INSERT OR REPLACE INTO rules VALUES (?, ?)", (chat_id, chat["rules"]))
+                self.db.executemany("INSERT OR IGNORE INTO bot_admins VALUES (?, ?)",
+                                    [(chat_id, int(u)) for u in chat.get("admins", [])])
+                self.db.executemany("INSERT OR REPLACE INTO keywords VALUES (?, ?, ?)",
+                                    [(chat_id, kw, reply) for kw, reply in chat.get("keywords", {}).items()])
+            self.db.executemany("INSERT OR IGNORE INTO stats_chats VALUES (?)", [(c,) for c in source.stats.chats])
+            self.db.executemany("INSERT OR IGNORE INTO stats_users VALUES (?)", [(u,) for u in source.stats.users])
+            self.db.executemany(
+                "INSERT INTO schedule (due, kind, chat_id, user_id, data) VALUES (?, ?, ?, ?, ?)",
+                [(due, kind, chat_id, user_id, json.dumps(data)) for due, _, kind, chat_id, user_id, data
+                 in source.get_schedule()]
+            )
+            if source.is_schedule_backfilled():
+                self.db.execute("INSERT OR REPLACE INTO settings VALUES ('schedule_backfilled', '1')")
+            if source.get_owner() is not None:
+                self.db.execute("INSERT OR REPLACE INTO settings VALUES ('owner', ?)", (str(source.get_owner()),))
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES ('json_migrated', ?)",
+                            (datetime.now().isoformat(),))
+        logger.info(f"JSON-данные перенесены в {self.path}")
+
+    async def flush(self):
+        pass
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def _get_setting(self, key: str):
+        row = self.db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_setting(self, key: str, value: str):
+        self.db.execute(
+            "INSERT INTO settings VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+
+    # --- ogohlantirishlar ---
+    def get_warnings(self, chat_id: int, user_id: int) -> list:
+        rows = self.db.execute(
+            "SELECT reason, date, by_user FROM warnings WHERE chat_id = ? AND user_id = ? ORDER BY id",
+            (chat_id, user_id)
+        )
+        return [WarningRecord(reason, warning_time(date), by) for reason, date, by in rows]
+
+    def _count_user_warnings(self, chat_id: int, user_id: int) -> int:
+        return self.db.execute(
+            "SELECT COUNT(*) FROM warnings WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+        ).fetchone()[0]
+
+    def add_warning(self, chat_id: int, user_id: int, reason: str, issued: float, by: int) -> int:
+        self.db.execute(
+            "INSERT INTO warnings (chat_id, user_id, reason, date, by_user) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, user_id, reason, warning_date(issued), by)
+        )
+        count = self._count_user_warnings(chat_id, user_id)
+        if count == 1:
+            self._warned_users += 1
+        return count
+
+    def clear_warnings(self, chat_id: int, user_id: int) -> int:
+        removed = self.db.execute(
+            "DELETE FROM warnings WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+        ).rowcount
+        if removed:
+            self._warned_users -= 1
+        return removed
+
+    def remove_warning(self, chat_id: int, user_id: int, issued: float) -> bool:
+        removed = self.db.execute(
+            "DELETE FROM warnings WHERE id = "
+            "(SELECT id FROM warnings WHERE chat_id = ? AND user_id = ? AND date = ? LIMIT 1)",
+            (chat_id, user_id, warning_date(issued))
+        ).rowcount
+        if removed and not self._count_user_warnings(chat_id, user_id):
+            self._warned_users -= 1
+        return removed > 0
+
+    def iter_warnings(self):
+        return [(chat_id, user_id, warning_time(date))
+                for chat_id, user_id, date in self.db.execute("SELECT chat_id, user_id, date FROM warnings")]
+
+    def count_warnings(self) -> int:
+        # Как и в JSON-варианте: число пользователей с ogohlantirish
+        return self._warned_users
+
+    # --- matnlar ---
+    def get_welcome(self, chat_id: int):
+        row = self.db.execute("SELECT text FROM welcome WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_welcome(self, chat_id: int, text: str):
+        self.db.execute(
+            "INSERT INTO welcome VALUES (?, ?) ON CONFLICT (chat_id) DO UPDATE SET text = excluded.text",
+            (chat_id, text)
+        )
+
+    def get_rules(self, chat_id: int):
+        row = self.db.execute("SELECT text FROM rules WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_rules(self, chat_id: int, text: str):
+        self.db.execute(
+            "INSERT INTO rules VALUES (?, ?) ON CONFLICT (chat_id) DO UPDATE SET text = excluded.text",
+            (chat_id, text)
+        )
+
+    # --- egasi va adminlar ---
+    def get_owner(self):
+        value = self._get_setting("owner")
+        return int(value) if value is not None else None
+
+    def set_owner(self, user_id: int):
+        self._set_setting("owner", str(user_id))
+
+    def get_bot_admins(self, chat_id: int) -> list:
+        return [row[0] for row in self.db.execute("SELECT user_id FROM bot_admins WHERE chat_id = ?", (chat_id,))]
+
+    # --- kalit so'zlar ---
+    def get_keywords(self, chat_id: int) -> dict:
+        return dict(self.db.execute("SELECT keyword, reply FROM keywords WHERE chat_id = ?", (chat_id,)))
+
+    def set_keyword(self, chat_id: int, keyword: str, reply: str):
+        self.db.execute(
+            "INSERT INTO keywords VALUES (?, ?, ?) "
+            "ON CONFLICT (chat_id, keyword) DO UPDATE SET reply = excluded.reply",
+            (chat_id, keyword, reply)
+        )
+
+    def delete_keyword(self, chat_id: int, keyword: str) -> bool:
+        return self.db.execute(
+            "DELETE FROM keywords WHERE chat_id = ? AND keyword = ?", (chat_id, keyword)
+        ).rowcount > 0
+
+    # --- rejalashtirilgan amallar ---
+    def get_schedule(self) -> list:
+        # Отсортированный список — уже готовая min-heap
+        return [(due, entry_id, kind, chat_id, user_id, json.loads(data))
+                for entry_id, due, kind, chat_id, user_id, data
+                in self.db.execute("SELECT id, due, kind, chat_id, user_id, data FROM schedule ORDER BY due, id")]
+
+    def add_schedule(self, due: float, kind: str, chat_id: int, user_id: int, data=None) -> int:
+        return self.db.execute(
+            "INSERT INTO schedule (due, kind, chat_id, user_id, data) VALUES (?, ?, ?, ?, ?)",
+            (due, kind, chat_id, user_id, json.dumps(data))
+        ).lastrowid
+
+    def remove_schedule(self, entry_id: int):
+        self.db.execute("DELETE FROM schedule WHERE id = ?", (entry_id,))
+
+    def is_schedule_backfilled(self) -> bool:
+        return self._get_setting("schedule_backfilled") is not None
+
+    def mark_schedule_backfilled(self):
+        self._set_setting("schedule_backfilled", "1")
+
+    # --- statistika ---
+    def _remember(self, seen: set, value: int) -> bool:
+        if value in seen:
+            return False
+        if len(seen) >= self.SEEN_CACHE_SIZE:
+            seen.clear()
+        seen.add(value)
+        return True
+
+    def add_chat(self, chat_id: int):
+        if self._remember(self._seen_chats, chat_id):
+            self.db.execute("INSERT OR IGNORE INTO stats_chats VALUES (?)", (chat_id,))
+
+    def add_user(self, user_id: int):
+        if self._remember(self._seen_users, user_id):
+            self.db.execute("INSERT OR IGNORE INTO stats_users VALUES (?)", (user_id,))
+
+    def count_chats(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM stats_chats").fetchone()[0]
+
+    def count_users(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM stats_users").fetchone()[0]
+
+    @staticmethod
+    def read_stats(data_dir: str) -> tuple:
+        """Как JsonStorage.read_stats, но из базы data_dir (открывается только на чтение)"""
+        import sqlite3
+        path = f"{data_dir}/{os.path.basename(SQLITE_FILE)}"
+        if not os.path.exists(path):
+            return 0, set(), 0
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            chats = db.execute("SELECT COUNT(*) FROM stats_chats").fetchone()[0]
+            users = {row[0] for row in db.execute("SELECT user_id FROM stats_users")}
+            warned = db.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT chat_id, user_id FROM warnings)"
+            ).fetchone()[0]
+        finally:
+            db.close()
+        return chats, users, warned
+
+
+def create_storage(backend: str):
+    """Выбор хранилища по STORAGE_BACKEND"""
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    if backend == "json":
+        return JsonStorage()
+    raise ValueError(f"Noma'lum STORAGE_BACKEND: {backend}")
+
+
+storage = create_storage(STORAGE_BACKEND)
+
+
+# ==================== ИНДЕКС USERNAME ====================
+class UsernameIndex:
+    """
+    username -> user_id по всем обновлениям, которые видит бот (Bot API не умеет
+    искать по username). В памяти — LRU не больше max_size записей, на диске —
+    append-only лог изменений, который сжимается при загрузке.
+    При шардировании лог общий: воркеры дописывают в него строки (каждая —
+    один write в режиме append), а промах get() дочитывает чужие строки.
+    Сжимает общий лог только приёмник, до запуска воркеров.
+    """
+
+    def __init__(self, path: str, max_size: int = USERNAME_INDEX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._ids = OrderedDict()  # username в нижнем регистре -> user_id
+        self._log = None
+        self._read_pos = 0  # до какого байта лог уже прочитан
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self, compact: bool = not SHARED_DATA_DIR):
+        self._ids.clear()
+        self._read_pos = 0
+        lines = self._read_tail()
+        if compact and lines > len(self._ids):
+            try:
+                write_file(self.path, "".join(f"{username} {user_id}\n" for username, user_id in self._ids.items()))
+                self._read_pos = os.path.getsize(self.path)
+            except Exception as e:
+                logger.error(f"Ошибка сжатия {self.path}: {e}")
+        logger.info(f"Индекс username: {len(self._ids)} записей")
+
+    def _read_tail(self) -> int:
+        """Дочитать лог с _read_pos; возвращает число прочитанных записей"""
+        lines = 0
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._read_pos)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.error(f"Ошибка чтения {self.path}: {e}")
+            return 0
+        # Последняя строка может ещё дописываться — её дочитаем в следующий раз
+        end = data.rfind(b"\n") + 1
+        self._read_pos += end
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            username, _, value = line.strip().partition(" ")
+            if not value.isdigit():
+                continue
+            self._ids[username] = int(value)
+            self._ids.move_to_end(username)
+            lines += 1
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return lines
+
+    def learn(self, user):
+        """Запомнить username пользователя; на диск пишется только изменение"""
+        if user is None or not user.username:
+            return
+        username = user.username.lower()
+        known = self._ids.get(username)
+        self._ids[username] = user.id
+        self._ids.move_to_end(username)
+        if known == user.id:
+            return
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        try:
+            if self._log is None:
+                self._log = open(self.path, 'a', encoding='utf-8')
+            line = f"{username} {user.id}\n"
+            self._log.write(line)
+            self._log.flush()
+            metrics.wrote(self.path, len(line))
+        except Exception as e:
+            logger.error(f"Ошибка записи в {self.path}: {e}")
+
+    def get(self, username: str):
+        """user_id по username (с @ или без) или None"""
+        username = username.lstrip('@').lower()
+        user_id = self._ids.get(username)
+        if user_id is None and SHARED_DATA_DIR:
+            self._read_tail()
+            user_id = self._ids.get(username)
+        if user_id is not None:
+            self._ids.move_to_end(username)
+        return user_id
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+
+
+username_index = UsernameIndex(USERNAMES_FILE)
+
+
+async def learn_usernames(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пополнение индекса username из каждого обновления: авторы, reply, новые участники, упоминания"""
+    try:
+        username_index.learn(update.effective_user)
+        message = update.effective_message
+        if message:
+            if message.reply_to_message:
+                username_index.learn(message.reply_to_message.from_user)
+            for member in message.new_chat_members or ():
+                username_index.learn(member)
+            for entity in message.entities or message.caption_entities or ():
+                if entity.user:
+                    username_index.learn(entity.user)
+        change = update.chat_member or update.my_chat_member
+        if change:
+            username_index.learn(change.new_chat_member.user)
+    except Exception as e:
+        logger.error(f"Ошибка в learn_usernames: {e}")
+
+
+# ==================== ЖУРНАЛ МОДЕРАЦИИ ====================
+class AuditLog:
+    """
+    Append-only журнал модерации: по строке на действие в сегментах
+    audit/<смещение>.log. Каждая запись хранит смещения предыдущей записи того же
+    пользователя в чате и того же чата, а в памяти — только смещения последних
+    записей (головы цепочек), поэтому последние N действий читаются за N pread
+    независимо от размера журнала. Заполненный сегмент ротируется; читаются
+    только AUDIT_OPEN_SEGMENTS последних, более старые сжимаются в .log.gz.
+    """
+
+    def __init__(self, directory: str, segment_size: int = AUDIT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._bases = []  # начальные смещения несжатых сегментов, последний — текущий
+        self._readers = {}  # начало сегмента -> fd для чтения
+        self._log = None
+        self._size = 0
+        self._user_heads = {}  # (chat_id, user_id) -> смещение последней записи
+        self._chat_heads = {}  # chat_id -> смещение последней записи
+
+    def _path(self, base: int) -> str:
+        return f"{self.directory}/{base:016d}.log"
+
+    def load(self):
+        """Головы цепочек — по несжатым сегментам (их размер ограничен), а не по всему журналу"""
+        self.close()
+        self._user_heads.clear()
+        self._chat_heads.clear()
+        os.makedirs(self.directory, exist_ok=True)
+        bases = sorted(
+            int(name[:-4]) for name in os.listdir(self.directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        # Сегменты, не успевшие сжаться до остановки
+        for base in bases[:-AUDIT_OPEN_SEGMENTS]:
+            self._compress(self._path(base))
+        self._bases = bases[-AUDIT_OPEN_SEGMENTS:] or [0]
+        records = 0
+        for base in self._bases:
+            path = self._path(base)
+            offset = base
+            try:
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        parts = line.split(b" ", 7)
+                        if len(parts) == 8:
+                            chat_id, user_id = int(parts[1]), int(parts[2])
+                            self._user_heads[(chat_id, user_id)] = offset
+                            self._chat_heads[chat_id] = offset
+                            records += 1
+                        offset += len(line)
+                if base == self._bases[-1] and offset - base < os.path.getsize(path):
+                    # Последняя строка записана не полностью
+                    os.truncate(path, offset - base)
+            except Exception as e:
+                logger.error(f"Ошибка чтения {path}: {e}")
+        self._size = offset - self._bases[-1]
+        logger.info(f"Журнал модерации: {records} недавних записей, {len(self._user_heads)} пользователей")
+
+    def record(self, chat_id: int, user_id: int, by: int, action: str, detail: str = ""):
+        """Записать действие; by=0 — автоматическое (флуд, спам, планировщик)"""
+        try:
+            if self._log is None:
+                self._log = open(self._path(self._bases[-1]), 'ab')
+            offset = self._bases[-1] + self._size
+            detail = " ".join(detail.split())[:AUDIT_DETAIL_LIMIT]
+            line = (
+                f"{int(time.time())} {chat_id} {user_id} {by} {action} "
+                f"{self._user_heads.get((chat_id, user_id), -1)} {self._chat_heads.get(chat_id, -1)} {detail}\n"
+            ).encode('utf-8')
+            self._log.write(line)
+            self._log.flush()
+            metrics.wrote(self._log.name, len(line))
+        except Exception as e:
+            logger.error(f"Ошибка записи в журнал модерации: {e}")
+            return
+        self._size += len(line)
+        self._user_heads[(chat_id, user_id)] = offset
+        self._chat_heads[chat_id] = offset
+        if self._size >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        """Новый текущий сегмент; вышедший за AUDIT_OPEN_SEGMENTS — на сжатие в executor"""
+        self._log.close()
+        self._log = None
+        self._bases.append(self._bases[-1] + self._size)
+        self._size = 0
+        if len(self._bases) <= AUDIT_OPEN_SEGMENTS:
+            return
+        base = self._bases.pop(0)
+        fd = self._readers.pop(base, None)
+        if fd is not None:
+            os.close(fd)
+        # Цепочки, ушедшие в сжатый сегмент, больше не читаются
+        oldest = self._bases[0]
+        self._user_heads = {key: offset for key, offset in self._user_heads.items() if offset >= oldest}
+        self._chat_heads = {key: offset for key, offset in self._chat_heads.items() if offset >= oldest}
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._compress(self._path(base))
+            return
+        loop.run_in_executor(None, profiler.run_in_thread, self._compress, self._path(base))
+
+    @staticmethod
+    def _compress(path: str):
+        try:
+            with open(path, 'rb') as src, gzip.open(path + ".gz.tmp", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + ".gz.tmp", path + ".gz")
+            metrics.wrote(path, os.path.getsize(path + ".gz"))
+            os.remove(path)
+            logger.info(f"Сегмент журнала сжат: {path}.gz")
+        except Exception as e:
+            logger.error(f"Ошибка сжатия {path}: {e}")
+
+    def _read(self, offset: int):
+        """Запись по смещению: (время, chat_id, user_id, by, действие, пред. пользователя, пред. чата, детали)"""
+        if offset < self._bases[0]:
+            return None
+        base = self._bases[bisect.bisect_right(self._bases, offset) - 1]
+        fd = self._readers.get(base)
+        if fd is None:
+            fd = self._readers[base] = os.open(self._path(base), os.O_RDONLY)
+        line = os.pread(fd, AUDIT_RECORD_LIMIT, offset - base).split(b"\n", 1)[0]
+        ts, chat_id, user_id, by, action, prev_user, prev_chat, detail = line.decode('utf-8').split(" ", 7)
+        return (int(ts), int(chat_id), int(user_id), int(by), action,
+                int(prev_user), int(prev_chat), detail)
+
+    def history(self, chat_id: int, user_id: int = None, limit: int = AUDIT_HISTORY_DEFAULT) -> list:
+        """Последние limit действий пользователя в чате (или всего чата), новые первыми"""
+        if user_id is None:
+            offset, link = self._chat_heads.get(chat_id, -1), 6
+        else:
+            offset, link = self._user_heads.get((chat_id, user_id), -1), 5
+        entries = []
+        try:
+            while offset >= 0 and len(entries) < limit:
+                entry = self._read(offset)
+                if entry is None:
+                    break
+                entries.append(entry)
+                offset = entry[link]
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала модерации: {e}")
+        return entries
+
+    def close(self):
+        if self._log:
+            self._log.close()
+            self._log = None
+        for fd in self._readers.values():
+            os.close(fd)
+        self._readers.clear()
+
+
+audit_log = AuditLog(AUDIT_DIR)
+
+
+# ==================== КЭШ АДМИНИСТРАТОРОВ ====================
+class AdminCache:
+    """
+    Администраторы Telegram-чатов в памяти: chat_id -> {user_id: ChatMember}.
+    Запись заполняется одним вызовом get_chat_administrators, живёт ADMIN_CACHE_TTL
+    секунд; при превышении ADMIN_CACHE_SIZE вытесняется самый давний чат (LRU).
+    """
+
+    def __init__(self, ttl: float = ADMIN_CACHE_TTL, max_chats: int = ADMIN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    async def get(self, bot, chat_id: int) -> dict:
+        return (await self._entry(bot, chat_id))[1]
+
+    async def mentions(self, bot, chat_id: int) -> str:
+        """
+        HTML-упоминания всех админов-людей. Строка собирается один раз на запись
+        кэша и пересобирается только после её сброса или истечения TTL.
+        """
+        entry = await self._entry(bot, chat_id)
+        if entry[2] is None:
+            entry[2] = " ".join(m.user.mention_html() for m in entry[1].values() if not m.user.is_bot)
+        return entry[2]
+
+    async def _entry(self, bot, chat_id: int) -> list:
+        entry = self._entries.get(chat_id)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(chat_id)
+            return entry
+        # Параллельные проверки одного чата ждут один и тот же запрос
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        return await task
+
+    async def _fetch(self, bot, chat_id: int) -> list:
+        admins = await bot.get_chat_administrators(chat_id)
+        # [срок жизни, {user_id: ChatMember}, готовая строка упоминаний]
+        entry = [time.monotonic() + self.ttl, {a.user.id: a for a in admins}, None]
+        self._entries[chat_id] = entry
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_chats:
+            self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+
+admin_cache = AdminCache()
+
+
+class Cooldown:
+    """
+    Кулдаун по ключу. Ключи хранятся в порядке последнего срабатывания,
+    истёкшие вытесняются с начала, поэтому память ограничена активными ключами.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self._last = OrderedDict()
+
+    def ready(self, key, now: float) -> bool:
+        last = self._last.get(key)
+        return last is None or now - last >= self.seconds
+
+    def hit(self, key, now: float):
+        self._last[key] = now
+        self._last.move_to_end(key)
+        while self._last:
+            oldest_key, oldest = next(iter(self._last.items()))
+            if now - oldest < self.seconds:
+                break
+            del self._last[oldest_key]
+
+
+summon_chat_cooldown = Cooldown(SUMMON_CHAT_COOLDOWN)
+summon_user_cooldown = Cooldown(SUMMON_USER_COOLDOWN)
+
+
+# ==================== РОЛИ ====================
+# Биты ролей пользователя в чате
+ROLE_OWNER = 1  # owner бота — во всех чатах
+ROLE_CREATOR = 2  # создатель Telegram-чата
+ROLE_CHAT_ADMIN = 4  # администратор Telegram-чата (у создателя тоже стоит)
+ROLE_BOT_ADMIN = 8  # админ бота в чате (storage.get_bot_admins)
+TELEGRAM_ROLES = ROLE_CREATOR | ROLE_CHAT_ADMIN
+# Права — маски ролей: достаточно любой из них
+CAN_SUPERADMIN = ROLE_OWNER
+CAN_FULL_MODERATE = ROLE_OWNER | ROLE_CHAT_ADMIN
+CAN_LIMITED_MODERATE = CAN_FULL_MODERATE | ROLE_BOT_ADMIN
+CAN_MANAGE_ADMINS = ROLE_OWNER | ROLE_CHAT_ADMIN
+# Кого не трогает массовая модерация
+PROTECTED_ROLES = ROLE_OWNER | ROLE_CHAT_ADMIN | ROLE_BOT_ADMIN
+# Методы Bot API, по которым видно модерацию в чате (MetricsRequest -> track_moderation)
+MODERATION_METHODS = frozenset((
+    "banChatMember", "unbanChatMember", "restrictChatMember", "promoteChatMember",
+    "deleteMessage", "deleteMessages", "banChatSenderChat",
+))
+# Ошибки, после которых список админов чата в индексе считается устаревшим
+ROLE_STALE_ERRORS = ("not enough rights", "chat_admin_required", "is not an administrator",
+                     "is an administrator", "need administrator rights")
+
+
+def status_roles(status: str) -> int:
+    """Роли по статусу ChatMember"""
+    if status == 'creator':
+        return ROLE_CREATOR | ROLE_CHAT_ADMIN
+    if status == 'administrator':
+        return ROLE_CHAT_ADMIN
+    return 0
+
+
+class RoleIndex:
+    """
+    (chat_id, user_id) -> битовая маска ролей: любой вопрос о правах — поиск в
+    словаре, без API. Админы Telegram-чата загружаются одним getChatAdministrators
+    при первой проверке в чате и дальше меняются по обновлениям chat_member; раз
+    в ROLE_RESYNC секунд (в чатах с недавней модерацией — в ROLE_RESYNC_ACTIVE)
+    список в фоне сверяется заново (на случай пропущенных обновлений), а после
+    отказа API в правах — перед следующей проверкой. Админы бота берутся из
+    хранилища при каждой такой загрузке.
+    """
+
+    def __init__(self, max_chats: int = ROLE_INDEX_CHATS, resync: float = ROLE_RESYNC,
+                 resync_active: float = ROLE_RESYNC_ACTIVE):
+        self.max_chats = max_chats
+        self.resync = resync
+        self.resync_active = resync_active
+        self._roles = {}  # (chat_id, user_id) -> маска без ROLE_OWNER
+        self._members = {}  # chat_id -> {user_id с ненулевой маской}
+        self._synced = OrderedDict()  # chat_id -> время загрузки (LRU); 0 — сброшен invalidate()
+        self._moderated = {}  # chat_id -> время последней модерации
+        self._owner = None
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._roles)
+
+    @property
+    def owner(self):
+        if self._owner is None:
+            self._owner = get_owner()
+        return self._owner
+
+    def set_owner(self, user_id: int):
+        self._owner = user_id
+
+    def get(self, chat_id: int, user_id: int) -> int:
+        """Маска ролей; для чатов, которые ещё не загружены, — только ROLE_OWNER"""
+        roles = self._roles.get((chat_id, user_id), 0)
+        if user_id is not None and user_id == self.owner:
+            roles |= ROLE_OWNER
+        return roles
+
+    def _set(self, chat_id: int, user_id: int, roles: int, mask: int):
+        """Заменить биты mask пользователя на roles"""
+        key = (chat_id, user_id)
+        value = (self._roles.get(key, 0) & ~mask) | roles
+        if value:
+            self._roles[key] = value
+            self._members.setdefault(chat_id, set()).add(user_id)
+        elif key in self._roles:
+            del self._roles[key]
+            self._members[chat_id].discard(user_id)
+
+    def set_chat_admins(self, chat_id: int, admins: dict):
+        """Полный список администраторов Telegram-чата {user_id: ChatMember}"""
+        for user_id in list(self._members.get(chat_id, ())):
+            if user_id not in admins:
+                self._set(chat_id, user_id, 0, TELEGRAM_ROLES)
+        for user_id, member in admins.items():
+            self._set(chat_id, user_id, status_roles(member.status), TELEGRAM_ROLES)
+
+    def set_bot_admins(self, chat_id: int, user_ids):
+        user_ids = set(user_ids)
+        for user_id in list(self._members.get(chat_id, ())):
+            if user_id not in user_ids:
+                self._set(chat_id, user_id, 0, ROLE_BOT_ADMIN)
+        for user_id in user_ids:
+            self._set(chat_id, user_id, ROLE_BOT_ADMIN, ROLE_BOT_ADMIN)
+
+    def update_member(self, chat_id: int, user_id: int, status: str):
+        """Смена статуса из chat_member; незагруженный чат загрузится целиком при первой проверке"""
+        if chat_id in self._synced:
+            self._set(chat_id, user_id, status_roles(status), TELEGRAM_ROLES)
+
+    def moderated(self, chat_id: int):
+        """В чате была модерация: его админов сверяем чаще"""
+        if chat_id in self._synced:
+            self._moderated[chat_id] = time.monotonic()
+
+    def invalidate(self, chat_id: int):
+        """Роли чата устарели (API отказал в правах): перечитать перед следующей проверкой"""
+        if chat_id in self._synced:
+            self._synced[chat_id] = 0
+            admin_cache.invalidate(chat_id)
+            logger.info(f"Роли чата {chat_id} сброшены после отказа API")
+
+    async def ensure(self, bot, chat):
+        """Загрузить роли чата, если их ещё нет; устаревшие — обновить в фоне"""
+        if chat is None or chat.type == "private":
+            return
+        synced = self._synced.get(chat.id)
+        if not synced:
+            await self._sync(bot, chat.id)
+            return
+        self._synced.move_to_end(chat.id)
+        now = time.monotonic()
+        moderated = self._moderated.get(chat.id)
+        resync = self.resync_active if moderated is not None and now - moderated < self.resync else self.resync
+        if now - synced > resync:
+            # Повторно в фон не ставим, пока идёт эта сверка
+            self._synced[chat.id] = time.monotonic()
+            admin_cache.invalidate(chat.id)
+            task = asyncio.ensure_future(self._sync(bot, chat.id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _sync(self, bot, chat_id: int):
+        try:
+            admins = await admin_cache.get(bot, chat_id)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки администраторов ({chat_id}): {e}")
+            return
+        self.set_chat_admins(chat_id, admins)
+        self.set_bot_admins(chat_id, storage.get_bot_admins(chat_id))
+        self._synced[chat_id] = time.monotonic()
+        self._synced.move_to_end(chat_id)
+        while len(self._synced) > self.max_chats:
+            evicted, _ = self._synced.popitem(last=False)
+            self._moderated.pop(evicted, None)
+            for user_id in self._members.pop(evicted, ()):
+                del self._roles[(evicted, user_id)]
+
+
+role_index = RoleIndex()
+
+
+def track_moderation(parameters: dict, code: int, payload: bytes):
+    """Ответ на вызов модерации: отмечаем активность чата, отказ в правах сбрасывает его роли"""
+    try:
+        chat_id = int(parameters.get("chat_id"))
+    except (TypeError, ValueError):
+        return
+    if code < 400:
+        role_index.moderated(chat_id)
+        return
+    try:
+        description = json.loads(payload).get("description", "").lower()
+    except ValueError:
+        return
+    if any(error in description for error in ROLE_STALE_ERRORS):
+        role_index.invalidate(chat_id)
+
+
+# ==================== ПОДТВЕРЖДЕНИЕ СТАТУСА ====================
+ADMIN_STATUSES = ('creator', 'administrator')
+NON_ADMIN_STATUSES = ('member', 'restricted', 'left', 'kicked')
+
+
+class StatusWaiter:
+    """Ожидание того, что (chat_id, user_id) получит один из statuses"""
+
+    __slots__ = ("chat_id", "user_id", "statuses", "future")
+
+    def __init__(self, chat_id: int, user_id: int, statuses):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.statuses = statuses
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class PendingConfirmations:
+    """
+    Реестр ожиданий подтверждения по ключу (chat_id, user_id).
+    Ожидание регистрируется до promote/demote и разрешается событием
+    ChatMemberUpdated в track_chat_members (работает благодаря concurrent_updates).
+    """
+
+    def __init__(self):
+        self._waiters = {}
+
+    def expect(self, chat_id: int, user_id: int, statuses) -> StatusWaiter:
+        waiter = StatusWaiter(chat_id, user_id, statuses)
+        self._waiters.setdefault((chat_id, user_id), []).append(waiter)
+        return waiter
+
+    def resolve(self, chat_id: int, user_id: int, status: str):
+        for waiter in self._waiters.get((chat_id, user_id), []):
+            if status in waiter.statuses and not waiter.future.done():
+                waiter.future.set_result(status)
+
+    def discard(self, waiter: StatusWaiter):
+        key = (waiter.chat_id, waiter.user_id)
+        waiters = self._waiters.get(key, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self._waiters.pop(key, None)
+        if not waiter.future.done():
+            waiter.future.cancel()
+
+
+pending_confirmations = PendingConfirmations()
+
+
+async def confirm_member_status(bot, waiter: StatusWaiter, timeout: float = CONFIRM_TIMEOUT) -> bool:
+    """
+    Ждёт события ChatMemberUpdated; если его нет (бот не получает chat_member
+    обновления), проверяет статус через get_chat_member с удваивающейся паузой.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = CONFIRM_FIRST_CHECK
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), min(delay, remaining))
+            return True
+        except asyncio.TimeoutError:
+            pass
+        try:
+            member = await bot.get_chat_member(waiter.chat_id, waiter.user_id)
+            if member.status in waiter.statuses:
+                return True
+        except Exception as e:
+            logger.error(f"Status tekshirishda xato: {e}")
+        delay *= 2
+
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+# Приоритеты: меньше — раньше
+PRIORITY_HIGH = 0  # модерация
+PRIORITY_NORMAL = 1  # ответы на команды
+PRIORITY_LOW = 2  # приветствия и авто-ответы
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _OutboundJob:
+    __slots__ = ("call", "future", "enqueued", "attempts")
+
+    def __init__(self, call, future, enqueued: float):
+        self.call = call
+        self.future = future
+        self.enqueued = enqueued
+        self.attempts = 0
+
+
+class OutboundDispatcher:
+    """
+    Центральная очередь исходящих сообщений.
+    У каждого чата своя очередь по приоритету и свой token bucket; общий bucket
+    держит глобальный лимит. В каждом чате одновременно отправляется не больше
+    одного сообщения, поэтому порядок внутри чата сохраняется. На 429 чат
+    ставится на паузу retry_after и сообщение повторяется. PRIORITY_LOW
+    выбрасывается при переполнении очереди чата и если слишком долго ждало.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._worker = None
+
+    def _reset(self, loop):
+        now = loop.time()
+        self._loop = loop
+        # Лимит Telegram общий на бота — воркеры делят его поровну
+        global_rate = GLOBAL_SEND_RATE / SHARDS
+        self._global = TokenBucket(global_rate, global_rate, now)
+        self._buckets = {}
+        self._pending = {}  # chat_id -> heap[(priority, seq, job)]
+        self._ready = []  # heap[(priority, seq, chat_id)] — чаты, которым можно отправлять
+        self._active = set()  # чаты в _ready, в ожидании токена или в процессе отправки
+        self._paused_until = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+        self._worker = loop.create_task(self._run())
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._reset(loop)
+
+    def submit(self, chat_id: int, call, priority: int = PRIORITY_NORMAL) -> asyncio.Future:
+        """
+        Поставить вызов Bot API в очередь. Возвращает future с результатом
+        (None при ошибке — она уже залогирована), ждать его не обязательно.
+        """
+        self._ensure_worker()
+        job = _OutboundJob(call, self._loop.create_future(), self._loop.time())
+        heap = self._pending.setdefault(chat_id, [])
+        heapq.heappush(heap, (priority, next(self._seq), job))
+        if len(heap) > OUTBOX_CHAT_LIMIT:
+            self._drop_oldest_low(heap)
+        self._idle.clear()
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._schedule(chat_id)
+        return job.future
+
+    @staticmethod
+    def _drop(job: _OutboundJob, reason: str):
+        metrics.outbox_dropped[reason] += 1
+        job.future.set_result(None)
+
+    def _drop_oldest_low(self, heap: list):
+        """Переполнение очереди чата: выбросить самое старое PRIORITY_LOW (модерацию и ответы — нет)"""
+        low = [entry for entry in heap if entry[0] == PRIORITY_LOW]
+        if not low:
+            return
+        oldest = min(low, key=lambda entry: entry[1])
+        heap.remove(oldest)
+        heapq.heapify(heap)
+        self._drop(oldest[2], "overflow")
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            now = self._loop.time()
+            if chat_id > 0:
+                bucket = TokenBucket(PRIVATE_SEND_RATE, 1, now)
             else:
-                save_data(file_path, default)
-                logger.info(f"Создан новый файл {file_path}")
+                bucket = TokenBucket(GROUP_SEND_RATE, GROUP_SEND_BURST, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule(self, chat_id: int):
+        now = self._loop.time()
+        wait = max(self._bucket(chat_id).wait_time(now), self._paused_until.get(chat_id, 0) - now)
+        if wait > 0:
+            self._loop.call_later(wait, self._make_ready, chat_id)
+        else:
+            self._make_ready(chat_id)
+
+    def _make_ready(self, chat_id: int):
+        heap = self._pending.get(chat_id)
+        if heap:
+            priority, seq, _ = heap[0]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = self._loop.time()
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            priority, _, job = heapq.heappop(self._pending[chat_id])
+            if priority == PRIORITY_LOW and now - job.enqueued > OUTBOX_LOW_MAX_AGE:
+                # Приветствие или авто-ответ через минуты уже не к месту
+                self._drop(job, "stale")
+                self._finish(chat_id)
+                continue
+            self._global.consume(now)
+            self._bucket(chat_id).consume(now)
+            self._loop.create_task(self._deliver(chat_id, job))
+
+    async def _deliver(self, chat_id: int, job: _OutboundJob):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            job.attempts += 1
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self._paused_until[chat_id] = self._loop.time() + delay
+            if job.attempts <= SEND_MAX_RETRIES:
+                self.retried += 1
+                # Повтор встаёт в начало очереди чата
+                heapq.heappush(self._pending[chat_id], (-1, next(self._seq), job))
+                logger.warning(f"429 в чате {chat_id}: повтор через {delay} сек")
+            else:
+                self.failed += 1
+                logger.error(f"Сообщение в {chat_id} не отправлено после {job.attempts} попыток")
+                job.future.set_result(None)
         except Exception as e:
-            logger.error(f"Ошибка загрузки {file_path}: {e}")
-            var_ref.clear()
-            var_ref.update(default)
+            self.failed += 1
+            logger.error(f"Ошибка отправки в {chat_id}: {e}")
+            job.future.set_result(None)
+        else:
+            self.sent += 1
+            self.latencies.append(self._loop.time() - job.enqueued)
+            job.future.set_result(result)
+        finally:
+            self._finish(chat_id)
+
+    def _finish(self, chat_id: int):
+        if self._pending.get(chat_id):
+            self._schedule(chat_id)
+            return
+        self._pending.pop(chat_id, None)
+        self._active.discard(chat_id)
+        if self._paused_until.get(chat_id, 0) <= self._loop.time():
+            self._paused_until.pop(chat_id, None)
+        if not self._active:
+            self._idle.set()
+        if len(self._buckets) > 1024:
+            self._prune_buckets()
+
+    def _prune_buckets(self):
+        # Полный bucket неактивного чата ничем не отличается от нового
+        now = self._loop.time()
+        for chat_id in [c for c, b in self._buckets.items() if b.is_full(now)]:
+            del self._buckets[chat_id]
+
+    def depth(self) -> int:
+        return sum(len(heap) for heap in self._pending.values()) if self._worker else 0
+
+    def latency_stats(self):
+        """Returns: (p50, p99, max) задержки в очереди в секундах за последние 1000 отправок"""
+        if not self._worker or not self.latencies:
+            return 0.0, 0.0, 0.0
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2], ordered[int(len(ordered) * 0.99)], ordered[-1]
+
+    async def drain(self, timeout: float):
+        """Дождаться отправки всего, что уже в очереди"""
+        if self._worker and self._loop is asyncio.get_running_loop():
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Очередь отправки не опустела: {self.depth()} сообщений")
+
+
+outbox = OutboundDispatcher()
+
+
+def reply(update: Update, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+    """
+    Ответ на сообщение через очередь outbox. Обработчик не ждёт отправки
+    (не держит слот concurrent_updates); если нужен результат — await future.
+    """
+    message = update.message
+    return outbox.submit(update.effective_chat.id, lambda: message.reply_text(text, **kwargs), priority)
+
+
+# ==================== ШАБЛОНЫ ====================
+# Теги, которые Telegram понимает в parse_mode=HTML
+TELEGRAM_HTML_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+    "span", "tg-spoiler", "tg-emoji", "blockquote",
+}
+TEMPLATE_PLACEHOLDER_RE = re.compile(r'\{(user|username|chat|count|time)\}')
+
+
+class TelegramHTMLChecker(HTMLParser):
+    """
+    Проверка HTML из /setwelcome и /setrules: только теги Telegram, все закрыты
+    по порядку. Попутно собирает текст заново, экранируя одиночные <, > и &,
+    которые Telegram иначе отклонит.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.stack = []
+        self.error = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in TELEGRAM_HTML_TAGS:
+            self.error = self.error or f"<{tag}> qo'llab-quvvatlanmaydi"
+        self.stack.append(tag)
+        self.parts.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            self.error = self.error or f"</{tag}> ochilmagan yoki tartib buzilgan"
+        else:
+            self.stack.pop()
+        self.parts.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data, quote=False))
+
+    def handle_entityref(self, name):
+        self.parts.append(f"&{name};")
+
+    def handle_charref(self, name):
+        self.parts.append(f"&#{name};")
+
+
+def check_html(text: str, max_length: int = None):
+    """
+    max_length — предел для шаблона: его длина после подстановок в худшем случае.
+    Returns: (экранированный текст, None) или (None, описание ошибки)
+    """
+    checker = TelegramHTMLChecker()
+    checker.feed(text)
+    checker.close()
+    if checker.error:
+        return None, checker.error
+    if checker.stack:
+        return None, f"<{checker.stack[-1]}> yopilmagan"
+    clean = "".join(checker.parts)
+    if max_length is not None:
+        length = compile_template(clean).max_length()
+        if length > max_length:
+            return None, f"matn juda uzun: {length} belgi, ko'pi bilan {max_length}"
+    return clean, None
+
+
+def username_text(member) -> str:
+    return f"@{member.username}" if member.username else html.escape(member.first_name)
+
+
+# Подстановки-списки: как показать одного участника
+TEMPLATE_LIST_FIELDS = {"user": User.mention_html, "username": username_text}
+
 
+class Template:
+    """
+    Текст, разобранный один раз: чётные элементы segments — готовый текст,
+    нечётные — имена подстановок. Рендер — один join без поиска по строке.
+    """
+
+    __slots__ = ("segments", "counts", "static_length", "fields")
+
+    def __init__(self, text: str):
+        self.segments = TEMPLATE_PLACEHOLDER_RE.split(text)
+        self.counts = Counter(self.segments[1::2])
+        self.static_length = sum(len(s) for s in self.segments[::2])
+        # Подстановки-списки участников, которые есть в тексте: (имя, рендер одного)
+        self.fields = [(name, show) for name, show in TEMPLATE_LIST_FIELDS.items() if name in self.counts]
+
+    def uses(self, name: str) -> bool:
+        return name in self.counts
+
+    def max_length(self) -> int:
+        """Длина после подстановок в худшем случае (списки участников сокращаются до «va yana N kishi»)"""
+        return self.static_length + sum(
+            TEMPLATE_VALUE_MAX.get(name, TEMPLATE_LIST_RESERVE) * n for name, n in self.counts.items()
+        )
+
+    def render(self, values: dict) -> str:
+        segments = self.segments[:]
+        for i in range(1, len(segments), 2):
+            segments[i] = values.get(segments[i], "")
+        return "".join(segments)
 
-def save_data(file_path: str, data):
-    """Сохранение данных в JSON-файл"""
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text: str) -> Template:
+    """Шаблоны кэшируются по тексту: после /setwelcome старый просто вытесняется"""
+    return Template(text)
+
+
+# ==================== ПРИВЕТСТВИЯ ====================
+def render_template(template: Template, members, chat_title: str, member_count: int = None,
+                    joined: datetime = None) -> str:
+    """
+    Приветствие (одно на всех вошедших) или правила: {user} — упоминания,
+    {username} — @username (или имя) через запятую; если они не помещаются в MAX_MESSAGE_LENGTH, остаток пишется как
+    «va yana N kishi». {chat} — название чата, {count} — участников, {time} — время вступления.
+    """
+    values = {"chat": html.escape(chat_title or "")}
+    if template.uses("count"):
+        values["count"] = str(member_count) if member_count is not None else ""
+    if template.uses("time"):
+        values["time"] = f"{joined or datetime.now():%H:%M}"
+    if not template.fields:
+        # Длину шаблона ограничивает check_html при сохранении
+        return template.render(values)
+    counts = template.counts
+    used = template.static_length + sum(len(value) * counts[name] for name, value in values.items())
+    lists = [[] for _ in template.fields]
+    # Участники рендерятся кусками: хвост, который всё равно не влезет, не рендерится
+    total = used
+    rendered = 0
+    while rendered < len(members) and total <= MAX_MESSAGE_LENGTH:
+        chunk = members[rendered:rendered + TEMPLATE_CHUNK]
+        for (name, show), pieces in zip(template.fields, lists):
+            new = [show(member) for member in chunk]
+            pieces += new
+            total += (sum(map(len, new)) + 2 * len(new)) * counts[name]
+        rendered += len(chunk)
+
+    # У последнего участника ", " лишняя
+    slots = sum(counts[name] for name, _ in template.fields)
+    shown = rendered
+    if rendered < len(members) or total - 2 * slots > MAX_MESSAGE_LENGTH:
+        # Не влезли все — берём сколько поместится вместе с «va yana N kishi»
+        costs = [0] * rendered
+        for (name, _), pieces in zip(template.fields, lists):
+            costs = [cost + (len(piece) + 2) * counts[name] for cost, piece in zip(costs, pieces)]
+        shown = 0
+        for cost in costs:
+            rest = len(members) - shown - 1
+            suffix = len(f" va yana {rest} kishi") * slots if rest else -2 * slots
+            if used + cost + suffix > MAX_MESSAGE_LENGTH:
+                break
+            used += cost
+            shown += 1
+    for (name, _), pieces in zip(template.fields, lists):
+        values[name] = ", ".join(pieces[:shown] if shown < rendered else pieces)
+        if shown < len(members):
+            values[name] += f" va yana {len(members) - shown} kishi"
+    return template.render(values)
+
+
+async def get_member_count(bot, chat_id: int):
+    """Число участников для {count}; при ошибке API подстановка остаётся пустой"""
     try:
-        temp_path = file_path + ".tmp"
-        with open(temp_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(temp_path, file_path)
-        logger.info(f"Данные успешно сохранены в {file_path}")
+        return await bot.get_chat_member_count(chat_id)
     except Exception as e:
-        logger.error(f"Ошибка сохранения в {file_path}: {e}")
+        logger.error(f"Ошибка getChatMemberCount ({chat_id}): {e}")
+        return None
+
+
+class JoinBatcher:
+    """
+    Склеивание вступлений: участники, вошедшие в чат за WELCOME_BATCH_WINDOW
+    секунд, получают одно общее приветствие вместо сообщения на каждого.
+    """
+
+    def __init__(self, window: float = WELCOME_BATCH_WINDOW):
+        self.window = window
+        self._buffers = {}  # chat_id -> [bot, название чата, {user_id: User}, время первого вступления]
+        self._last_welcome = {}  # chat_id -> message_id последнего приветствия
+        self._tasks = set()
+
+    def add(self, bot, chat, members):
+        buffer = self._buffers.get(chat.id)
+        if buffer is None:
+            buffer = self._buffers[chat.id] = [bot, chat.title, {}, datetime.now()]
+            task = asyncio.get_running_loop().create_task(self._flush_later(chat.id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        buffer[1] = chat.title
+        for member in members:
+            buffer[2][member.id] = member
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        await self._flush(chat_id)
+
+    async def _flush(self, chat_id: int):
+        buffer = self._buffers.pop(chat_id, None)
+        if not buffer:
+            return
+        bot, title, members, joined = buffer
+        try:
+            text = storage.get_welcome(chat_id)
+            if text is None:
+                return
+            template = compile_template(text)
+            count = await get_member_count(bot, chat_id) if template.uses("count") else None
+            text = render_template(template, list(members.values()), title, count, joined)
+            message = await outbox.submit(
+                chat_id, lambda: bot.send_message(chat_id, text, parse_mode=ParseMode.HTML), PRIORITY_LOW
+            )
+            if message is None:
+                return
+            previous = self._last_welcome.get(chat_id)
+            self._last_welcome[chat_id] = message.message_id
+            if previous and WELCOME_DELETE_PREVIOUS:
+                await bot.delete_message(chat_id, previous)
+        except Exception as e:
+            logger.error(f"Ошибка в welcome ({chat_id}): {e}")
+
+    async def flush_all(self):
+        """Разослать всё накопленное сразу (при остановке бота)"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*(self._flush(chat_id) for chat_id in list(self._buffers)))
+
+
+join_batcher = JoinBatcher()
+
+
+# ==================== ПЛАНИРОВЩИК ====================
+class Scheduler:
+    """
+    Отложенные действия (снятие временного бана, истечение ogohlantirish,
+    уведомление о конце mute). Сроки — min-heap в памяти, записи — в хранилище;
+    в JobQueue всегда стоит одно задание — на ближайший срок. После перезапуска
+    загружается только очередь сроков, данные чатов заново не просматриваются.
+    """
+
+    def __init__(self):
+        self._heap = []  # [(срок, id, вид, chat_id, user_id, данные)]
+        self._by_target = {}  # (вид, chat_id, user_id) -> {id}
+        self._cancelled = set()
+        self._application = None
+        self._job = None
+        self._job_due = None
+
+    def __len__(self):
+        return len(self._heap) - len(self._cancelled)
+
+    def load(self):
+        self._heap = storage.get_schedule()
+        heapq.heapify(self._heap)
+        self._by_target.clear()
+        self._cancelled.clear()
+        for due, entry_id, kind, chat_id, user_id, data in self._heap:
+            self._by_target.setdefault((kind, chat_id, user_id), set()).add(entry_id)
+        logger.info(f"Планировщик: {len(self._heap)} отложенных действий")
+
+    def _backfill_warnings(self):
+        """Однократно: сроки истечения для ogohlantirish, выданных до появления планировщика"""
+        if WARN_EXPIRE_DAYS:
+            for chat_id, user_id, issued in storage.iter_warnings():
+                self.add((issued or time.time()) + WARN_EXPIRE_DAYS * 86400, "warn_expire",
+                         chat_id, user_id, issued)
+        storage.mark_schedule_backfilled()
+
+    def start(self, application: Application):
+        # Внутри event loop, чтобы записи склеивались WriteBehind
+        if not storage.is_schedule_backfilled():
+            self._backfill_warnings()
+        # Задание прежнего Application (повторный запуск в том же процессе) уже недействительно
+        self._application = application
+        self._job = None
+        self._arm()
+
+    def add(self, due: float, kind: str, chat_id: int, user_id: int, data=None):
+        entry_id = storage.add_schedule(due, kind, chat_id, user_id, data)
+        heapq.heappush(self._heap, (due, entry_id, kind, chat_id, user_id, data))
+        self._by_target.setdefault((kind, chat_id, user_id), set()).add(entry_id)
+        if self._heap[0][1] == entry_id:
+            self._arm()
+
+    def cancel(self, kind: str, chat_id: int, user_id: int) -> int:
+        """Отменить все действия вида kind для пользователя; из кучи они уйдут при извлечении"""
+        entry_ids = self._by_target.pop((kind, chat_id, user_id), ())
+        for entry_id in entry_ids:
+            self._cancelled.add(entry_id)
+            storage.remove_schedule(entry_id)
+        return len(entry_ids)
+
+    def _arm(self):
+        """Поставить задание JobQueue на ближайший срок (или оставить уже стоящее)"""
+        while self._heap and self._heap[0][1] in self._cancelled:
+            self._cancelled.discard(heapq.heappop(self._heap)[1])
+        if self._application is None or not self._heap:
+            return
+        job_queue = self._application.job_queue
+        if job_queue is None:
+            logger.error("JobQueue недоступна: установите python-telegram-bot[job-queue]")
+            return
+        due = self._heap[0][0]
+        if self._job is not None:
+            if self._job_due <= due:
+                return
+            self._job.schedule_removal()
+        self._job = job_queue.run_once(self._run, when=max(0.0, due - time.time()), name="scheduler")
+        self._job_due = due
+
+    async def _run(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = None
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            due, entry_id, kind, chat_id, user_id, data = heapq.heappop(self._heap)
+            if entry_id in self._cancelled:
+                self._cancelled.discard(entry_id)
+                continue
+            targets = self._by_target.get((kind, chat_id, user_id))
+            if targets is not None:
+                targets.discard(entry_id)
+                if not targets:
+                    del self._by_target[(kind, chat_id, user_id)]
+            try:
+                await SCHEDULED_ACTIONS[kind](context.bot, chat_id, user_id, data)
+            except Exception as e:
+                logger.error(f"Ошибка отложенного действия {kind} ({chat_id}, {user_id}): {e}")
+            storage.remove_schedule(entry_id)
+        self._arm()
+
+
+scheduler = Scheduler()
+
+
+async def expire_warning(bot, chat_id: int, user_id: int, issued):
+    # В записях, запланированных до перехода на epoch, время — ISO-строка
+    storage.remove_warning(chat_id, user_id, warning_time(issued))
+
+
+async def lift_temp_ban(bot, chat_id: int, user_id: int, mention: str):
+    await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+    audit_log.record(chat_id, user_id, 0, "unban", "muddat tugadi")
+    outbox.submit(
+        chat_id,
+        lambda: bot.send_message(chat_id, f"⏰ <b>{mention} blokdan chiqarildi.</b>", parse_mode=ParseMode.HTML),
+        PRIORITY_LOW
+    )
+
+
+async def announce_unmute(bot, chat_id: int, user_id: int, mention: str):
+    # Mute снимает сам Telegram по until_date — здесь только уведомление
+    outbox.submit(
+        chat_id,
+        lambda: bot.send_message(chat_id, f"🔊 <b>{mention} ovozi qaytdi.</b>", parse_mode=ParseMode.HTML),
+        PRIORITY_LOW
+    )
+
+
+SCHEDULED_ACTIONS = {
+    "warn_expire": expire_warning,
+    "unban": lift_temp_ban,
+    "unmute": announce_unmute,
+}
+
+
+def schedule_lift(kind: str, chat_id: int, user_id: int, until_date=None, mention: str = None):
+    """
+    После бана/мута (и их снятия): прежнее отложенное "unban"/"unmute" отменяется,
+    для временного — планируется новое на until_date. Общее для одиночных и /bulk... команд.
+    """
+    scheduler.cancel(kind, chat_id, user_id)
+    if until_date:
+        scheduler.add(until_date, kind, chat_id, user_id, mention)
 
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
@@ -89,7 +2650,12 @@ async def get_user_from_message(update: Update, context: ContextTypes.DEFAULT_TY
             user = update.message.reply_to_message.from_user
             return user, user.id
 
-        # 2. @username yoki user_id orqali
+        # 2. Username'siz foydalanuvchi uchun Telegram qo'ygan havola (text_mention)
+        for entity in update.message.entities:
+            if entity.type == MessageEntity.TEXT_MENTION and entity.user:
+                return entity.user, entity.user.id
+
+        # 3. @username yoki user_id orqali
         if context.args:
             identifier = context.args[0]
 
@@ -108,26 +2674,21 @@ async def get_user_from_message(update: Update, context: ContextTypes.DEFAULT_TY
                     logger.error(f"User ID orqali topib bo'lmadi: {e}")
                     return None, None
 
-            # Username orqali qidirish (chat memberlarini tekshirish)
-            try:
-                # Telegram API username orqali to'g'ridan-to'g'ri qidirishni qo'llab-quvvatlamaydi
-                # Shuning uchun xabar matni orqali username ni olish kerak
-                chat_id = update.effective_chat.id
-
-                # Kichik xatoliklar uchun: chat a'zolaridan qidirish imkonsiz
-                # Faqat mention qilingan userlarni olish mumkin
-                await update.message.reply_text(
-                    f"❌ @{username} topilmadi!\n\n"
-                    f"💡 <b>Qanday ishlatiladi:</b>\n"
-                    f"• Foydalanuvchi xabariga reply qiling\n"
-                    f"• Yoki user ID kiriting: <code>/admin 123456789</code>",
-                    parse_mode=ParseMode.HTML
-                )
-                return None, None
-
-            except Exception as e:
-                logger.error(f"Username orqali qidirishda xato: {e}")
-                return None, None
+            # Username orqali qidirish: Telegram API buni qo'llab-quvvatlamaydi,
+            # shuning uchun bot ko'rgan update'lardan yig'ilgan indeksdan olinadi
+            user_id = username_index.get(username)
+            if user_id is not None:
+                return User(id=user_id, first_name=username, is_bot=False, username=username), user_id
+
+            reply(
+                update,
+                f"❌ @{username} topilmadi!\n\n"
+                f"💡 <b>Qanday ishlatiladi:</b>\n"
+                f"• Foydalanuvchi xabariga reply qiling\n"
+                f"• Yoki user ID kiriting: <code>/admin 123456789</code>",
+                parse_mode=ParseMode.HTML
+            )
+            return None, None
 
         return None, None
 
@@ -136,109 +2697,121 @@ async def get_user_from_message(update: Update, context: ContextTypes.DEFAULT_TY
         return None, None
 
 
-async def is_chat_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int = None) -> bool:
-    """Проверка, является ли пользователь администратором Telegram-чата"""
-    try:
-        if user_id is None:
-            user_id = update.effective_user.id
-        member = await context.bot.get_chat_member(update.effective_chat.id, user_id)
-        return member.status in ['creator', 'administrator']
-    except Exception as e:
-        logger.error(f"Ошибка проверки статуса администратора: {e}")
-        return False
+def get_owner():
+    """
+    Owner бота. При шардировании он один на все воркеры: тот, кто первым
+    занял OWNER_FILE; воркер запоминает его в своём хранилище.
+    """
+    owner = storage.get_owner()
+    if owner is None and SHARED_DATA_DIR:
+        try:
+            with open(OWNER_FILE, 'r', encoding='utf-8') as f:
+                owner = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        storage.set_owner(owner)
+    return owner
 
 
-def is_superadmin(user_id: int) -> bool:
-    """Проверка, является ли пользователь суперадмином (только owner)"""
-    owner = superadmins_data.get("owner")
-    return user_id == owner
+def claim_owner(user_id: int) -> bool:
+    """Стать owner'ом, если его ещё нет (O_EXCL: из двух воркеров выиграет один)"""
+    if SHARED_DATA_DIR:
+        try:
+            fd = os.open(OWNER_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(str(user_id))
+    storage.set_owner(user_id)
+    role_index.set_owner(user_id)
+    return True
 
 
-def is_bot_admin(chat_id: int, user_id: int) -> bool:
-    """Проверка, является ли пользователь обычным админом бота в данном чате"""
-    chat_id_str = str(chat_id)
-    return user_id in admins_data.get(chat_id_str, [])
+def parse_duration(arg: str):
+    """
+    Vaqt: 5m / 2h / 1d
+    Returns: (sekundlar, " 5 daqiqaga") yoki None
+    """
+    arg = arg.lower()
+    if len(arg) < 2 or not arg[:-1].isdigit():
+        return None
+    amount = int(arg[:-1])
+    if arg.endswith('m'):
+        return amount * 60, f" {amount} daqiqaga"
+    if arg.endswith('h'):
+        return amount * 3600, f" {amount} soatga"
+    if arg.endswith('d'):
+        return amount * 86400, f" {amount} kunga"
+    return None
+
+
+class UpdateInfo:
+    """
+    Производные значения обновления, общие для всех его обработчиков.
+    Создаётся один раз в prepare_update и лежит в context.info; роли автора
+    и цель команды вычисляются при первом обращении и запоминаются.
+    """
 
+    __slots__ = ("update", "bot", "chat", "user", "chat_id", "user_id", "_roles", "_target")
 
-async def can_full_moderate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Полные права модерации: superadmin или Telegram-админ чата"""
-    user_id = update.effective_user.id
-    if is_superadmin(user_id):
-        return True
-    if await is_chat_admin(update, context, user_id):
-        return True
-    return False
+    def __init__(self, update: Update, bot):
+        self.update = update
+        self.bot = bot
+        self.chat = update.effective_chat
+        self.user = update.effective_user
+        self.chat_id = self.chat.id if self.chat else None
+        self.user_id = self.user.id if self.user else None
+        self._roles = None
+        self._target = None
 
+    async def roles(self) -> int:
+        """Маска ролей автора в чате (RoleIndex); API — только при первой проверке в чате"""
+        if self._roles is None:
+            await role_index.ensure(self.bot, self.chat)
+            self._roles = role_index.get(self.chat_id, self.user_id)
+        return self._roles
 
-async def can_limited_moderate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Ограниченные права: block/mute/delete (включает full moderate)"""
-    if await can_full_moderate(update, context):
-        return True
-    chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
-    if is_bot_admin(chat_id, user_id):
-        return True
-    return False
+    async def can(self, permission: int) -> bool:
+        """Есть ли у автора хотя бы одна из ролей маски permission (CAN_*)"""
+        return bool(await self.roles() & permission)
 
+    async def target(self, context: ContextTypes.DEFAULT_TYPE):
+        """Цель команды (reply, @username или ID): (user, user_id) или (None, None)"""
+        if self._target is None:
+            self._target = await get_user_from_message(self.update, context)
+        return self._target
 
-def collect_stats(update: Update):
-    """Сбор статистики"""
-    if not update.effective_chat or not update.effective_user:
-        return
-    chat_id_str = str(update.effective_chat.id)
-    user_id_str = str(update.effective_user.id)
-    changed = False
-    if chat_id_str not in stats_data["chats"]:
-        stats_data["chats"].append(chat_id_str)
-        changed = True
-    if user_id_str not in stats_data["users"]:
-        stats_data["users"].append(user_id_str)
-        changed = True
-    if changed:
-        save_data(STATS_FILE, stats_data)
-
-
-# ==================== КОМАНДЫ ====================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /start"""
-    try:
-        collect_stats(update)
-        if update.effective_chat.type == "private":
-            if superadmins_data.get("owner") is None:
-                superadmins_data["owner"] = update.effective_user.id
-                save_data(SUPERADMINS_FILE, superadmins_data)
-                await update.message.reply_text(
-                    "👑 <b>Siz botning egasi bo'ldingiz!</b>\n\n"
-                    "📋 <b>Asosiy buyruqlar:</b>\n"
-                    "/admin - admin tayinlash\n"
-                    "/help - barcha buyruqlar\n"
-                    "/statsbot - bot statistikasi",
-                    parse_mode=ParseMode.HTML
-                )
-                return
 
-        welcome_message = (
-            "👋 <b>Salom! Men guruh moderatsiya boti.</b>\n\n"
-            "🔧 <b>Meni qanday ishlatish:</b>\n"
-            "1. Guruhga qo'shing\n"
-            "2. Administrator huquqlarini bering\n"
-            "3. /help - barcha buyruqlar ro'yxati\n\n"
-            "💡 <b>Maxsus imkoniyatlar:</b>\n"
-            "• Avtomatik moderatsiya\n"
-            "• Ogohlantirish tizimi\n"
-            "• Kutish xabarlari\n"
-            "• Va ko'p narsalar!"
-        )
-        await update.message.reply_text(welcome_message, parse_mode=ParseMode.HTML)
-    except Exception as e:
-        logger.error(f"Ошибка в /start: {e}")
+async def prepare_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Предобработка до всех остальных групп: UpdateInfo в context.info и статистика"""
+    info = context.info = UpdateInfo(update, context.bot)
+    if info.chat_id is not None and info.user_id is not None:
+        storage.add_chat(info.chat_id)
+        storage.add_user(info.user_id)
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /help"""
-    try:
-        collect_stats(update)
-        help_text = """
+# ==================== КОМАНДЫ ====================
+# Постоянные тексты собираются один раз при импорте, а не в каждом вызове
+OWNER_TEXT = (
+    "👑 <b>Siz botning egasi bo'ldingiz!</b>\n\n"
+    "📋 <b>Asosiy buyruqlar:</b>\n"
+    "/admin - admin tayinlash\n"
+    "/help - barcha buyruqlar\n"
+    "/statsbot - bot statistikasi"
+)
+START_TEXT = (
+    "👋 <b>Salom! Men guruh moderatsiya boti.</b>\n\n"
+    "🔧 <b>Meni qanday ishlatish:</b>\n"
+    "1. Guruhga qo'shing\n"
+    "2. Administrator huquqlarini bering\n"
+    "3. /help - barcha buyruqlar ro'yxati\n\n"
+    "💡 <b>Maxsus imkoniyatlar:</b>\n"
+    "• Avtomatik moderatsiya\n"
+    "• Ogohlantirish tizimi\n"
+    "• Kutish xabarlari\n"
+    "• Va ko'p narsalar!"
+)
+HELP_TEXT = """
 📚 <b>Bot buyruqlari</b>
 
 <b>🔰 Umumiy:</b>
@@ -250,7 +2823,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /admins — guruh administratorlari ro'yxati
 
 <b>🛡️ Moderatsiya:</b>
-/ban [reply/@user] — bloklash
+/ban [reply/@user] [vaqt] — bloklash (vaqt bilan — vaqtinchalik)
 /unban [reply/@user] — blokdan chiqarish
 /kick [reply/@user] — guruhdan haydash
 /mute [reply/@user] [vaqt] — ovozni o'chirish
@@ -260,15 +2833,24 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /resetwarns [reply/@user] — ogohlantirishlarni tozalash
 /del [reply] — xabarni o'chirish
 /pin [reply] — xabarni pin qilish
+/history [reply/@user/ID] [soni] — moderatsiya tarixi
+/bulkban [ID ID ...] [joined=15m] — ko'pchilikni bloklash
+/bulkkick [ID ID ...] [joined=15m] — ko'pchilikni haydash
+/bulkmute [ID ID ...] [joined=15m] [vaqt] — ko'pchilikning ovozini o'chirish
+/bulkunmute [ID ID ...] — ko'pchilikning ovozini yoqish
 
 <b>👤 Admin boshqaruvi:</b>
 /admin [reply/@user/ID] — admin tayinlash (faqat owner)
 /unadmin [reply/@user/ID] — adminlikdan olish
 /setwelcome [matn] — salomlashuv xabarini o'rnatish
 /setrules [matn] — guruh qoidalarini o'rnatish
+/addkeyword [so'z] [javob] — kalit so'z va avto-javob qo'shish
+/delkeyword [so'z] — kalit so'zni o'chirish
+/keywords — guruh kalit so'zlari
 
 <b>📊 Superadmin uchun:</b>
 /statsbot — bot statistikasi
+/profile [sekund|stop] — botni profillash (cProfile, bot_data/ ga)
 
 <b>💡 Vaqt formati:</b>
 • m = daqiqa (5m)
@@ -281,8 +2863,37 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 <code>/admin 123456789</code>
 <code>/mute 30m</code> (reply bilan)
 <code>/ban @user Spam uchun</code>
+<code>/bulkban joined=10m</code> (so'nggi 10 daqiqada kirganlar)
 """
-        await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
+SET_WELCOME_USAGE = (
+    "ℹ️ <b>Foydalanish:</b> /setwelcome &lt;matn&gt;\n\n"
+    "<b>Maxsus kodlar:</b>\n"
+    "{user} — yangi a'zolar (havola bilan)\n"
+    "{username} — yangi a'zolarning @username'i\n"
+    "{chat} — guruh nomi\n"
+    "{count} — guruhdagi a'zolar soni\n"
+    "{time} — qo'shilgan vaqt\n\n"
+    "<b>Misol:</b>\n"
+    "<code>/setwelcome Xush kelibsiz {user}! {chat} guruhiga qo'shilganingiz bilan!</code>"
+)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start"""
+    try:
+        if update.effective_chat.type == "private":
+            if get_owner() is None and claim_owner(update.effective_user.id):
+                reply(update, OWNER_TEXT, parse_mode=ParseMode.HTML)
+                return
+        reply(update, START_TEXT, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Ошибка в /start: {e}")
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /help"""
+    try:
+        reply(update, HELP_TEXT, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"Ошибка в /help: {e}")
 
@@ -290,31 +2901,26 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /setwelcome"""
     try:
-        collect_stats(update)
-        if not await can_full_moderate(update, context):
-            await update.message.reply_text("❌ Faqat to'liq huquqli adminlar.")
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.")
             return
         if not context.args:
-            await update.message.reply_text(
-                "ℹ️ <b>Foydalanish:</b> /setwelcome <matn>\n\n"
-                "<b>Maxsus kodlar:</b>\n"
-                "{user} — yangi a'zo nomi\n"
-                "{chat} — guruh nomi\n\n"
-                "<b>Misol:</b>\n"
-                "<code>/setwelcome Xush kelibsiz {user}! {chat} guruhiga qo'shilganingiz bilan!</code>",
-                parse_mode=ParseMode.HTML
-            )
+            reply(update, SET_WELCOME_USAGE, parse_mode=ParseMode.HTML)
+            return
+        welcome_text, error = check_html(" ".join(context.args), MAX_MESSAGE_LENGTH - TEMPLATE_HEADER_RESERVE)
+        if error:
+            reply(update, f"❌ <b>Xato:</b> {html.escape(error)}", parse_mode=ParseMode.HTML)
             return
-        chat_id = str(update.effective_chat.id)
-        welcome_text = " ".join(context.args)
-        welcome_data[chat_id] = welcome_text
-        save_data(WELCOME_FILE, welcome_data)
+        storage.set_welcome(info.chat_id, welcome_text)
 
         # Test preview
-        preview = welcome_text.replace("{user}", update.effective_user.mention_html()) \
-            .replace("{chat}", update.effective_chat.title)
+        template = compile_template(welcome_text)
+        count = await get_member_count(context.bot, info.chat_id) if template.uses("count") else None
+        preview = render_template(template, [update.effective_user], update.effective_chat.title, count)
 
-        await update.message.reply_text(
+        reply(
+            update,
             f"✅ <b>Kutish xabari o'rnatildi!</b>\n\n"
             f"<b>Namuna:</b>\n{preview}",
             parse_mode=ParseMode.HTML
@@ -326,20 +2932,15 @@ async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def welcome_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Приветствие новых участников"""
     try:
-        chat_id = str(update.effective_chat.id)
-        collect_stats(update)
-        if chat_id not in welcome_data:
+        members = [m for m in update.message.new_chat_members if not m.is_bot]
+        recent_joins.add(update.effective_chat.id, [m.id for m in members], time.monotonic())
+        welcome_text = storage.get_welcome(update.effective_chat.id)
+        if welcome_text is None:
             return
-        for member in update.message.new_chat_members:
-            if member.is_bot:
-                continue
-            if str(member.id) not in stats_data["users"]:
-                stats_data["users"].append(str(member.id))
-                save_data(STATS_FILE, stats_data)
-            text = welcome_data[chat_id] \
-                .replace("{user}", member.mention_html()) \
-                .replace("{chat}", update.effective_chat.title)
-            await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        for member in members:
+            storage.add_user(member.id)
+        if members:
+            join_batcher.add(context.bot, update.effective_chat, members)
     except Exception as e:
         logger.error(f"Ошибка в welcome: {e}")
 
@@ -347,15 +2948,19 @@ async def welcome_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /rules"""
     try:
-        collect_stats(update)
-        chat_id = str(update.effective_chat.id)
-        if chat_id in rules_data and rules_data[chat_id].strip():
-            await update.message.reply_text(
-                f"📜 <b>Guruh qoidalari:</b>\n\n{rules_data[chat_id]}",
+        rules_text = storage.get_rules(update.effective_chat.id)
+        if rules_text and rules_text.strip():
+            template = compile_template(rules_text)
+            count = await get_member_count(context.bot, update.effective_chat.id) if template.uses("count") else None
+            reply(
+                update,
+                "📜 <b>Guruh qoidalari:</b>\n\n"
+                + render_template(template, [update.effective_user], update.effective_chat.title, count),
                 parse_mode=ParseMode.HTML
             )
         else:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ Guruh qoidalari hali o'rnatilmagan.\n\n"
                 "💡 Adminlar /setrules buyrug'i bilan qoidalar qo'shishi mumkin."
             )
@@ -366,24 +2971,27 @@ async def rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /setrules"""
     try:
-        collect_stats(update)
-        if not await can_full_moderate(update, context):
-            await update.message.reply_text("❌ Faqat to'liq huquqli adminlar.")
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.")
             return
         if not context.args:
-            await update.message.reply_text(
-                "ℹ️ <b>Foydalanish:</b> /setrules <qoidalar>\n\n"
+            reply(
+                update,
+                "ℹ️ <b>Foydalanish:</b> /setrules &lt;qoidalar&gt;\n\n"
                 "<b>Misol:</b>\n"
                 "<code>/setrules 1. Spam qilmang\n2. Hurmat bilan muomala qiling</code>",
                 parse_mode=ParseMode.HTML
             )
             return
-        chat_id = str(update.effective_chat.id)
-        rules_text = " ".join(context.args)
-        rules_data[chat_id] = rules_text
-        save_data(RULES_FILE, rules_data)
+        rules_text, error = check_html(" ".join(context.args), MAX_MESSAGE_LENGTH - TEMPLATE_HEADER_RESERVE)
+        if error:
+            reply(update, f"❌ <b>Xato:</b> {html.escape(error)}", parse_mode=ParseMode.HTML)
+            return
+        storage.set_rules(info.chat_id, rules_text)
 
-        await update.message.reply_text(
+        reply(
+            update,
             f"✅ <b>Guruh qoidalari o'rnatildi!</b>\n\n"
             f"📜 <b>Qoidalar:</b>\n{rules_text}",
             parse_mode=ParseMode.HTML
@@ -396,7 +3004,6 @@ async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admins_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admins - список админов Telegram чата"""
     try:
-        collect_stats(update)
         admins = await context.bot.get_chat_administrators(update.effective_chat.id)
         text = "<b>📋 Guruh administratorlari:</b>\n\n"
         for a in admins:
@@ -405,85 +3012,55 @@ async def admins_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += f"{status}: {a.user.mention_html()} ({username})\n"
 
         text += f"\n<b>Jami:</b> {len(admins)} ta admin"
-        await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+        reply(update, text, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error(f"Ошибка в /admins: {e}")
 
 
 async def make_bot_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /admin - foydalanuvchini guruhda haqiqiy admin qilish
-    (reply, linked @username yoki user ID orqali)"""
+    """Команда /admin - foydalanuvchini guruhda haqiqiy admin qilish (reply/@username/ID)"""
     try:
-        collect_stats(update)
-
-        # Kim ishlatishi mumkin:
-        user_id = update.effective_user.id
-        bot_owner_id = 7294324265  # Sizning ID'ingiz
-
-        if user_id != bot_owner_id and not await is_chat_admin(update, context, user_id):
-            await update.message.reply_text(
-                "❌ Faqat guruh adminlari yoki bot egasi ishlatishi mumkin."
+        info = context.info
+
+        # Kim ishlatishi mumkin: bot egasi yoki guruh adminlari
+        if not await info.can(CAN_MANAGE_ADMINS):
+            reply(
+                update,
+                "❌ Faqat guruh adminlari yoki bot egasi ishlatishi mumkin.",
+                priority=PRIORITY_HIGH
             )
             return
 
-        target_user = None
-        target_id = None
-
-        # 1-usul: reply to message (eng ishonchli)
-        if update.message.reply_to_message and update.message.reply_to_message.from_user:
-            target_user = update.message.reply_to_message.from_user
-            target_id = target_user.id
-
-        # 2-usul: linked mention (@username Telegram avto ko'k link qilgan bo'lsa)
-        elif update.message.entities:
-            for entity in update.message.entities:
-                if entity.type in ["mention", "text_mention"]:
-                    if entity.user:
-                        target_user = entity.user
-                        target_id = target_user.id
-                        break
+        # Foydalanuvchini olish
+        target_user, target_id = await info.target(context)
 
-        # 3-usul: user ID ni to'g'ridan-to'g'ri yozish (/admin 123456789)
-        elif context.args:
-            arg = " ".join(context.args).strip()
-            if arg.startswith('@'):
-                arg = arg[1:]  # @username ni tozalash (agar qo'lda yozilgan bo'lsa)
-            if arg.isdigit():
-                target_id = int(arg)
-                try:
-                    member = await context.bot.get_chat_member(update.effective_chat.id, target_id)
-                    target_user = member.user
-                except:
-                    target_user = None
-
-        # Agar hali ham topilmagan bo'lsa — aniq yo'riqnoma
-        if target_id is None:
-            await update.message.reply_text(
-                "❌ Admin beriladigan foydalanuvchini aniqlab bo'lmadi!\n\n"
-                "✅ Eng ishonchli usullar:\n"
-                "1. Foydalanuvchi xabariga <b>reply</b> qilib /admin yozing\n"
-                "2. /admin <b>123456789</b> — user ID ni yozing\n"
-                "   • ID ni olish uchun: foydalanuvchi xabariga reply qilib <b>/info</b> yozing\n\n"
-                "⚠️ /admin @username faqat Telegram avto <b>ko'k link</b> qilsa ishlaydi\n"
-                "   (ya'ni user guruh a'zosi bo'lib, privacy sozlamalari ruxsat bersa).",
-                parse_mode=ParseMode.HTML
+        if not target_user or not target_id:
+            reply(
+                update,
+                "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
+                "💡 <b>Qanday ishlatiladi:</b>\n"
+                "• Foydalanuvchi xabariga reply qiling\n"
+                "• User ID kiriting: <code>/admin 123456789</code>\n"
+                "• Username: <code>/admin @username</code>",
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        chat_id = update.effective_chat.id
+        chat_id = info.chat_id
 
         # Tekshirish: allaqachon adminmi yoki guruhda emasmi?
         try:
             member = await context.bot.get_chat_member(chat_id, target_id)
             if member.status in ['administrator', 'creator']:
-                await update.message.reply_text("❌ Bu foydalanuvchi allaqachon guruh admini.")
+                reply(update, "❌ Bu foydalanuvchi allaqachon guruh admini.", priority=PRIORITY_HIGH)
                 return
             if member.status in ['left', 'kicked']:
-                await update.message.reply_text("❌ Bu foydalanuvchi guruhda emas yoki banlangan.")
+                reply(update, "❌ Bu foydalanuvchi guruhda emas yoki banlangan.", priority=PRIORITY_HIGH)
                 return
         except Exception as e:
             logger.error(f"Status tekshirishda xato: {e}")
-            await update.message.reply_text("❌ Foydalanuvchi guruhda emas yoki statusini tekshirib bo'lmadi.")
+            reply(update, "❌ Foydalanuvchi guruhda emas yoki statusini tekshirib bo'lmadi.", priority=PRIORITY_HIGH)
             return
 
         # Botning o'z huquqlarini olish (xavfsizlik uchun oshib ketmasin)
@@ -495,54 +3072,63 @@ async def make_bot_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Promote qilish: cheklangan huquqlar + bot huquqlaridan oshmasin
         try:
-            await context.bot.promote_chat_member(
-                chat_id=chat_id,
-                user_id=target_id,
-                is_anonymous=False,
-                can_delete_messages=True,  # majburiy
-                can_restrict_members=True,  # majburiy (ban/mute/kick)
-                can_pin_messages=bot_member.can_pin_messages if bot_member else False,
-                can_change_info=False,
-                can_invite_users=bot_member.can_invite_users if bot_member else False,
-                can_promote_members=False,  # yangi admin o'ziga admin bera olmasin
-                can_manage_chat=False,
-                can_post_messages=False,
-                can_edit_messages=False,
-                can_manage_video_chats=False
-            )
-
-            # Qayta tekshirish
-            await asyncio.sleep(2)
-            new_member = await context.bot.get_chat_member(chat_id, target_id)
+            waiter = pending_confirmations.expect(chat_id, target_id, ADMIN_STATUSES)
+            try:
+                await context.bot.promote_chat_member(
+                    chat_id=chat_id,
+                    user_id=target_id,
+                    is_anonymous=False,
+                    can_delete_messages=True,  # majburiy
+                    can_restrict_members=True,  # majburiy (ban/mute/kick)
+                    can_pin_messages=bot_member.can_pin_messages if bot_member else False,
+                    can_change_info=False,
+                    can_invite_users=bot_member.can_invite_users if bot_member else False,
+                    can_promote_members=False,  # yangi admin o'ziga admin bera olmasin
+                    can_manage_chat=False,
+                    can_post_messages=False,
+                    can_edit_messages=False,
+                    can_manage_video_chats=False
+                )
+                admin_cache.invalidate(chat_id)
+                # Qayta tekshirish: ChatMemberUpdated hodisasini kutamiz
+                confirmed = await confirm_member_status(context.bot, waiter)
+            finally:
+                pending_confirmations.discard(waiter)
 
-            mention = target_user.mention_html() if target_user else f"<code>{target_id}</code>"
+            mention = target_user.mention_html()
 
-            if new_member.status not in ['administrator', 'creator']:
-                await update.message.reply_text(
+            if not confirmed:
+                reply(
+                    update,
                     f"⚠️ {mention} ga adminlik berildi, lekin hali adminlar ro'yxatida ko'rinmayapti.\n\n"
                     f"• 1-2 daqiqa kutib guruhni yangilang\n"
                     f"• Botga 'Add Administrators' huquqi berilganligini tekshiring!",
-                    parse_mode=ParseMode.HTML
+                    parse_mode=ParseMode.HTML,
+                    priority=PRIORITY_HIGH
                 )
             else:
-                await update.message.reply_text(
+                reply(
+                    update,
                     f"✅ {mention} muvaffaqiyatli guruh admini qilindi!\n\n"
                     f"🔓 <b>Berilgan huquqlar:</b>\n"
                     f"• Xabarlarni oʻchirish\n"
                     f"• Foydalanuvchilarni bloklash/mute/kick qilish\n"
                     f"• Pin qilish (agar botga berilgan bo'lsa)\n\n"
                     f"⚠️ Boshqa huquqlar yo'q (admin tayinlash mumkin emas).",
-                    parse_mode=ParseMode.HTML
+                    parse_mode=ParseMode.HTML,
+                    priority=PRIORITY_HIGH
                 )
         except Exception as promote_error:
             logger.error(f"Promote xatosi: {promote_error}")
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ Admin tayinlab bo'lmadi!\n\n"
                 "Eng ko'p uchraydigan sabablar:\n"
                 "• Botga 'Add Administrators' huquqi berilmagan\n"
                 "• Foydalanuvchi guruh a'zosi emas\n\n"
                 "🔄 Botni guruhdan chiqarib, qayta qo'shing va bu huquqni yoqing.",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
     except Exception as e:
         logger.error(f"Ошибка в /admin: {e}")
@@ -551,78 +3137,103 @@ async def make_bot_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def remove_bot_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /unadmin - guruhdan adminlikni olib tashlash (reply/@username/ID)"""
     try:
-        collect_stats(update)
+        info = context.info
 
-        user_id = update.effective_user.id
-
-        if user_id != bot_owner_id and not await is_chat_admin(update, context, user_id):
-            await update.message.reply_text("❌ Faqat guruh adminlari yoki bot egasi ishlatishi mumkin.")
+        if not await info.can(CAN_MANAGE_ADMINS):
+            reply(update, "❌ Faqat guruh adminlari yoki bot egasi ishlatishi mumkin.", priority=PRIORITY_HIGH)
             return
 
         # Foydalanuvchini olish
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
 
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 <b>Qanday ishlatiladi:</b>\n"
                 "• Foydalanuvchi xabariga reply qiling\n"
                 "• User ID kiriting: <code>/unadmin 123456789</code>\n"
                 "• Username: <code>/unadmin @username</code>",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        chat_id = update.effective_chat.id
+        chat_id = info.chat_id
 
         # Tekshirish: target user adminmi?
         try:
             member = await context.bot.get_chat_member(chat_id, target_id)
             if member.status not in ['administrator', 'creator']:
-                await update.message.reply_text(
+                reply(
+                    update,
                     f"❌ {target_user.mention_html()} guruh admini emas.",
-                    parse_mode=ParseMode.HTML
+                    parse_mode=ParseMode.HTML,
+                    priority=PRIORITY_HIGH
                 )
                 return
             if member.status == 'creator':
-                await update.message.reply_text("❌ Guruh egasini adminlikdan olish mumkin emas.")
+                reply(update, "❌ Guruh egasini adminlikdan olish mumkin emas.", priority=PRIORITY_HIGH)
                 return
         except Exception as e:
             logger.error(f"Status tekshirishda xato: {e}")
-            await update.message.reply_text("❌ Foydalanuvchi statusini tekshirib bo'lmadi.")
+            reply(update, "❌ Foydalanuvchi statusini tekshirib bo'lmadi.", priority=PRIORITY_HIGH)
             return
 
-        # Demote qilish
+        # Demote qilish: Bot API'da alohida metod yo'q — barcha huquqlar False bilan promote
         try:
-            await context.bot.demote_chat_member(chat_id=chat_id, user_id=target_id)
-
-            await asyncio.sleep(2)
-            new_member = await context.bot.get_chat_member(chat_id, target_id)
-
-            if new_member.status in ['administrator', 'creator']:
-                await update.message.reply_text(
+            waiter = pending_confirmations.expect(chat_id, target_id, NON_ADMIN_STATUSES)
+            try:
+                await context.bot.promote_chat_member(
+                    chat_id=chat_id,
+                    user_id=target_id,
+                    is_anonymous=False,
+                    can_manage_chat=False,
+                    can_delete_messages=False,
+                    can_manage_video_chats=False,
+                    can_restrict_members=False,
+                    can_promote_members=False,
+                    can_change_info=False,
+                    can_invite_users=False,
+                    can_post_messages=False,
+                    can_edit_messages=False,
+                    can_pin_messages=False
+                )
+                admin_cache.invalidate(chat_id)
+                confirmed = await confirm_member_status(context.bot, waiter)
+            finally:
+                pending_confirmations.discard(waiter)
+
+            if not confirmed:
+                reply(
+                    update,
                     f"⚠️ <b>{target_user.mention_html()} adminligi olib tashlandi</b>, lekin guruh ro'yxatida hali admin ko'rinmoqda.\n\n"
                     f"📌 <b>Sabablar:</b>\n"
                     f"• Telegram kesh — 1-2 daqiqa kutib yangilang\n"
                     f"• Botga 'Add Administrators' huquqi berilmagan\n\n"
                     f"🔄 Botni guruhdan chiqarib, qayta qo'shing va bu huquqni yoqing!",
-                    parse_mode=ParseMode.HTML
+                    parse_mode=ParseMode.HTML,
+                    priority=PRIORITY_HIGH
                 )
             else:
-                await update.message.reply_text(
+                reply(
+                    update,
                     f"✅ <b>{target_user.mention_html()} muvaffaqiyatli adminlikdan olindi!</b>\n\n"
                     f"Endi oddiy a'zo holatida.",
-                    parse_mode=ParseMode.HTML
+                    parse_mode=ParseMode.HTML,
+                    priority=PRIORITY_HIGH
                 )
         except Exception as demote_error:
             logger.error(f"Demote xatosi: {demote_error}")
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Adminlikni olib bo'lmadi!</b>\n\n"
                 "<b>Sabablar:</b>\n"
                 "• Botga 'Add Administrators' huquqi berilmagan\n"
                 "• Botning o'zi admin emas yoki huquqlari cheklangan\n\n"
                 "🔄 Botni guruhdan chiqarib, qayta qo'shing va 'Add Administrators' huquqini yoqing.",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
     except Exception as e:
         logger.error(f"Ошибка в /unadmin: {e}")
@@ -631,110 +3242,182 @@ async def remove_bot_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def stats_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /statsbot"""
     try:
-        collect_stats(update)
-        if not is_superadmin(update.effective_user.id):
-            await update.message.reply_text("❌ Faqat bot egasi.")
+        if not await context.info.can(CAN_SUPERADMIN):
+            reply(update, "❌ Faqat bot egasi.")
+            return
+        if SHARED_DATA_DIR:
+            # Каждый воркер видит только свои чаты — собираем итог по всем шардам
+            chats_count, users_count, total_warnings = await asyncio.get_running_loop().run_in_executor(
+                None, aggregate_shard_stats)
+        else:
+            chats_count = storage.count_chats()
+            users_count = storage.count_users()
+
+            # Warnings statistikasi
+            total_warnings = storage.count_warnings()
+
+        # Navbat (outbox) statistikasi
+        p50, p99, _ = outbox.latency_stats()
+
+        reply(
+            update,
+            f"📊 <b>Bot statistikasi:</b>\n\n"
+            f"👥 <b>Guruhlar:</b> {chats_count}\n"
+            f"🧑‍💼 <b>Foydalanuvchilar:</b> {users_count}\n"
+            f"⚠️ <b>Aktiv ogohlantirishlar:</b> {total_warnings}\n"
+            f"⏰ <b>Rejalashtirilgan amallar:</b> {len(scheduler)}\n\n"
+            f"📤 <b>Navbatda:</b> {outbox.depth()} ta xabar\n"
+            f"⏱ <b>Kutish:</b> p50 {p50:.2f}s / p99 {p99:.2f}s",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в /statsbot: {e}")
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile: cProfile на N секунд, результат — в bot_data/*.prof"""
+    try:
+        if not await context.info.can(CAN_SUPERADMIN):
+            reply(update, "❌ Faqat bot egasi.")
+            return
+
+        if context.args and context.args[0].lower() == "stop":
+            if not profiler.stop():
+                reply(update, "ℹ️ Profillash yoqilmagan.")
+            return
+        if profiler.active:
+            reply(update, "ℹ️ Profillash allaqachon ketmoqda. To'xtatish: /profile stop")
+            return
+
+        try:
+            seconds = float(context.args[0]) if context.args else 30
+        except ValueError:
+            reply(update, "💡 /profile [sekund|stop]")
             return
-        chats_count = len(stats_data["chats"])
-        users_count = len(stats_data["users"])
+        seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
 
-        # Warnings statistikasi
-        total_warnings = sum(len(users) for users in warnings_data.values())
+        bot = context.bot
+        chat_id = update.effective_chat.id
 
-        await update.message.reply_text(
-            f"📊 <b>Bot statistikasi:</b>\n\n"
-            f"👥 <b>Guruhlar:</b> {chats_count}\n"
-            f"🧑‍💼 <b>Foydalanuvchilar:</b> {users_count}\n"
-            f"⚠️ <b>Aktiv ogohlantirishlar:</b> {total_warnings}",
-            parse_mode=ParseMode.HTML
-        )
+        def notify(path: str, summary: str):
+            outbox.submit(
+                chat_id,
+                lambda: bot.send_message(
+                    chat_id,
+                    f"✅ <b>Profil tayyor:</b> <code>{path}</code>\n\n<pre>{html.escape(summary)}</pre>",
+                    parse_mode=ParseMode.HTML
+                )
+            )
+
+        profiler.start(seconds, notify)
+        reply(update, f"⏱ <b>Profillash boshlandi:</b> {seconds:.0f} s", parse_mode=ParseMode.HTML)
     except Exception as e:
-        logger.error(f"Ошибка в /statsbot: {e}")
+        logger.error(f"Ошибка в /profile: {e}")
 
 
 # ==================== МОДЕРАЦИЯ ====================
+FULL_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_audios=True,
+    can_send_documents=True,
+    can_send_photos=True,
+    can_send_videos=True,
+    can_send_video_notes=True,
+    can_send_voice_notes=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=True,
+    can_invite_users=True,
+    can_pin_messages=True
+)
+
+
 async def warn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_full_moderate(update, context):
-            await update.message.reply_text("❌ Faqat to'liq huquqli adminlar.")
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /warn [reply/@user/ID] [sabab]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        chat_id = str(update.effective_chat.id)
-        user_id = str(target_id)
-
         # Agar @username ishlatilgan bo'lsa, context.args[0]ni sabab uchun ishlatmaymiz
         if context.args and context.args[0].startswith('@'):
             reason = " ".join(context.args[1:]) if len(context.args) > 1 else "Sabab ko'rsatilmagan"
         else:
             reason = " ".join(context.args) if context.args else "Sabab ko'rsatilmagan"
 
-        if chat_id not in warnings_data:
-            warnings_data[chat_id] = {}
-        if user_id not in warnings_data[chat_id]:
-            warnings_data[chat_id][user_id] = []
-
-        warnings_data[chat_id][user_id].append({
-            "reason": reason,
-            "date": datetime.now().isoformat(),
-            "by": update.effective_user.id
-        })
-        count = len(warnings_data[chat_id][user_id])
-        save_data(WARNINGS_FILE, warnings_data)
+        issued = time.time()
+        count = storage.add_warning(
+            info.chat_id, target_id,
+            reason=reason,
+            issued=issued,
+            by=info.user_id
+        )
+        audit_log.record(info.chat_id, target_id, info.user_id, "warn", reason)
+        if WARN_EXPIRE_DAYS:
+            scheduler.add(issued + WARN_EXPIRE_DAYS * 86400, "warn_expire",
+                          info.chat_id, target_id, issued)
 
-        await update.message.reply_text(
+        reply(
+            update,
             f"⚠️ <b>{target_user.mention_html()} ogohlantirildi!</b>\n"
             f"📝 <b>Sabab:</b> {reason}\n"
             f"📊 <b>Jami:</b> {count}/3",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
 
         if count >= 3:
-            await context.bot.ban_chat_member(update.effective_chat.id, target_id)
-            await update.message.reply_text(
+            await context.bot.ban_chat_member(info.chat_id, target_id)
+            audit_log.record(info.chat_id, target_id, info.user_id, "ban", "3/3 ogohlantirish")
+            reply(
+                update,
                 f"🔨 <b>{target_user.mention_html()} 3 ogohlantirish uchun bloklandi!</b>",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
-            del warnings_data[chat_id][user_id]
-            save_data(WARNINGS_FILE, warnings_data)
+            storage.clear_warnings(info.chat_id, target_id)
+            scheduler.cancel("warn_expire", info.chat_id, target_id)
     except Exception as e:
         logger.error(f"Ошибка в /warn: {e}")
 
 
 async def warns(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
+        info = context.info
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user and not target_id:
             # Agar reply/username bo'lmasa, o'zi haqida
             target_user = update.effective_user
             target_id = target_user.id
 
-        chat_id = str(update.effective_chat.id)
-        user_id = str(target_id)
-
-        if chat_id in warnings_data and user_id in warnings_data[chat_id]:
+        user_warnings = storage.get_warnings(info.chat_id, target_id)
+        if user_warnings:
             list_text = "\n".join([
-                f"{i}. {w['reason']} ({w['date'][:10]})"
-                for i, w in enumerate(warnings_data[chat_id][user_id], 1)
+                f"{i}. {w.reason} ({datetime.fromtimestamp(w.issued):%Y-%m-%d})"
+                for i, w in enumerate(user_warnings, 1)
             ])
-            await update.message.reply_text(
+            reply(
+                update,
                 f"⚠️ <b>{target_user.mention_html()} ogohlantirishlari:</b>\n\n{list_text}\n\n"
-                f"📊 <b>Jami:</b> {len(warnings_data[chat_id][user_id])}/3",
+                f"📊 <b>Jami:</b> {len(user_warnings)}/3",
                 parse_mode=ParseMode.HTML
             )
         else:
-            await update.message.reply_text(
+            reply(
+                update,
                 f"✅ {target_user.mention_html()} ogohlantirishlari yo'q.",
                 parse_mode=ParseMode.HTML
             )
@@ -744,36 +3427,39 @@ async def warns(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def reset_warns(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_full_moderate(update, context):
-            await update.message.reply_text("❌ Faqat to'liq huquqli adminlar.")
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /resetwarns [reply/@user/ID]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        chat_id = str(update.effective_chat.id)
-        user_id = str(target_id)
-
-        if chat_id in warnings_data and user_id in warnings_data[chat_id]:
-            count = len(warnings_data[chat_id][user_id])
-            del warnings_data[chat_id][user_id]
-            save_data(WARNINGS_FILE, warnings_data)
-            await update.message.reply_text(
+        count = storage.clear_warnings(info.chat_id, target_id)
+        scheduler.cancel("warn_expire", info.chat_id, target_id)
+        if count:
+            audit_log.record(info.chat_id, target_id, info.user_id, "resetwarns", f"{count} ta")
+            reply(
+                update,
                 f"✅ <b>{target_user.mention_html()} ogohlantirishlari tozalandi!</b>\n"
                 f"Tozalangan: {count} ta ogohlantirish",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
         else:
-            await update.message.reply_text(
+            reply(
+                update,
                 f"❌ {target_user.mention_html()} ogohlantirishlari yo'q.",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
     except Exception as e:
         logger.error(f"Ошибка в /resetwarns: {e}")
@@ -781,30 +3467,42 @@ async def reset_warns(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
-                "💡 /ban [reply/@user/ID] [sabab]",
-                parse_mode=ParseMode.HTML
+                "💡 /ban [reply/@user/ID] [1d] [sabab]",
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        if context.args and context.args[0].startswith('@'):
-            reason = " ".join(context.args[1:]) if len(context.args) > 1 else "Sabab ko'rsatilmagan"
-        else:
-            reason = " ".join(context.args) if context.args else "Sabab ko'rsatilmagan"
-
-        await context.bot.ban_chat_member(update.effective_chat.id, target_id)
-        await update.message.reply_text(
-            f"🔨 <b>{target_user.mention_html()} bloklandi!</b>\n"
+        # Reply bo'lmasa, birinchi argument — @user yoki ID, sababga kirmaydi
+        reason_args = (context.args or [])[0 if update.message.reply_to_message else 1:]
+        # Vaqtinchalik blok: /ban @user 1d sabab
+        duration = parse_duration(reason_args[0]) if reason_args else None
+        if duration:
+            reason_args = reason_args[1:]
+        reason = " ".join(reason_args) if reason_args else "Sabab ko'rsatilmagan"
+
+        chat_id = info.chat_id
+        until_date = int(time.time()) + duration[0] if duration else None
+        await context.bot.ban_chat_member(chat_id, target_id, until_date=until_date)
+        audit_log.record(chat_id, target_id, info.user_id, "ban",
+                         f"{duration[1].strip()}: {reason}" if duration else reason)
+        schedule_lift("unban", chat_id, target_id, until_date, target_user.mention_html())
+        reply(
+            update,
+            f"🔨 <b>{target_user.mention_html()}{duration[1] if duration else ''} bloklandi!</b>\n"
             f"📝 <b>Sabab:</b> {reason}",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
     except Exception as e:
         logger.error(f"Ошибка в /ban: {e}")
@@ -812,24 +3510,30 @@ async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /unban [reply/@user/ID]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        await context.bot.unban_chat_member(update.effective_chat.id, target_id)
-        await update.message.reply_text(
+        await context.bot.unban_chat_member(info.chat_id, target_id)
+        audit_log.record(info.chat_id, target_id, info.user_id, "unban")
+        schedule_lift("unban", info.chat_id, target_id)
+        reply(
+            update,
             f"✅ <b>{target_user.mention_html()} blokdan chiqarildi!</b>",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
     except Exception as e:
         logger.error(f"Ошибка в /unban: {e}")
@@ -837,25 +3541,30 @@ async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /kick [reply/@user/ID]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        await context.bot.ban_chat_member(update.effective_chat.id, target_id)
-        await context.bot.unban_chat_member(update.effective_chat.id, target_id)
-        await update.message.reply_text(
+        await context.bot.ban_chat_member(info.chat_id, target_id)
+        await context.bot.unban_chat_member(info.chat_id, target_id)
+        audit_log.record(info.chat_id, target_id, info.user_id, "kick")
+        reply(
+            update,
             f"👞 <b>{target_user.mention_html()} guruhdan haydaldi!</b>",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
     except Exception as e:
         logger.error(f"Ошибка в /kick: {e}")
@@ -863,17 +3572,19 @@ async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /mute [reply/@user/ID] [5m/2h/1d]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
@@ -889,34 +3600,27 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 time_arg = context.args[0]
 
         if time_arg:
-            arg = time_arg.lower()
-            now_utc = datetime.now(timezone.utc)
-            if arg.endswith('m'):
-                mins = int(arg[:-1])
-                until_date = int((now_utc + timedelta(minutes=mins)).timestamp())
-                time_str = f" {mins} daqiqaga"
-            elif arg.endswith('h'):
-                hours = int(arg[:-1])
-                until_date = int((now_utc + timedelta(hours=hours)).timestamp())
-                time_str = f" {hours} soatga"
-            elif arg.endswith('d'):
-                days = int(arg[:-1])
-                until_date = int((now_utc + timedelta(days=days)).timestamp())
-                time_str = f" {days} kunga"
-            else:
-                await update.message.reply_text("❌ Vaqt formati noto'g'ri (m/h/d).")
+            duration = parse_duration(time_arg)
+            if duration is None:
+                reply(update, "❌ Vaqt formati noto'g'ri (m/h/d).", priority=PRIORITY_HIGH)
                 return
+            seconds, time_str = duration
+            until_date = int(time.time()) + seconds
 
         permissions = ChatPermissions(can_send_messages=False)
         await context.bot.restrict_chat_member(
-            update.effective_chat.id,
+            info.chat_id,
             target_id,
             permissions=permissions,
             until_date=until_date
         )
-        await update.message.reply_text(
+        audit_log.record(info.chat_id, target_id, info.user_id, "mute", time_str.strip())
+        schedule_lift("unmute", info.chat_id, target_id, until_date, target_user.mention_html())
+        reply(
+            update,
             f"🔇 <b>{target_user.mention_html()}{time_str} ovozi o'chirildi!</b>",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
     except Exception as e:
         logger.error(f"Ошибка в /mute: {e}")
@@ -924,43 +3628,34 @@ async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user or not target_id:
-            await update.message.reply_text(
+            reply(
+                update,
                 "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
                 "💡 /unmute [reply/@user/ID]",
-                parse_mode=ParseMode.HTML
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
             )
             return
 
-        full_perms = ChatPermissions(
-            can_send_messages=True,
-            can_send_audios=True,
-            can_send_documents=True,
-            can_send_photos=True,
-            can_send_videos=True,
-            can_send_video_notes=True,
-            can_send_voice_notes=True,
-            can_send_polls=True,
-            can_send_other_messages=True,
-            can_add_web_page_previews=True,
-            can_change_info=True,
-            can_invite_users=True,
-            can_pin_messages=True
-        )
         await context.bot.restrict_chat_member(
-            update.effective_chat.id,
+            info.chat_id,
             target_id,
-            permissions=full_perms
+            permissions=FULL_PERMISSIONS
         )
-        await update.message.reply_text(
+        audit_log.record(info.chat_id, target_id, info.user_id, "unmute")
+        schedule_lift("unmute", info.chat_id, target_id)
+        reply(
+            update,
             f"🔊 <b>{target_user.mention_html()} ovozi yoqildi!</b>",
-            parse_mode=ParseMode.HTML
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
         )
     except Exception as e:
         logger.error(f"Ошибка в /unmute: {e}")
@@ -968,14 +3663,18 @@ async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_limited_moderate(update, context):
-            await update.message.reply_text("❌ Faqat adminlar.")
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
             return
         if not update.message.reply_to_message:
-            await update.message.reply_text("❌ O'chiriladigan xabarga reply qiling.")
+            reply(update, "❌ O'chiriladigan xabarga reply qiling.", priority=PRIORITY_HIGH)
             return
-        await update.message.reply_to_message.delete()
+        deleted = update.message.reply_to_message
+        await deleted.delete()
+        if deleted.from_user:
+            audit_log.record(info.chat_id, deleted.from_user.id, info.user_id, "del",
+                             deleted.text or deleted.caption or "")
         # Buyruq xabarini ham o'chirish
         await update.message.delete()
     except Exception as e:
@@ -984,34 +3683,278 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def pin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        if not await can_full_moderate(update, context):
-            await update.message.reply_text("❌ Faqat to'liq huquqli adminlar.")
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.", priority=PRIORITY_HIGH)
             return
         if not update.message.reply_to_message:
-            await update.message.reply_text("❌ Pin qilinadigan xabarga reply qiling.")
+            reply(update, "❌ Pin qilinadigan xabarga reply qiling.", priority=PRIORITY_HIGH)
             return
         await context.bot.pin_chat_message(
-            update.effective_chat.id,
+            info.chat_id,
             update.message.reply_to_message.message_id,
             disable_notification=True
         )
-        await update.message.reply_text("📌 Xabar pin qilindi!")
+        reply(update, "📌 Xabar pin qilindi!", priority=PRIORITY_HIGH)
     except Exception as e:
         logger.error(f"Ошибка в /pin: {e}")
 
 
-# ==================== ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ====================
-async def check_keywords_and_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка @admins и ключевых слов (donat, donater, garant)"""
+AUDIT_ACTIONS = {
+    "warn": "⚠️ Ogohlantirish",
+    "resetwarns": "♻️ Ogohlantirishlar tozalandi",
+    "ban": "🔨 Blok",
+    "unban": "✅ Blokdan chiqarildi",
+    "kick": "👞 Haydaldi",
+    "mute": "🔇 Ovozi o'chirildi",
+    "unmute": "🔊 Ovozi yoqildi",
+    "del": "🗑 Xabari o'chirildi",
+}
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /history: последние действия модерации по пользователю или по всему чату"""
     try:
-        if not update.message.text:
+        info = context.info
+        if not await info.can(CAN_LIMITED_MODERATE):
+            reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
+            return
+
+        # Oxirgi argument — yozuvlar soni (ID lar bundan ancha katta)
+        limit = AUDIT_HISTORY_DEFAULT
+        if context.args and context.args[-1].isdigit() and int(context.args[-1]) <= AUDIT_HISTORY_MAX:
+            limit = max(1, int(context.args.pop()))
+
+        target_user, target_id = None, None
+        if update.message.reply_to_message or context.args:
+            target_user, target_id = await info.target(context)
+            if not target_id:
+                reply(
+                    update,
+                    "❌ <b>Foydalanuvchi topilmadi!</b>\n\n"
+                    "💡 /history [reply/@user/ID] [soni]",
+                    parse_mode=ParseMode.HTML
+                )
+                return
+
+        entries = audit_log.history(info.chat_id, target_id, limit)
+        title = f"{target_user.mention_html()} tarixi" if target_user else "Guruh moderatsiya tarixi"
+        if not entries:
+            reply(update, f"📜 <b>{title}:</b> bo'sh.", parse_mode=ParseMode.HTML)
             return
-        text_lower = update.message.text.lower()
 
-        # Ключевые слова — реклама
-        if any(word in text_lower for word in ["donat", "donater", "garant"]):
-            reply_text = """
+        lines = []
+        for i, (ts, _, user_id, by, action, _, _, detail) in enumerate(entries, 1):
+            line = f"{i}. {AUDIT_ACTIONS.get(action, action)}"
+            if not target_user:
+                line += f" — <code>{user_id}</code>"
+            if detail:
+                line += f": {html.escape(detail)}"
+            author = f"<code>{by}</code>" if by else "🤖"
+            line += f"\n    <i>{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M}, {author}</i>"
+            lines.append(line)
+        reply(update, f"📜 <b>{title}:</b>\n\n" + "\n".join(lines), parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Ошибка в /history: {e}")
+
+
+# ==================== МАССОВАЯ МОДЕРАЦИЯ ====================
+class RecentJoins:
+    """
+    Кто и когда вступил в чат за последние RECENT_JOINS_WINDOW сек — для /bulk... joined=15m.
+    Одно вступление приходит и сообщением new_chat_members, и chat_member-обновлением:
+    на пользователя в чате хранится одна запись с последним временем.
+    """
+
+    def __init__(self):
+        self._chats = OrderedDict()  # chat_id -> OrderedDict[user_id, время] в порядке вступления
+
+    def add(self, chat_id: int, user_ids, now: float):
+        joins = self._chats.get(chat_id)
+        if joins is None:
+            joins = self._chats[chat_id] = OrderedDict()
+            if len(self._chats) > RECENT_JOINS_CHATS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        for user_id in user_ids:
+            joins.pop(user_id, None)
+            joins[user_id] = now
+        while joins and (len(joins) > BULK_MAX_TARGETS or now - next(iter(joins.values())) > RECENT_JOINS_WINDOW):
+            joins.popitem(last=False)
+
+    def since(self, chat_id: int, seconds: float, now: float):
+        joins = self._chats.get(chat_id, {})
+        return [user_id for user_id, joined in joins.items() if now - joined <= seconds]
+
+
+recent_joins = RecentJoins()
+
+
+def parse_bulk_targets(update: Update, context: ContextTypes.DEFAULT_TYPE, allow_duration: bool = False):
+    """
+    Цели массовой команды: reply, ID и @username через пробел и joined=15m (вступившие за 15 минут).
+    Returns: (список ID, длительность или None, нераспознанные аргументы)
+    """
+    targets = []
+    duration = None
+    unknown = []
+    if update.message.reply_to_message:
+        targets.append(update.message.reply_to_message.from_user.id)
+    for arg in context.args or []:
+        if arg.lstrip('-').isdigit():
+            targets.append(int(arg))
+        elif arg.startswith('@') and username_index.get(arg) is not None:
+            targets.append(username_index.get(arg))
+        elif arg.lower().startswith('joined='):
+            window = parse_duration(arg[7:])
+            if window is None:
+                unknown.append(arg)
+            else:
+                targets.extend(recent_joins.since(update.effective_chat.id, window[0], time.monotonic()))
+        elif allow_duration and duration is None and parse_duration(arg) is not None:
+            duration = parse_duration(arg)
+        else:
+            unknown.append(arg)
+    return list(dict.fromkeys(targets)), duration, unknown
+
+
+async def run_bulk(user_ids, action):
+    """
+    Выполнить action(user_id) для всех целей, не больше BULK_CONCURRENCY запросов сразу;
+    RetryAfter от Telegram — подождать и повторить. Returns: (успешно, с ошибкой)
+    """
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def run_one(user_id):
+        async with semaphore:
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                try:
+                    await action(user_id)
+                    return True
+                except RetryAfter as e:
+                    if attempt == SEND_MAX_RETRIES:
+                        break
+                    delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                    await asyncio.sleep(delay)
+                except Exception as e:
+                    logger.error(f"Массовая модерация, {user_id}: {e}")
+                    return False
+            return False
+
+    results = await asyncio.gather(*(run_one(user_id) for user_id in user_ids))
+    done = sum(results)
+    return done, len(results) - done
+
+
+async def bulk_moderate(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str):
+    """Общая часть /bulkban, /bulkkick, /bulkmute, /bulkunmute: одна проверка прав и один итог"""
+    info = context.info
+    if not await info.can(CAN_LIMITED_MODERATE):
+        reply(update, "❌ Faqat adminlar.", priority=PRIORITY_HIGH)
+        return
+
+    targets, duration, unknown = parse_bulk_targets(update, context, allow_duration=command == "bulkmute")
+    if unknown:
+        reply(update, f"❌ Tushunarsiz: {' '.join(unknown)}", priority=PRIORITY_HIGH)
+        return
+
+    chat_id = info.chat_id
+    # Админов, владельца, самого бота и автора команды не трогаем
+    protected = {user_id for user_id in targets if role_index.get(chat_id, user_id) & PROTECTED_ROLES}
+    protected.update((context.bot.id, info.user_id))
+    skipped = sum(1 for user_id in targets if user_id in protected)
+    targets = [user_id for user_id in targets if user_id not in protected]
+
+    if not targets:
+        reply(
+            update,
+            "❌ <b>Foydalanuvchilar topilmadi!</b>\n\n"
+            f"💡 /{command} [reply] [ID ID ...] [joined=15m]"
+            + (" [5m/2h/1d]" if command == "bulkmute" else ""),
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
+        )
+        return
+    if len(targets) > BULK_MAX_TARGETS:
+        reply(update, f"❌ Bir martada {BULK_MAX_TARGETS} tadan ko'p emas.", priority=PRIORITY_HIGH)
+        return
+
+    bot = context.bot
+    if command == "bulkban":
+        async def action(user_id):
+            await bot.ban_chat_member(chat_id, user_id)
+            audit_log.record(chat_id, user_id, info.user_id, "ban", "/bulkban")
+            schedule_lift("unban", chat_id, user_id)
+        title = "🔨 Bloklandi"
+    elif command == "bulkkick":
+        async def action(user_id):
+            await bot.ban_chat_member(chat_id, user_id)
+            await bot.unban_chat_member(chat_id, user_id)
+            audit_log.record(chat_id, user_id, info.user_id, "kick", "/bulkkick")
+        title = "👞 Guruhdan haydaldi"
+    elif command == "bulkmute":
+        until_date = int(time.time()) + duration[0] if duration else None
+
+        async def action(user_id):
+            await bot.restrict_chat_member(
+                chat_id, user_id, permissions=ChatPermissions(can_send_messages=False), until_date=until_date
+            )
+            audit_log.record(chat_id, user_id, info.user_id, "mute",
+                             f"/bulkmute {duration[1].strip() if duration else 'doimiy'}")
+            mention = f'<a href="tg://user?id={user_id}">{user_id}</a>'
+            schedule_lift("unmute", chat_id, user_id, until_date, mention)
+        title = f"🔇{duration[1] if duration else ' doimiy'} ovozi o'chirildi"
+    else:
+        async def action(user_id):
+            await bot.restrict_chat_member(chat_id, user_id, permissions=FULL_PERMISSIONS)
+            audit_log.record(chat_id, user_id, info.user_id, "unmute", "/bulkunmute")
+            schedule_lift("unmute", chat_id, user_id)
+        title = "🔊 Ovozi yoqildi"
+
+    done, failed = await run_bulk(targets, action)
+    summary = f"<b>{title}:</b> {done} ta"
+    if failed:
+        summary += f"\n❗ <b>Xato:</b> {failed} ta"
+    if skipped:
+        summary += f"\n🛡 <b>O'tkazib yuborildi (adminlar):</b> {skipped} ta"
+    reply(update, summary, parse_mode=ParseMode.HTML, priority=PRIORITY_HIGH)
+
+
+async def bulk_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /bulkban"""
+    try:
+        await bulk_moderate(update, context, "bulkban")
+    except Exception as e:
+        logger.error(f"Ошибка в /bulkban: {e}")
+
+
+async def bulk_kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /bulkkick"""
+    try:
+        await bulk_moderate(update, context, "bulkkick")
+    except Exception as e:
+        logger.error(f"Ошибка в /bulkkick: {e}")
+
+
+async def bulk_mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /bulkmute"""
+    try:
+        await bulk_moderate(update, context, "bulkmute")
+    except Exception as e:
+        logger.error(f"Ошибка в /bulkmute: {e}")
+
+
+async def bulk_unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /bulkunmute"""
+    try:
+        await bulk_moderate(update, context, "bulkunmute")
+    except Exception as e:
+        logger.error(f"Ошибка в /bulkunmute: {e}")
+
+
+# ==================== КЛЮЧЕВЫЕ СЛОВА ====================
+DEFAULT_KEYWORD_REPLY = """
 🔥 <b>Eng ishonchli MLBB akkaunt savdo joyi!</b> 🔥
 
 💎 Donatli, garantli va premium akkauntlar mavjud
@@ -1022,21 +3965,513 @@ async def check_keywords_and_admins(update: Update, context: ContextTypes.DEFAUL
 Xavfsiz savdo, minglab ijobiy fikrlar! 🚀
 Bog'laning va o'z orzuingizdagi akkauntni oling 😎
             """
-            await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
+DEFAULT_KEYWORDS = {
+    "donat": DEFAULT_KEYWORD_REPLY,
+    "donater": DEFAULT_KEYWORD_REPLY,
+    "garant": DEFAULT_KEYWORD_REPLY,
+}
+ADMINS_TRIGGER = "@admins"
+
+
+def _trie_pattern(words) -> str:
+    """
+    Регулярное выражение в виде префиксного дерева: общие префиксы
+    записываются один раз, поэтому на каждой позиции текста проверяется
+    не больше ветвей, чем символов в алфавите, а не все слова подряд.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def render(node) -> str:
+        branches = [re.escape(ch) + render(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            # Слово может закончиться здесь; жадный ? предпочитает более длинное совпадение
+            return ("(?:" + body + ")?") if len(branches) == 1 else body + "?"
+        return body
+
+    return render(trie)
+
+
+class KeywordEngine:
+    """
+    Все ключевые слова чата (и @admins) ищутся за один проход скомпилированным regex.
+    Поиск — в lookahead, поэтому совпадения перекрываются: на каждой позиции
+    находится самое длинное слово, а слова-префиксы этого слова берутся из
+    prefixes. Так находятся и вложенные слова ("ant" в "garant").
+    """
+
+    def __init__(self, keywords: dict):
+        self.keywords = {k.lower(): v for k, v in keywords.items()}
+        words = set(self.keywords) | {ADMINS_TRIGGER}
+        self.pattern = re.compile("(?=(" + _trie_pattern(words) + "))", re.IGNORECASE)
+        # Слово -> все слова, которые являются его префиксами (включая само слово), от коротких к длинным
+        self.prefixes = {
+            word: [word[:i] for i in range(1, len(word) + 1) if word[:i] in words]
+            for word in words
+        }
+
+    def match(self, text: str):
+        """Returns: (уникальные ответы в порядке появления, был ли вызов @admins)"""
+        replies = []
+        admins_called = False
+        for m in self.pattern.finditer(text):
+            found = m.group(1)
+            for word in self.prefixes.get(found.lower(), ()):
+                if word == ADMINS_TRIGGER:
+                    # Как и раньше, @admins — с учётом регистра
+                    admins_called = admins_called or found.startswith(ADMINS_TRIGGER)
+                    continue
+                reply = self.keywords.get(word)
+                if reply is not None and reply not in replies:
+                    replies.append(reply)
+        return replies, admins_called
+
+
+_default_keyword_engine = KeywordEngine(DEFAULT_KEYWORDS)
+_keyword_engines = {}
+
+
+def get_keyword_engine(chat_id: int) -> KeywordEngine:
+    """Движок чата собирается один раз и пересобирается только после изменения его слов"""
+    engine = _keyword_engines.get(chat_id)
+    if engine is None:
+        custom = storage.get_keywords(chat_id)
+        engine = KeywordEngine({**DEFAULT_KEYWORDS, **custom}) if custom else _default_keyword_engine
+        _keyword_engines[chat_id] = engine
+    return engine
+
+
+async def add_keyword(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /addkeyword"""
+    try:
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.")
+            return
+        if len(context.args) < 2:
+            reply(
+                update,
+                "ℹ️ <b>Foydalanish:</b> /addkeyword <so'z> <javob>\n\n"
+                "<b>Misol:</b>\n"
+                "<code>/addkeyword narx Narxlar: @admin ga yozing</code>",
+                parse_mode=ParseMode.HTML
+            )
+            return
+        keyword = context.args[0].lower()
+        if len(keyword) > MAX_KEYWORD_LENGTH or keyword == ADMINS_TRIGGER:
+            reply(update, "❌ Bu kalit so'zni qo'shib bo'lmaydi.")
+            return
+        chat_keywords = storage.get_keywords(info.chat_id)
+        if keyword not in chat_keywords and len(chat_keywords) >= MAX_KEYWORDS_PER_CHAT:
+            reply(update, f"❌ Kalit so'zlar soni {MAX_KEYWORDS_PER_CHAT} tadan oshmasligi kerak.")
+            return
+        storage.set_keyword(info.chat_id, keyword, " ".join(context.args[1:]))
+        _keyword_engines.pop(info.chat_id, None)
+        reply(
+            update,
+            f"✅ <b>Kalit so'z qo'shildi:</b> <code>{keyword}</code>",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в /addkeyword: {e}")
+
+
+async def del_keyword(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /delkeyword"""
+    try:
+        info = context.info
+        if not await info.can(CAN_FULL_MODERATE):
+            reply(update, "❌ Faqat to'liq huquqli adminlar.")
+            return
+        if not context.args:
+            reply(update, "ℹ️ <b>Foydalanish:</b> /delkeyword <so'z>", parse_mode=ParseMode.HTML)
+            return
+        keyword = context.args[0].lower()
+        if not storage.delete_keyword(info.chat_id, keyword):
+            reply(update, "❌ Bunday kalit so'z topilmadi.")
+            return
+        _keyword_engines.pop(info.chat_id, None)
+        reply(
+            update,
+            f"✅ <b>Kalit so'z o'chirildi:</b> <code>{keyword}</code>",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в /delkeyword: {e}")
+
+
+async def list_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /keywords"""
+    try:
+        chat_keywords = storage.get_keywords(update.effective_chat.id)
+        if not chat_keywords:
+            reply(update, "ℹ️ Guruhda qo'shimcha kalit so'zlar yo'q.")
+            return
+        list_text = "\n".join(f"• <code>{k}</code>" for k in sorted(chat_keywords))
+        reply(
+            update,
+            f"🔑 <b>Guruh kalit so'zlari:</b>\n\n{list_text}\n\n"
+            f"<b>Jami:</b> {len(chat_keywords)} ta",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в /keywords: {e}")
+
+
+# ==================== АНТИ-ФЛУД ====================
+class FloodDetector:
+    """
+    Скользящие окна на пользователя в чате и на чат. Окно — deque фиксированной
+    длины (лимит), поэтому проверка — O(1): превышение, если самое старое из
+    последних N сообщений моложе окна. Давно молчащие ключи вытесняются,
+    всего хранится не больше FLOOD_MAX_TRACKED окон.
+    """
+
+    def __init__(self):
+        self._users = OrderedDict()  # (chat_id, user_id) -> deque[время]
+        self._chats = OrderedDict()  # chat_id -> deque[время]
+        self._raid_until = {}
+        self._punished = OrderedDict()  # (chat_id, user_id) -> до какого времени наказан
+
+    @staticmethod
+    def _window(table: OrderedDict, key, maxlen: int, window: float, now: float) -> deque:
+        times = table.get(key)
+        if times is None:
+            times = table[key] = deque(maxlen=maxlen)
+            # Вытесняем тех, кто молчит дольше окна (они в начале — LRU-порядок)
+            while table:
+                oldest = next(iter(table.values()))
+                if len(table) <= FLOOD_MAX_TRACKED and (not oldest or now - oldest[-1] < window):
+                    break
+                table.popitem(last=False)
+        else:
+            table.move_to_end(key)
+        times.append(now)
+        return times
+
+    def in_raid(self, chat_id: int, now: float) -> bool:
+        until = self._raid_until.get(chat_id)
+        if until is not None and until <= now:
+            del self._raid_until[chat_id]
+            return False
+        return until is not None
+
+    def hit(self, chat_id: int, user_id: int, now: float) -> bool:
+        """Учесть сообщение; True — пользователь превысил лимит"""
+        chat_times = self._window(self._chats, chat_id, FLOOD_CHAT_LIMIT, FLOOD_CHAT_WINDOW, now)
+        if len(chat_times) == FLOOD_CHAT_LIMIT and now - chat_times[0] < FLOOD_CHAT_WINDOW:
+            if not self.in_raid(chat_id, now):
+                logger.warning(f"Рейд в чате {chat_id}: лимит флуда снижен на {RAID_DURATION} сек")
+            self._raid_until[chat_id] = now + RAID_DURATION
+
+        limit = max(2, FLOOD_USER_LIMIT // 2) if self.in_raid(chat_id, now) else FLOOD_USER_LIMIT
+        user_times = self._window(self._users, (chat_id, user_id), FLOOD_USER_LIMIT, FLOOD_USER_WINDOW, now)
+        return len(user_times) >= limit and now - user_times[-limit] < FLOOD_USER_WINDOW
+
+    def punish(self, chat_id: int, user_id: int, now: float) -> bool:
+        """Отметить наказание; False — пользователь уже наказан (повторно не трогаем)"""
+        key = (chat_id, user_id)
+        while self._punished:
+            oldest_key, until = next(iter(self._punished.items()))
+            if until > now:
+                break
+            del self._punished[oldest_key]
+        if key in self._punished:
+            return False
+        self._punished[key] = now + FLOOD_MUTE_SECONDS
+        return True
+
+
+flood_detector = FloodDetector()
+
+
+async def check_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Анти-флуд для всех сообщений групп; сообщения флудера дальше не обрабатываются"""
+    flooding = False
+    try:
+        # Анонимные админы и посты каналов приходят от общего служебного
+        # пользователя — в одно окно их не сводим и не ограничиваем
+        if update.message.sender_chat:
+            return
+        chat_id = update.effective_chat.id
+        user_id = update.effective_user.id
+        now = time.monotonic()
+        if not flood_detector.hit(chat_id, user_id, now):
+            return
+        if await context.info.can(CAN_LIMITED_MODERATE):
+            return
+        flooding = True
+        if flood_detector.punish(chat_id, user_id, now):
+            await context.bot.restrict_chat_member(
+                chat_id,
+                user_id,
+                permissions=ChatPermissions(can_send_messages=False),
+                until_date=int(time.time()) + FLOOD_MUTE_SECONDS
+            )
+            audit_log.record(chat_id, user_id, 0, "mute", f"flood, {FLOOD_MUTE_SECONDS // 60} daqiqaga")
+            reply(
+                update,
+                f"🔇 <b>{update.effective_user.mention_html()} flood uchun "
+                f"{FLOOD_MUTE_SECONDS // 60} daqiqaga ovozi o'chirildi!</b>",
+                parse_mode=ParseMode.HTML,
+                priority=PRIORITY_HIGH
+            )
+    except Exception as e:
+        logger.error(f"Ошибка в check_flood: {e}")
+    if flooding:
+        raise ApplicationHandlerStop
+
+
+# ==================== АНТИ-СПАМ ====================
+_SPAM_INVISIBLE = dict.fromkeys(map(ord, '\u200b\u200c\u200d\u200e\u200f\u2060\ufeff\u00ad'))
+_SPAM_LINK_RE = re.compile(r'(?:https?://|www\.|t\.me/|@)\S+')
+_SPAM_DIGITS_RE = re.compile(r'\d+')
+_SPAM_SEPARATORS_RE = re.compile(r'[\W_]+')
+_MINHASH_EMPTY = (1 << 64) - 1
+
+
+def normalize_text(text: str) -> str:
+    """Текст без регистра, невидимых символов, ссылок, чисел и пунктуации — устойчив к мелким правкам"""
+    text = _SPAM_LINK_RE.sub(' ', text.translate(_SPAM_INVISIBLE).casefold())
+    text = _SPAM_DIGITS_RE.sub('0', text)
+    return _SPAM_SEPARATORS_RE.sub(' ', text).strip()
+
+
+def stable_hash(text: str) -> int:
+    """64-битный хэш, одинаковый в любом процессе (встроенный hash() строк солится при запуске)"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def minhash(words) -> tuple:
+    """
+    MinHash по множеству пар соседних слов с одной хэш-функцией: хэш пары выбирает корзину
+    (SPAM_MINHASH_BINS штук), в корзине остаётся минимум. Пустые корзины берут
+    значение ближайшей непустой справа со сдвигом, так что сходство двух текстов —
+    просто доля совпавших корзин (оценка сходства по Жаккару).
+    """
+    bins = [_MINHASH_EMPTY] * SPAM_MINHASH_BINS
+    for pair in set(zip(words, words[1:])):
+        h = stable_hash(" ".join(pair))
+        index = h % SPAM_MINHASH_BINS
+        value = h // SPAM_MINHASH_BINS
+        if value < bins[index]:
+            bins[index] = value
+    if _MINHASH_EMPTY not in bins:
+        return tuple(bins)
+    signature = []
+    for i, value in enumerate(bins):
+        shift = 0
+        while value == _MINHASH_EMPTY:
+            shift += 1
+            value = bins[(i + shift) % SPAM_MINHASH_BINS]
+        signature.append(value + shift)
+    return tuple(signature)
+
+
+def minhash_similarity(a: tuple, b: tuple) -> float:
+    return sum(map(int.__eq__, a, b)) / SPAM_MINHASH_BINS
+
+
+def minhash_bands(signature: tuple):
+    """Ключи LSH: тройки соседних корзин; похожие тексты почти наверняка совпадут хотя бы в одной"""
+    for i in range(0, SPAM_MINHASH_BINS, SPAM_MINHASH_BAND):
+        yield i, signature[i:i + SPAM_MINHASH_BAND]
+
+
+class _SpamRecord:
+    __slots__ = ('signature', 'keys', 'chats', 'last_seen')
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.keys = []
+        self.chats = {}  # chat_id -> [повторов в окне, последний раз]
+        self.last_seen = 0.0
+
+
+class SpamIndex:
+    """
+    Отпечатки недавних сообщений. Точный повтор находится по хэшу нормализованного
+    текста, похожий — по MinHash: кандидаты берутся из словаря полос (LSH) и
+    сверяются по доле совпавших корзин. Записи живут SPAM_WINDOW сек в LRU
+    не больше SPAM_MAX_TRACKED; общие для всех чатов, повторы считаются по чатам.
+    При шардировании индекс у каждого воркера свой: рассылка по чатам разных
+    шардов ловится, только если в одном шарде набралось SPAM_GLOBAL_CHATS чатов.
+    """
+
+    def __init__(self):
+        self._records = OrderedDict()  # id(record) -> record, от давних к свежим
+        self._exact = {}  # хэш нормализованного текста -> record
+        self._bands = {}  # (полоса, значения) -> [record]
+
+    def __len__(self):
+        return len(self._records)
+
+    def _find_similar(self, signature: tuple):
+        checked = set()
+        for band in minhash_bands(signature):
+            # Свежие записи в конце; длинные корзины (частые слова) смотрим не целиком
+            for record in reversed(self._bands.get(band, ())[-SPAM_BAND_SCAN:]):
+                if id(record) in checked:
+                    continue
+                if minhash_similarity(record.signature, signature) >= SPAM_SIMILARITY:
+                    return record
+                checked.add(id(record))
+        return None
+
+    def _add(self, record: _SpamRecord):
+        self._records[id(record)] = record
+        if record.signature is not None:
+            for band in minhash_bands(record.signature):
+                self._bands.setdefault(band, []).append(record)
+
+    def _remove(self, record: _SpamRecord):
+        del self._records[id(record)]
+        for key in record.keys:
+            del self._exact[key]
+        if record.signature is not None:
+            for band in minhash_bands(record.signature):
+                bucket = self._bands[band]
+                bucket.remove(record)
+                if not bucket:
+                    del self._bands[band]
+
+    def _expire(self, now: float):
+        while self._records:
+            oldest = next(iter(self._records.values()))
+            if len(self._records) < SPAM_MAX_TRACKED and now - oldest.last_seen < SPAM_WINDOW:
+                break
+            self._remove(oldest)
+
+    def check(self, chat_id: int, text: str, now: float):
+        """
+        Учесть сообщение. Возвращает (повторов в этом чате, чатов с этим текстом)
+        или None, если текст слишком короткий для отпечатка.
+        """
+        normalized = normalize_text(text)
+        if len(normalized) < SPAM_MIN_LENGTH:
+            return None
+        key = stable_hash(normalized)
+        record = self._exact.get(key)
+        if record is None:
+            words = normalized.split()
+            signature = minhash(words) if len(words) >= SPAM_MIN_WORDS else None
+            if signature is not None:
+                record = self._find_similar(signature)
+            if record is None:
+                self._expire(now)
+                record = _SpamRecord(signature)
+                self._add(record)
+            # Варианты текста запоминаем для быстрого точного поиска, но не без предела
+            if len(record.keys) < 8:
+                record.keys.append(key)
+                self._exact[key] = record
+
+        if now - record.last_seen >= SPAM_WINDOW:
+            record.chats.clear()
+        self._records.move_to_end(id(record))
+        record.last_seen = now
+
+        seen = record.chats.get(chat_id)
+        if seen is None or now - seen[1] >= SPAM_WINDOW:
+            seen = record.chats[chat_id] = [0, now]
+        seen[0] += 1
+        seen[1] = now
+        return seen[0], len(record.chats)
+
+
+spam_index = SpamIndex()
+
+
+def is_spam(repeats) -> bool:
+    return repeats is not None and (repeats[0] >= SPAM_CHAT_REPEATS or repeats[1] >= SPAM_GLOBAL_CHATS)
+
+
+async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повторы одного текста в чате и между чатами: удаление (или пометка в логе)"""
+    spam = False
+    try:
+        message = update.effective_message
+        repeats = spam_index.check(update.effective_chat.id, message.text or message.caption, time.monotonic())
+        if not is_spam(repeats):
+            return
+        user_id = update.effective_user.id
+        if await context.info.can(CAN_LIMITED_MODERATE):
+            return
+        logger.warning(
+            f"Спам в чате {update.effective_chat.id} от {user_id}: "
+            f"{repeats[0]} повторов в чате, {repeats[1]} чатов"
+        )
+        if SPAM_ACTION == "delete":
+            spam = True
+            await message.delete()
+            audit_log.record(update.effective_chat.id, user_id, 0, "del", f"spam: {message.text or message.caption}")
+    except Exception as e:
+        logger.error(f"Ошибка в check_spam: {e}")
+    if spam:
+        raise ApplicationHandlerStop
+
+
+# ==================== ДОПОЛНИТЕЛЬНЫЕ ФУНКЦИИ ====================
+async def track_chat_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сброс кэша администраторов, учёт вступлений и подтверждение ожидающих /admin, /unadmin"""
+    try:
+        change = update.chat_member or update.my_chat_member
+        admin_statuses = ('creator', 'administrator')
+        was_admin = change.old_chat_member.status in admin_statuses
+        is_admin = change.new_chat_member.status in admin_statuses
+        if was_admin or is_admin:
+            admin_cache.invalidate(change.chat.id)
+            role_index.update_member(change.chat.id, change.new_chat_member.user.id, change.new_chat_member.status)
+        joined = change.old_chat_member.status in ('left', 'kicked') and \
+            change.new_chat_member.status in ('member', 'restricted')
+        if update.chat_member and joined:
+            recent_joins.add(change.chat.id, [change.new_chat_member.user.id], time.monotonic())
+        pending_confirmations.resolve(change.chat.id, change.new_chat_member.user.id, change.new_chat_member.status)
+    except Exception as e:
+        logger.error(f"Ошибка в track_chat_members: {e}")
+
+
+async def summon_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Вызов админов с кулдауном на чат и на пользователя; повторы не стоят API-запросов"""
+    chat_id = update.effective_chat.id
+    user_key = (chat_id, update.effective_user.id)
+    now = time.monotonic()
+    if not summon_chat_cooldown.ready(chat_id, now) or not summon_user_cooldown.ready(user_key, now):
+        return
+    summon_chat_cooldown.hit(chat_id, now)
+    summon_user_cooldown.hit(user_key, now)
+
+    mentions_text = await admin_cache.mentions(context.bot, chat_id)
+    if mentions_text:
+        reply(
+            update,
+            f"🆘 <b>Adminlar chaqirildi!</b>\n{mentions_text}",
+            parse_mode=ParseMode.HTML,
+            priority=PRIORITY_HIGH
+        )
+
+
+async def check_keywords_and_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка @admins и ключевых слов чата (по умолчанию donat, donater, garant)"""
+    try:
+        if not update.message.text:
+            return
+        replies, admins_called = get_keyword_engine(update.effective_chat.id).match(update.message.text)
+
+        # Ключевые слова — авто-ответы (реклама по умолчанию)
+        for reply_text in replies:
+            reply(update, reply_text, parse_mode=ParseMode.HTML, priority=PRIORITY_LOW)
 
         # @admins — уведомление всех Telegram-админов чата
-        if "@admins" in update.message.text:
-            admins = await context.bot.get_chat_administrators(update.effective_chat.id)
-            mentions = []
-            for admin in admins:
-                if not admin.user.is_bot:
-                    mentions.append(admin.user.mention_html())
-            if mentions:
-                mentions_text = " ".join(mentions)
-                await update.message.reply_text(
-                    f"🆘 <b>Adminlar chaqirildi!</b>\n{mentions_text}",
-                    parse_mode=ParseMode.HTML
-                )
+        if admins_called:
+            await summon_admins(update, context)
     except Exception as e:
         logger.error(f"Ошибка в check_keywords_and_admins: {e}")
 
@@ -1044,9 +4479,9 @@ Bog'laning va o'z orzuingizdagi akkauntni oling 😎
 async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /info"""
     try:
-        collect_stats(update)
+        info = context.info
 
-        target_user, target_id = await get_user_from_message(update, context)
+        target_user, target_id = await info.target(context)
         if not target_user:
             target_user = update.effective_user
             target_id = target_user.id
@@ -1061,15 +4496,15 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"<b>Til:</b> {target_user.language_code or 'nomaʼlum'}\n\n"
             f"🔗 <a href=\"tg://user?id={target_id}\">Profil</a>"
         )
-        await update.message.reply_text(info_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        reply(update, info_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
     except Exception as e:
         logger.error(f"Ошибка в /info: {e}")
 
 
 async def chat_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        collect_stats(update)
-        await update.message.reply_text(
+        reply(
+            update,
             f"<b>📊 Guruh ma'lumotlari:</b>\n\n"
             f"<b>ID:</b> <code>{update.effective_chat.id}</code>\n"
             f"<b>Nomi:</b> {update.effective_chat.title}\n"
@@ -1081,52 +4516,457 @@ async def chat_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ==================== ЗАПУСК БОТА ====================
+async def on_start(application: Application):
+    """Запуск планировщика (просроченные за время простоя действия выполнятся сразу) и метрик"""
+    scheduler.start(application)
+    if PROFILE_SECONDS:
+        profiler.start(min(PROFILE_SECONDS, PROFILE_MAX_SECONDS))
+    if METRICS_PORT:
+        await metrics_server.start(application, METRICS_LISTEN, METRICS_PORT)
+
+
+async def on_stop(application: Application):
+    """Отправка того, что осталось в очереди, пока бот ещё может слать сообщения"""
+    await join_batcher.flush_all()
+    await outbox.drain(timeout=10)
+    await metrics_server.stop()
+    profiler.stop()
+
+
+async def on_shutdown(application: Application):
+    """Финальная запись всех отложенных изменений при остановке"""
+    await storage.flush()
+    username_index.close()
+    audit_log.close()
+
+
+async def observe_update_lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Задержка обновления: от времени сообщения в Telegram до начала обработки"""
+    message = update.effective_message
+    # У недоступных сообщений (старые callback query) дата — 0
+    if message and message.date.timestamp() > 0:
+        sent = message.edit_date or message.date
+        metrics.update_lag.observe(max(0.0, time.time() - sent.timestamp()))
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запись входящих обновлений в JSON Lines для воспроизведения в bench.py"""
+    try:
+        with open(RECORD_UPDATES_FILE, 'a', encoding='utf-8') as f:
+            f.write(update.to_json() + "\n")
+    except Exception as e:
+        logger.error(f"Ошибка записи обновления: {e}")
+
+
+def build_application(token: str, base_url: str = None, polling: bool = True,
+                      concurrent_updates=True) -> Application:
+    """
+    Создание Application со всеми обработчиками (используется и в bench.py).
+    polling=False — без Updater: обновления кладутся в update_queue снаружи (воркер шарда).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(concurrent_updates)
+        .request(MetricsRequest(connection_pool_size=256))
+        .post_init(on_start)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if polling:
+        builder = builder.get_updates_request(MetricsRequest())
+    else:
+        builder = builder.updater(None)
+    if base_url:
+        # Локальный Bot API сервер (или его заглушка в bench.py)
+        builder = builder.base_url(f"{base_url}/bot")
+    application = builder.build()
+
+    # Команды
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("rules", rules))
+    application.add_handler(CommandHandler("setrules", set_rules))
+    application.add_handler(CommandHandler("setwelcome", set_welcome))
+    application.add_handler(CommandHandler("addkeyword", add_keyword))
+    application.add_handler(CommandHandler("delkeyword", del_keyword))
+    application.add_handler(CommandHandler("keywords", list_keywords))
+
+    # Модерация
+    application.add_handler(CommandHandler("warn", warn))
+    application.add_handler(CommandHandler("warns", warns))
+    application.add_handler(CommandHandler("resetwarns", reset_warns))
+    application.add_handler(CommandHandler("ban", ban))
+    application.add_handler(CommandHandler("unban", unban))
+    application.add_handler(CommandHandler("kick", kick))
+    application.add_handler(CommandHandler("mute", mute))
+    application.add_handler(CommandHandler("unmute", unmute))
+    application.add_handler(CommandHandler("del", delete_message))
+    application.add_handler(CommandHandler("pin", pin_message))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("bulkban", bulk_ban))
+    application.add_handler(CommandHandler("bulkkick", bulk_kick))
+    application.add_handler(CommandHandler("bulkmute", bulk_mute))
+    application.add_handler(CommandHandler("bulkunmute", bulk_unmute))
+
+    # Информация
+    application.add_handler(CommandHandler("info", user_info))
+    application.add_handler(CommandHandler("admins", admins_list))
+    application.add_handler(CommandHandler("chatid", chat_id_command))
+
+    # Управление админами
+    application.add_handler(CommandHandler("admin", make_bot_admin))
+    application.add_handler(CommandHandler("unadmin", remove_bot_admin))
+    application.add_handler(CommandHandler("statsbot", stats_bot))
+    application.add_handler(CommandHandler("profile", profile_command))
+
+    # Системные обработчики
+    application.add_handler(TypeHandler(Update, learn_usernames), group=-4)
+    application.add_handler(
+        MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.MESSAGE & ~filters.StatusUpdate.ALL, check_flood),
+        group=-2
+    )
+    application.add_handler(
+        MessageHandler(filters.ChatType.GROUPS & (filters.TEXT | filters.CAPTION) & ~filters.COMMAND, check_spam),
+        group=-1
+    )
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_user))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_keywords_and_admins))
+    application.add_handler(ChatMemberHandler(track_chat_members, ChatMemberHandler.ANY_CHAT_MEMBER))
+
+    if RECORD_UPDATES_FILE:
+        application.add_handler(TypeHandler(Update, record_update), group=-3)
+    application.add_handler(TypeHandler(Update, prepare_update), group=-5)
+    application.add_handler(TypeHandler(Update, observe_update_lag), group=-6)
+
+    # Время каждого обработчика — в метрики
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback)
+    return application
+
+
+# ==================== ШАРДИРОВАНИЕ ====================
+def shard_of(update: dict, shards: int) -> int:
+    """Воркер для обновления: по chat_id, без чата (inline, poll_answer) — по отправителю"""
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"] % shards
+        sender = value.get("from") or value.get("user")
+        if sender:
+            return sender["id"] % shards
+    return 0
+
+
+def split_data(shards: int):
+    """
+    Однократная раскладка данных DATA_DIR по шардам: файлы чатов и
+    отложенные действия — в shard-K своего чата, пользователи статистики — в
+    shard-0, owner — в OWNER_FILE. Исходные файлы (и журнал модерации,
+    который воркеры начинают заново) остаются как есть.
+    Число шардов записывается в shards.json; сменить его потом нельзя.
+    """
+    marker = f"{DATA_DIR}/shards.json"
+    if os.path.exists(marker):
+        with open(marker, 'r', encoding='utf-8') as f:
+            split = json.load(f).get("shards")
+        if split != shards:
+            raise RuntimeError(f"Ma'lumotlar {split} ta shardga bo'lingan, BOT_SHARDS={shards}")
+        return
+    if STORAGE_BACKEND == "sqlite" and os.path.exists(SQLITE_FILE):
+        raise RuntimeError(f"{SQLITE_FILE} shardlarga avtomatik bo'linmaydi")
+
+    source = JsonStorage()
+    source.load()
+    source.stats.close()
+    warned = [0] * shards
+    for shard in range(shards):
+        os.makedirs(f"{DATA_DIR}/shard-{shard}/chats", exist_ok=True)
+    for chat_id in source.chats.chat_ids():
+        chat = source.chats.get(chat_id)
+        save_data(f"{DATA_DIR}/shard-{chat_id % shards}/chats/{chat_id}.json", chat)
+        warned[chat_id % shards] += chat["warnings"].warned_users() if "warnings" in chat else 0
+    files = {SUMMARY_FILE: [{"warned_users": n} for n in warned]}
+    files[SCHEDULE_FILE] = [
+        {"next_id": source.schedule["next_id"], "backfilled": source.is_schedule_backfilled(), "entries": {}}
+        for _ in range(shards)
+    ]
+    for entry_id, entry in source.schedule["entries"].items():
+        files[SCHEDULE_FILE][entry[2] % shards]["entries"][entry_id] = entry
+    files[STATS_FILE] = [
+        {"chats": [c for c in source.stats.chats if c % shards == shard],
+         "users": list(source.stats.users) if shard == 0 else []}
+        for shard in range(shards)
+    ]
+
+    for shard in range(shards):
+        for path, parts in files.items():
+            save_data(f"{DATA_DIR}/shard-{shard}/{os.path.basename(path)}", parts[shard])
+    if source.get_owner() is not None and not os.path.exists(OWNER_FILE):
+        write_file(OWNER_FILE, str(source.get_owner()))
+    save_data(marker, {"shards": shards})
+    logger.info(f"Данные разложены по {shards} шардам")
+
+
+def aggregate_shard_stats() -> tuple:
+    """
+    /statsbot при шардировании: чаты и ogohlantirishlar суммируются по всем
+    SHARED_DATA_DIR/shard-*, пользователи объединяются (один пользователь пишет
+    в чаты разных шардов). Чужие шарды читаются с диска, поэтому их
+    ogohlantirishlar могут отставать на SAVE_DELAY. Блокирующее — через executor.
+    """
+    chats, users, warned = 0, set(), 0
+    for data_dir in sorted(glob.glob(f"{SHARED_DATA_DIR}/shard-*/")):
+        shard_chats, shard_users, shard_warned = type(storage).read_stats(data_dir.rstrip("/"))
+        chats += shard_chats
+        users |= shard_users
+        warned += shard_warned
+    return chats, len(users), warned
+
+
+class ShardIngress:
+    """
+    Приёмник обновлений для нескольких воркеров. Сам делает getUpdates и, не
+    разбирая обновления в объекты, отдаёт каждое воркеру shard_of() строкой
+    JSON в его unix-сокет. Обновления одного чата всегда идут в один воркер
+    по порядку, поэтому состояние чата живёт только в нём.
+    Общие для воркеров: OWNER_FILE, индекс username (SHARED_DATA_DIR) и итог
+    /statsbot (aggregate_shard_stats). SpamIndex остаётся у каждого свой.
+    """
+
+    def __init__(self, token: str, shards: int, base_url: str = None, worker_command: list = None):
+        self.base_url = base_url
+        self.url = f"{base_url or 'https://api.telegram.org'}/bot{token}"
+        self.shards = shards
+        # По умолчанию воркер — этот же bot.py
+        self.worker_command = worker_command or [sys.executable, os.path.abspath(__file__)]
+        self.workers = []
+        self.writers = []
+        self.forwarded = 0
+        self._stop = asyncio.Event()
+
+    def socket_path(self, shard: int) -> str:
+        return f"{DATA_DIR}/shard-{shard}.sock"
+
+    async def start(self):
+        """Раскладка данных, запуск воркеров и подключение к их сокетам"""
+        split_data(self.shards)
+        # Общий индекс username воркеры только дописывают; сжимаем его, пока они не запущены
+        username_index.load(compact=True)
+        username_index.close()
+        for shard in range(self.shards):
+            path = self.socket_path(shard)
+            if os.path.exists(path):
+                os.remove(path)
+            env = dict(os.environ, BOT_DATA_DIR=f"{DATA_DIR}/shard-{shard}",
+                       BOT_SHARED_DATA_DIR=DATA_DIR, BOT_SHARD_SOCKET=path, BOT_SHARDS=str(self.shards))
+            if self.base_url:
+                env["BOT_API_URL"] = self.base_url
+            if METRICS_PORT:
+                env["METRICS_PORT"] = str(METRICS_PORT + shard)
+            self.workers.append(await asyncio.create_subprocess_exec(*self.worker_command, env=env))
+        for shard in range(self.shards):
+            self.writers.append(await self._connect(shard))
+        logger.info(f"Запущено воркеров: {self.shards}")
+
+    async def _connect(self, shard: int):
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_path(shard))
+                return writer
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.workers[shard].returncode is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Воркер {shard} не запустился")
+                await asyncio.sleep(0.1)
+
+    def stop(self):
+        self._stop.set()
+
+    async def run(self):
+        """Пересылка обновлений до stop() или падения любого воркера"""
+        async with httpx.AsyncClient(timeout=SHARD_POLL_TIMEOUT + 10) as client:
+            await self._call(client, "deleteWebhook", drop_pending_updates=DROP_PENDING_UPDATES)
+            poll = asyncio.create_task(self._poll(client))
+            waiters = [asyncio.create_task(self._stop.wait()), poll]
+            waiters += [asyncio.create_task(worker.wait()) for worker in self.workers]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for task in waiters:
+                task.cancel()
+            for shard, worker in enumerate(self.workers):
+                if worker.returncode is not None:
+                    logger.error(f"Воркер {shard} завершился с кодом {worker.returncode}")
+            if poll.done() and not poll.cancelled() and poll.exception():
+                raise poll.exception()
+
+    def load_offset(self) -> int:
+        """Offset, с которого продолжать: после сброса очереди — с начала"""
+        if DROP_PENDING_UPDATES:
+            return 0
+        try:
+            with open(SHARD_OFFSET_FILE, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            logger.error(f"Повреждён {SHARD_OFFSET_FILE}, начинаем с неподтверждённых обновлений")
+            return 0
+
+    def save_offset(self, offset: int):
+        """Атомарная запись offset (без write_file: пишется на каждую пачку, лог не засоряем)"""
+        temp_path = SHARD_OFFSET_FILE + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(str(offset))
+        os.replace(temp_path, SHARD_OFFSET_FILE)
+
+    async def _poll(self, client: httpx.AsyncClient):
+        offset = self.load_offset()
+        while True:
+            try:
+                updates = await self._call(client, "getUpdates", offset=offset, timeout=SHARD_POLL_TIMEOUT,
+                                           allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta)
+                                    else e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                line = json.dumps(update, ensure_ascii=False).encode('utf-8') + b"\n"
+                self.writers[shard_of(update, self.shards)].write(line)
+            # Ждём, пока воркеры заберут отправленное, и только потом подтверждаем offset
+            await asyncio.gather(*(writer.drain() for writer in self.writers))
+            if updates:
+                offset = updates[-1]["update_id"] + 1
+                self.forwarded += len(updates)
+                self.save_offset(offset)
+
+    async def _call(self, client: httpx.AsyncClient, method: str, **params):
+        response = await client.post(f"{self.url}/{method}", json=params)
+        result = response.json()
+        if not result.get("ok"):
+            retry_after = result.get("parameters", {}).get("retry_after")
+            if retry_after:
+                raise RetryAfter(retry_after)
+            raise RuntimeError(f"{method}: {result.get('description')}")
+        return result["result"]
+
+    async def close(self):
+        """Закрытие сокетов: воркер дообрабатывает принятое и завершается сам"""
+        for writer in self.writers:
+            writer.close()
+        await asyncio.gather(*(writer.wait_closed() for writer in self.writers), return_exceptions=True)
+        for shard, worker in enumerate(self.workers):
+            try:
+                await asyncio.wait_for(worker.wait(), SHARD_START_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Воркер {shard} не завершился, останавливаем принудительно")
+                worker.kill()
+                await worker.wait()
+            if os.path.exists(self.socket_path(shard)):
+                os.remove(self.socket_path(shard))
+
+
+async def run_ingress():
+    """Процесс-приёмник (BOT_SHARDS > 1)"""
+    ingress = ShardIngress(BOT_TOKEN, SHARDS, BOT_API_URL)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, ingress.stop)
+    try:
+        await ingress.start()
+        await ingress.run()
+    finally:
+        await ingress.close()
+
+
+async def run_shard_worker(application: Application, socket_path: str):
+    """
+    Воркер шарда: Application без Updater, обновления приходят строками JSON
+    из сокета. Соединение закрыто (или SIGTERM) — дообрабатываем очередь и выходим.
+    """
+    done = asyncio.Event()
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    update = Update.de_json(json.loads(line), application.bot)
+                except Exception as e:
+                    logger.error(f"Ошибка разбора обновления: {e}")
+                    continue
+                await application.update_queue.put(update)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            done.set()
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, done.set)
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        server = await asyncio.start_unix_server(receive, socket_path, limit=SHARD_LINE_LIMIT)
+        await done.wait()
+        server.close()
+        await application.stop()
+        await application.post_stop(application)
+    await application.post_shutdown(application)
+
+
+def run_worker():
+    """Процесс-воркер (BOT_SHARD_SOCKET задан приёмником)"""
+    # Ctrl+C получает вся группа процессов; останавливает воркеры приёмник
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    formatter = logging.Formatter(
+        f'%(asctime)s - {os.path.basename(DATA_DIR)} - %(name)s - %(levelname)s - %(message)s'
+    )
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(formatter)
+    load_data()
+    application = build_application(BOT_TOKEN, BOT_API_URL, polling=False)
+    asyncio.run(run_shard_worker(application, SHARD_SOCKET))
+    storage.close()
+
+
 def main():
     """Основная функция запуска бота"""
     try:
-        load_data()
-        BOT_TOKEN = "8312081729:AAH9IZR1dF_QLA4WamD6Wwd36v-ZE7XN_o0"
         if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
             logger.error("❌ Bot tokeni topilmadi! BotFather'dan token oling.")
             return
+        if SHARD_SOCKET:
+            run_worker()
+            return
+        if SHARDS > 1:
+            logger.info(f"🔄 Bot {SHARDS} ta worker bilan ishga tushmoqda...")
+            asyncio.run(run_ingress())
+            return
+        load_data()
         logger.info("🔄 Bot ishga tushmoqda...")
-        application = Application.builder().token(BOT_TOKEN).concurrent_updates(True).build()
-
-        # Команды
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("rules", rules))
-        application.add_handler(CommandHandler("setrules", set_rules))
-        application.add_handler(CommandHandler("setwelcome", set_welcome))
-
-        # Модерация
-        application.add_handler(CommandHandler("warn", warn))
-        application.add_handler(CommandHandler("warns", warns))
-        application.add_handler(CommandHandler("resetwarns", reset_warns))
-        application.add_handler(CommandHandler("ban", ban))
-        application.add_handler(CommandHandler("unban", unban))
-        application.add_handler(CommandHandler("kick", kick))
-        application.add_handler(CommandHandler("mute", mute))
-        application.add_handler(CommandHandler("unmute", unmute))
-        application.add_handler(CommandHandler("del", delete_message))
-        application.add_handler(CommandHandler("pin", pin_message))
-
-        # Информация
-        application.add_handler(CommandHandler("info", user_info))
-        application.add_handler(CommandHandler("admins", admins_list))
-        application.add_handler(CommandHandler("chatid", chat_id_command))
-
-        # Управление админами
-        application.add_handler(CommandHandler("admin", make_bot_admin))
-        application.add_handler(CommandHandler("unadmin", remove_bot_admin))
-        application.add_handler(CommandHandler("statsbot", stats_bot))
-
-        # Системные обработчики
-        application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_user))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_keywords_and_admins))
+        application = build_application(BOT_TOKEN, BOT_API_URL)
 
         logger.info("✅ Bot muvaffaqiyatli ishga tushdi!")
-        application.run_polling(drop_pending_updates=True)
+        # chat_member обновления приходят только если их явно запросить
+        if WEBHOOK_URL:
+            # Webhook за reverse proxy: Telegram копит обновления, пока бот перезапускается
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=False,
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            application.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+        storage.close()
     except Exception as e:
         logger.error(f"❌ Bot ishga tushmadi: {e}")
         import traceback
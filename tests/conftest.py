@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Данные тестов — во временном каталоге, до импорта bot
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="test_bot_data_")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,20 @@
+import bot
+
+
+def test_join_seen_twice_is_recorded_once(monkeypatch):
+    monkeypatch.setattr(bot, "BULK_MAX_TARGETS", 2)
+    joins = bot.RecentJoins()
+    # new_chat_members и chat_member об одном вступлении — одна запись, а не две
+    joins.add(-100, [1], 10.0)
+    joins.add(-100, [1], 10.5)
+    joins.add(-100, [2], 11.0)
+    assert joins.since(-100, 60, 12.0) == [1, 2]
+
+
+def test_window_and_capacity(monkeypatch):
+    monkeypatch.setattr(bot, "BULK_MAX_TARGETS", 2)
+    joins = bot.RecentJoins()
+    joins.add(-100, [1, 2, 3], 0.0)
+    assert joins.since(-100, 60, 1.0) == [2, 3]
+    joins.add(-100, [4], 30.0)
+    assert joins.since(-100, 10, 31.0) == [4]
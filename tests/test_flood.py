@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import bench
+import bot
+
+
+def test_user_limit_and_single_punishment():
+    detector = bot.FloodDetector()
+    hits = [detector.hit(-1, 1, 100.0 + i * 0.1) for i in range(bot.FLOOD_USER_LIMIT)]
+    assert hits == [False] * (bot.FLOOD_USER_LIMIT - 1) + [True]
+    # Тот же темп, но растянутый шире окна — не флуд
+    assert not any(detector.hit(-1, 2, 100.0 + i * bot.FLOOD_USER_WINDOW) for i in range(bot.FLOOD_USER_LIMIT))
+    assert detector.punish(-1, 1, 101.0)
+    assert not detector.punish(-1, 1, 102.0)
+    assert detector.punish(-1, 1, 101.0 + bot.FLOOD_MUTE_SECONDS)
+
+
+def test_raid_halves_user_limit():
+    detector = bot.FloodDetector()
+    for i in range(bot.FLOOD_CHAT_LIMIT):
+        detector.hit(-1, 1000 + i, 100.0 + i * 0.01)
+    assert detector.in_raid(-1, 101.0)
+    raid_limit = max(2, bot.FLOOD_USER_LIMIT // 2)
+    hits = [detector.hit(-1, 1, 101.0 + i * 0.1) for i in range(raid_limit)]
+    assert hits[-1] and not any(hits[:-1])
+    # Сообщения во время рейда продлевают его, пока чат не затихнет
+    assert not detector.in_raid(-1, 102.0 + bot.RAID_DURATION)
+
+
+def restricted(updates) -> list:
+    """user_id из вызовов restrictChatMember при прогоне updates"""
+    api = bench.FakeBotApi()
+    calls = []
+    dispatch = api.dispatch
+
+    async def recording(method, params):
+        if method == "restrictChatMember":
+            calls.append(int(params["user_id"]))
+        return await dispatch(method, params)
+
+    api.dispatch = recording
+    asyncio.run(bench.replay(updates, "polling", api=api))
+    return calls
+
+
+def messages(chat_id: int, user_id: int, kind: str = "message", **extra) -> list:
+    return [{"update_id": i + 1, kind: dict({
+        "message_id": i + 1,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "supergroup", "title": "Test"},
+        "from": bench.user_json(user_id),
+        "text": f"salom {i}",
+    }, **extra)} for i in range(bot.FLOOD_USER_LIMIT * 2)]
+
+
+def test_edits_and_sender_chat_are_not_flood():
+    bot.load_data()
+    assert restricted(messages(-300, 8001, "edited_message", edit_date=int(time.time()))) == []
+    channel = {"id": -1009, "type": "channel", "title": "Kanal"}
+    assert restricted(messages(-301, 8002, sender_chat=channel)) == []
+    assert restricted(messages(-302, 8003)) == [8003]
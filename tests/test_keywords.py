@@ -0,0 +1,21 @@
+import bot
+
+
+def test_overlapping_and_contained_keywords():
+    engine = bot.KeywordEngine({"garant": "G", "ant": "A", "price": "P", "rice": "R"})
+    replies, admins_called = engine.match("garant price")
+    assert replies == ["G", "A", "P", "R"]
+    assert not admins_called
+
+
+def test_keyword_that_is_prefix_of_another():
+    engine = bot.KeywordEngine({"donat": "D", "donater": "DR", "nat": "N"})
+    assert engine.match("Donater bormi")[0] == ["D", "DR", "N"]
+    assert engine.match("donat")[0] == ["D", "N"]
+
+
+def test_admins_trigger_inside_text():
+    engine = bot.KeywordEngine({"admin": "X"})
+    replies, admins_called = engine.match("yordam @admins tez")
+    assert replies == ["X"] and admins_called
+    assert not engine.match("@ADMINS")[1]
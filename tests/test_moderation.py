@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import bench
+import bot
+
+CHAT_ID = -100
+
+
+def command(update_id: int, text: str, user_id: int = bench.OWNER_ID) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": CHAT_ID, "type": "supergroup", "title": "Test"},
+        "from": bench.user_json(user_id),
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    }}
+
+
+def scheduled(kind: str, user_id: int) -> list:
+    return [entry for entry in bot.storage.get_schedule()
+            if entry[2] == kind and entry[3] == CHAT_ID and entry[4] == user_id]
+
+
+def test_bulkban_cancels_pending_unban():
+    bot.load_data()
+    asyncio.run(bench.replay([command(1, "/ban 5001 1h reklama")], "polling"))
+    assert scheduled("unban", 5001)
+    asyncio.run(bench.replay([command(1, "/bulkban 5001 5002")], "polling"))
+    assert not scheduled("unban", 5001)
+
+
+def test_bulkmute_schedules_and_cancels_unmute():
+    bot.load_data()
+    asyncio.run(bench.replay([command(1, "/bulkmute 30m 6001 6002")], "polling"))
+    assert scheduled("unmute", 6001) and scheduled("unmute", 6002)
+    asyncio.run(bench.replay([command(1, "/bulkmute 6001")], "polling"))
+    assert not scheduled("unmute", 6001)
+    assert scheduled("unmute", 6002)
+
+
+def promoted(updates) -> list:
+    """user_id из вызовов promoteChatMember при прогоне updates"""
+    api = bench.FakeBotApi()
+    calls = []
+    dispatch = api.dispatch
+
+    async def recording(method, params):
+        if method == "promoteChatMember":
+            calls.append(int(params["user_id"]))
+        return await dispatch(method, params)
+
+    api.dispatch = recording
+    asyncio.run(bench.replay(updates, "polling", api=api))
+    return calls
+
+
+def test_admin_by_username_and_id():
+    bot.load_data()
+    greeting = command(1, "/start", user_id=7001)
+    greeting["message"]["from"]["username"] = "newadmin"
+    assert promoted([greeting, command(2, "/admin @newadmin")]) == [7001]
+    assert promoted([command(1, "/admin 7002")]) == [7002]
@@ -0,0 +1,65 @@
+import asyncio
+
+import bot
+
+CHAT_ID = -100
+
+
+def test_overflow_drops_oldest_low_priority(monkeypatch):
+    monkeypatch.setattr(bot, "OUTBOX_CHAT_LIMIT", 5)
+    dropped = bot.metrics.outbox_dropped["overflow"]
+
+    async def run():
+        outbox = bot.OutboundDispatcher()
+        sent = []
+
+        def call(name):
+            async def send():
+                sent.append(name)
+            return send
+
+        futures = {}
+        # Первые GROUP_SEND_BURST уходят сразу, остальные ждут токена
+        for i in range(bot.GROUP_SEND_BURST):
+            futures[f"burst{i}"] = outbox.submit(CHAT_ID, call(f"burst{i}"), bot.PRIORITY_HIGH)
+        await asyncio.sleep(0.05)
+        for i in range(4):
+            futures[f"low{i}"] = outbox.submit(CHAT_ID, call(f"low{i}"), bot.PRIORITY_LOW)
+        for i in range(3):
+            futures[f"high{i}"] = outbox.submit(CHAT_ID, call(f"high{i}"), bot.PRIORITY_HIGH)
+        assert outbox.depth() == 5
+        return futures
+
+    futures = asyncio.run(run())
+    assert bot.metrics.outbox_dropped["overflow"] - dropped == 2
+    assert futures["low0"].result() is None and futures["low1"].result() is None
+    assert not futures["low2"].done() and not futures["high2"].done()
+
+
+def test_stale_low_priority_is_not_sent(monkeypatch):
+    monkeypatch.setattr(bot, "GROUP_SEND_RATE", 10)
+    monkeypatch.setattr(bot, "GROUP_SEND_BURST", 1)
+    monkeypatch.setattr(bot, "OUTBOX_LOW_MAX_AGE", 0.05)
+    dropped = bot.metrics.outbox_dropped["stale"]
+
+    async def run():
+        outbox = bot.OutboundDispatcher()
+        sent = []
+
+        def call(name):
+            async def send():
+                sent.append(name)
+                return name
+            return send
+
+        # Второе сообщение ждёт токена 0.1 сек — дольше OUTBOX_LOW_MAX_AGE
+        outbox.submit(CHAT_ID, call("first"), bot.PRIORITY_HIGH)
+        low = outbox.submit(CHAT_ID, call("welcome"), bot.PRIORITY_LOW)
+        normal = outbox.submit(CHAT_ID, call("reply"), bot.PRIORITY_NORMAL)
+        await outbox.drain(2)
+        return sent, await low, await normal
+
+    sent, low, normal = asyncio.run(run())
+    assert sent == ["first", "reply"]
+    assert low is None and normal == "reply"
+    assert bot.metrics.outbox_dropped["stale"] - dropped == 1
@@ -0,0 +1,54 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import bot
+
+CHAT = SimpleNamespace(id=-100, type="supergroup")
+NO_RIGHTS = b'{"ok": false, "error_code": 400, "description": "Bad Request: not enough rights to restrict/demote chat member"}'
+
+
+def role_index(monkeypatch) -> list:
+    """Свежий role_index; возвращает список чатов, для которых загружались админы"""
+    loads = []
+
+    async def get_admins(_bot, chat_id):
+        loads.append(chat_id)
+        return {}
+
+    monkeypatch.setattr(bot, "role_index", bot.RoleIndex())
+    monkeypatch.setattr(bot.admin_cache, "get", get_admins)
+    monkeypatch.setattr(bot.storage, "get_bot_admins", lambda chat_id: [])
+    return loads
+
+
+async def ensure():
+    await bot.role_index.ensure(None, CHAT)
+    # Фоновая сверка успевает выполниться
+    await asyncio.sleep(0)
+
+
+def test_rights_error_resyncs_before_next_check(monkeypatch):
+    loads = role_index(monkeypatch)
+    asyncio.run(ensure())
+    asyncio.run(ensure())
+    assert loads == [CHAT.id]
+    bot.track_moderation({"chat_id": CHAT.id}, 400, b'{"ok": false, "description": "Bad Request: message to delete not found"}')
+    asyncio.run(ensure())
+    assert loads == [CHAT.id]
+    bot.track_moderation({"chat_id": CHAT.id}, 400, NO_RIGHTS)
+    asyncio.run(ensure())
+    assert loads == [CHAT.id, CHAT.id]
+
+
+def test_moderated_chat_resyncs_sooner(monkeypatch):
+    loads = role_index(monkeypatch)
+    asyncio.run(ensure())
+    stale = time.monotonic() - bot.ROLE_RESYNC_ACTIVE - 1
+    bot.role_index._synced[CHAT.id] = stale
+    asyncio.run(ensure())
+    assert loads == [CHAT.id]
+    bot.track_moderation({"chat_id": CHAT.id}, 200, b"")
+    bot.role_index._synced[CHAT.id] = stale
+    asyncio.run(ensure())
+    assert loads == [CHAT.id, CHAT.id]
@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_bot(code: str, **env) -> subprocess.CompletedProcess:
+    """Код с bot в отдельном процессе: split_data работает с путями модуля"""
+    return subprocess.run([sys.executable, "-c", "import bot\n" + code], cwd=ROOT, capture_output=True,
+                          text=True, timeout=60, env=dict(os.environ, **env))
+
+
+def test_shard_of_routes_by_chat_then_sender():
+    chat = {"id": -1001, "type": "supergroup"}
+    assert bot.shard_of({"update_id": 1, "message": {"chat": chat, "from": {"id": 2}}}, 4) == -1001 % 4
+    assert bot.shard_of({"update_id": 2, "callback_query": {"from": {"id": 2}, "message": {"chat": chat}}}, 4) \
+        == -1001 % 4
+    assert bot.shard_of({"update_id": 3, "inline_query": {"from": {"id": 7}}}, 4) == 3
+    assert bot.shard_of({"update_id": 4, "poll_answer": {"user": {"id": 9}}}, 4) == 1
+    assert bot.shard_of({"update_id": 5}, 4) == 0
+
+
+def test_split_data_and_shard_count_mismatch():
+    data_dir = tempfile.mkdtemp(prefix="test_shards_")
+    seeded = run_bot(
+        "bot.storage.load()\n"
+        "for chat_id in (-100, -101):\n"
+        "    bot.storage.add_chat(chat_id)\n"
+        "    bot.storage.set_rules(chat_id, f'rules {chat_id}')\n"
+        "bot.storage.add_user(7)\n"
+        "bot.storage.close()\n"
+        "bot.split_data(2)\n",
+        BOT_DATA_DIR=data_dir)
+    assert seeded.returncode == 0, seeded.stderr
+
+    for chat_id, shard in ((-100, 0), (-101, 1)):
+        with open(f"{data_dir}/shard-{shard}/chats/{chat_id}.json", encoding="utf-8") as f:
+            assert json.load(f)["rules"] == f"rules {chat_id}"
+        assert not os.path.exists(f"{data_dir}/shard-{1 - shard}/chats/{chat_id}.json")
+    with open(f"{data_dir}/shards.json", encoding="utf-8") as f:
+        assert json.load(f) == {"shards": 2}
+
+    # Воркер shard-1 видит в /statsbot итог по обоим шардам
+    totals = run_bot("print(bot.aggregate_shard_stats())",
+                     BOT_DATA_DIR=f"{data_dir}/shard-1", BOT_SHARED_DATA_DIR=data_dir)
+    assert totals.stdout.strip() == "(2, 1, 0)", totals.stderr
+
+    mismatch = run_bot("bot.split_data(3)", BOT_DATA_DIR=data_dir)
+    assert mismatch.returncode != 0
+    assert "BOT_SHARDS=3" in mismatch.stderr
+
+
+def test_username_seen_by_another_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "SHARED_DATA_DIR", str(tmp_path))
+    path = str(tmp_path / "usernames.log")
+    first, second = bot.UsernameIndex(path), bot.UsernameIndex(path)
+    first.load(compact=False)
+    second.load(compact=False)
+    first.learn(bot.User(id=42, first_name="A", is_bot=False, username="Alice"))
+    # Промах во втором воркере дочитывает строку, которую дописал первый
+    assert second.get("@alice") == 42
+    first.close()
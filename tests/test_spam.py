@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+import bot
+
+SPAM = "Arzon kurs! Bitcoin sotib oling, foyda 300% kafolat, yozing http://t.me/x"
+
+
+def test_exact_repeat_in_chat_and_across_chats():
+    index = bot.SpamIndex()
+    assert index.check(-1, SPAM, 0.0) == (1, 1)
+    assert index.check(-1, SPAM, 1.0) == (2, 1)
+    # Ссылка и числа нормализуются — тот же текст
+    assert index.check(-2, SPAM.replace("300", "500").replace("t.me/x", "t.me/y"), 2.0) == (1, 2)
+    assert bot.is_spam(index.check(-3, SPAM, 3.0))
+
+
+def test_near_repeat_is_matched():
+    index = bot.SpamIndex()
+    index.check(-1, SPAM + " tez orada", 0.0)
+    assert index.check(-2, SPAM + " tez", 1.0) == (1, 2)
+    assert index.check(-2, "Bugun kechqurun futbol o'yini bo'ladimi, kim boradi?", 2.0) == (1, 1)
+
+
+def test_window_expiry():
+    index = bot.SpamIndex()
+    index.check(-1, SPAM, 0.0)
+    index.check(-2, SPAM, 1.0)
+    assert index.check(-1, SPAM, 1.0 + bot.SPAM_WINDOW) == (1, 1)
+
+
+def test_signature_is_stable_across_processes():
+    code = f"import bot; print(bot.minhash(bot.normalize_text({SPAM!r}).split()))"
+    signatures = {
+        subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                       env=dict(os.environ, PYTHONHASHSEED=seed), cwd=os.path.dirname(bot.__file__)).stdout
+        for seed in ("1", "2")
+    }
+    assert signatures == {str(bot.minhash(bot.normalize_text(SPAM).split())) + "\n"}
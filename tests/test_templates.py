@@ -0,0 +1,31 @@
+from telegram import User
+
+import bot
+
+LIMIT = bot.MAX_MESSAGE_LENGTH - bot.TEMPLATE_HEADER_RESERVE
+
+
+def test_too_long_template_is_rejected():
+    text, error = bot.check_html("<b>" + "x" * LIMIT + "</b>", LIMIT)
+    assert text is None and "uzun" in error
+    text, error = bot.check_html("<b>" + "x" * (LIMIT - 7) + "</b>", LIMIT)
+    assert error is None
+
+
+def test_placeholders_count_towards_limit():
+    text = "x" * (LIMIT - bot.TEMPLATE_VALUE_MAX["chat"]) + "{chat}"
+    assert bot.check_html(text, LIMIT)[1] is None
+    assert bot.check_html(text + "{chat}", LIMIT)[1] is not None
+
+
+def test_accepted_template_fits_without_cutting():
+    title = '"' * 128
+    for text in ("<b>" + "x" * (LIMIT - 2 * bot.TEMPLATE_VALUE_MAX["chat"] - 7) + "</b>{chat}{chat}",
+                 "<i>" + "y" * (LIMIT - bot.TEMPLATE_VALUE_MAX["chat"] - bot.TEMPLATE_LIST_RESERVE - 7)
+                 + "</i>{chat}{user}"):
+        clean, error = bot.check_html(text, LIMIT)
+        assert error is None
+        members = [User(i, f"User{i}", False) for i in range(1, 500)]
+        rendered = bot.render_template(bot.compile_template(clean), members, title)
+        assert len(rendered) <= bot.MAX_MESSAGE_LENGTH
+        assert bot.check_html(rendered)[1] is None